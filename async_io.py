@@ -0,0 +1,114 @@
+# 异步脚本共用的工具：把读文件、base64、图片缩放这类阻塞操作放到线程池里执行，并监测事件循环的延迟
+# 事件循环线程上每做一次阻塞的 open().read() 或 base64，所有在途的HTTP请求都会跟着停顿，
+# LoopLagMonitor 定时测量 sleep 实际醒来比预期晚了多少，用来确认事件循环没有再被阻塞
+#
+# 用法：
+#     configure_executor(16)   # 可选，默认线程数为 DEFAULT_IO_WORKERS；figure_descriper.py 和 figure_pipeline.py 的 --io-workers 即此参数
+#     async with LoopLagMonitor():
+#         image_base64 = await read_file_base64(path)
+
+import asyncio
+import base64
+import functools
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_IO_WORKERS = min(32, (os.cpu_count() or 4) + 4)
+
+_executor = None
+
+def configure_executor(max_workers=None):
+    """设置阻塞操作使用的线程池大小，需要在第一次使用前调用"""
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False)
+    _executor = ThreadPoolExecutor(max_workers=max_workers or DEFAULT_IO_WORKERS,
+                                   thread_name_prefix='async_io')
+    return _executor
+
+def get_executor():
+    if _executor is None:
+        configure_executor()
+    return _executor
+
+async def run_blocking(func, *args, **kwargs):
+    """在线程池中执行阻塞函数"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_executor(), functools.partial(func, *args, **kwargs))
+
+def _read_bytes(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+def _read_base64(path):
+    return base64.b64encode(_read_bytes(path)).decode('utf-8')
+
+async def read_file_bytes(path):
+    return await run_blocking(_read_bytes, path)
+
+async def read_file_base64(path):
+    """读取文件并做 base64 编码，都在线程池中完成"""
+    return await run_blocking(_read_base64, path)
+
+class LoopLagMonitor:
+    """
+    定时测量事件循环的延迟
+    
+    参数:
+        interval: 采样间隔（秒）
+        warn_threshold: 单次延迟超过该值（秒）时输出警告，同一秒内最多输出一次
+    """
+    def __init__(self, interval=0.1, warn_threshold=0.2):
+        self.interval = interval
+        self.warn_threshold = warn_threshold
+        self.samples = 0
+        self.total_lag = 0.0
+        self.max_lag = 0.0
+        self.slow_samples = 0
+        self.task = None
+        self._last_warning = 0.0
+    
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, loop.time() - expected)
+            self.samples += 1
+            self.total_lag += lag
+            self.max_lag = max(self.max_lag, lag)
+            if lag > self.warn_threshold:
+                self.slow_samples += 1
+                now = time.monotonic()
+                if now - self._last_warning >= 1:
+                    self._last_warning = now
+                    print(f"警告：事件循环阻塞了 {lag * 1000:.0f} 毫秒")
+    
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.get_running_loop().create_task(self._run())
+        return self
+    
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        self.report()
+    
+    def report(self):
+        if not self.samples:
+            return
+        print(f"事件循环延迟: 平均 {self.total_lag / self.samples * 1000:.1f} 毫秒, "
+              f"最大 {self.max_lag * 1000:.1f} 毫秒, "
+              f"超过 {self.warn_threshold * 1000:.0f} 毫秒 {self.slow_samples}/{self.samples} 次")
+    
+    async def __aenter__(self):
+        return self.start()
+    
+    async def __aexit__(self, *exc_info):
+        await self.stop()
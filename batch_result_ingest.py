@@ -0,0 +1,170 @@
+# 把 OpenAI Batch API 的结果文件写回每本书的 auto/<书名>_figures_description.json
+# custom_id 为 "<书名>::<图片文件名>"（见 figure_descriper_batch_jsonl.py），按书名分组后每本书只读写一次描述文件；
+# 失败的请求（错误文件中的记录、非200响应、空描述或不合格的描述）重新生成一个重试分片，可以直接再提交一次 Batch
+#
+# 使用示例：
+#     python batch_result_ingest.py /root/rawdata/batch_request/batch_output_*.jsonl /root/rawdata/batch_request/batch_errors_*.jsonl \
+#         --manifests "/root/rawdata/batch_request/batch_requests_*.manifest.json" \
+#         --root-dir /root/rawdata/gcs/textbook_ocr \
+#         --retry-output /root/rawdata/batch_request/retry_requests.jsonl
+
+import argparse
+import asyncio
+import glob
+import gzip
+import json
+import time
+from collections import Counter
+from pathlib import Path
+from description_journal import DescriptionJournal, journal_path_for, load_descriptions
+from description_quality import check_description
+from figure_catalog import DEFAULT_CATALOG_PATH, FigureCatalog
+from figure_descriper_batch_jsonl import MAX_SHARD_BYTES, MAX_SHARD_REQUESTS, parse_custom_id, write_batch_requests
+
+def iter_jsonl(path):
+    """逐行读取 jsonl（支持 .gz），跳过空行"""
+    opener = gzip.open if str(path).endswith('.gz') else open
+    with opener(path, 'rt', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+def parse_result(record):
+    """返回 (custom_id, 描述, 错误信息)，成功时错误信息为 None，失败时描述为 None"""
+    custom_id = record.get('custom_id')
+    response = record.get('response') or {}
+    error = record.get('error')
+    body = response.get('body') or {}
+    
+    if response.get('status_code') == 200:
+        choices = body.get('choices') or []
+        content = choices[0].get('message', {}).get('content') if choices else None
+        # 和实时接口相同的质量检查，过短或拒绝回答的描述不写入，放进重试分片
+        reason = check_description(content)
+        if reason is None:
+            return custom_id, content, None
+        finish_reason = choices[0].get('finish_reason') if choices else None
+        return custom_id, None, f"{reason} (finish_reason={finish_reason}, {len(content or '')}字)"
+    if error:
+        return custom_id, None, f"{error.get('code')}: {error.get('message')}"
+    body_error = body.get('error') or {}
+    return custom_id, None, f"http_{response.get('status_code')}: {body_error.get('message', '')}"
+
+def load_manifest_images(manifest_patterns):
+    """读取请求分片的 manifest，返回 {custom_id: 图片路径}"""
+    images = {}
+    for pattern in manifest_patterns or []:
+        for manifest_path in sorted(glob.glob(pattern)):
+            with open(manifest_path, 'r', encoding='utf-8') as f:
+                images.update(json.load(f)['images'])
+    return images
+
+def resolve_image(custom_id, manifest_images, root_dir):
+    """返回 (书名, 图片文件名, 图片路径)，无法确定所属的书时返回 None"""
+    image_path = manifest_images.get(custom_id)
+    if image_path is not None:
+        image_path = Path(image_path)
+        # 图片路径为 <textbook_ocr>/<书名>/auto/figures/<文件名>
+        return image_path.parent.parent.parent.name, image_path.name, image_path
+    book, image_name = parse_custom_id(custom_id)
+    if book is None or root_dir is None:
+        return None
+    return book, image_name, Path(root_dir) / book / 'auto' / 'figures' / image_name
+
+def ingest_results(result_paths, manifest_images=None, root_dir=None, catalog=None):
+    """
+    流式读取结果/错误文件，把成功的描述按书合并写入描述文件
+    
+    catalog 不为 None 时同时把描述写入图片目录
+    返回 (每本书新写入的数量, 失败的 {custom_id: (图片路径, 错误信息)})
+    """
+    manifest_images = manifest_images or {}
+    successes = {}
+    failures = {}
+    unresolved = 0
+    records = 0
+    
+    for result_path in result_paths:
+        for record in iter_jsonl(result_path):
+            records += 1
+            custom_id, description, error = parse_result(record)
+            resolved = resolve_image(custom_id, manifest_images, root_dir)
+            if resolved is None:
+                unresolved += 1
+                continue
+            book, image_name, image_path = resolved
+            if description is not None:
+                successes.setdefault((book, image_path.parent.parent), {})[image_name] = description
+                failures.pop(custom_id, None)
+            elif image_name not in successes.get((book, image_path.parent.parent), {}):
+                failures[custom_id] = (str(image_path), error)
+    
+    print(f"共读取 {records} 条结果，成功 {sum(len(v) for v in successes.values())} 条，"
+          f"失败 {len(failures)} 条，无法确定所属书籍 {unresolved} 条")
+    
+    # 每本书只读写一次描述文件，读到的描述留着给下面过滤失败的请求用
+    written = {}
+    book_descriptions = {}
+    for (book, auto_dir), new_descriptions in sorted(successes.items()):
+        output_file = auto_dir / f"{book}_figures_description.json"
+        journal = DescriptionJournal(journal_path_for(output_file))
+        descriptions = load_descriptions(output_file, journal)
+        descriptions.update(new_descriptions)
+        journal.compact(output_file, descriptions)
+        book_descriptions[output_file] = descriptions
+        if catalog is not None:
+            catalog.add_book(book, auto_dir)
+            for name, description in new_descriptions.items():
+                catalog.record_description(book, name, description)
+            catalog.flush()
+        written[book] = len(new_descriptions)
+        print(f"{book}: 写入 {len(new_descriptions)} 条描述，共 {len(descriptions)} 条 -> {output_file}")
+    
+    # 已经有描述的图片不需要重试（例如之前的重试已经成功），每本书的描述文件最多读取一次
+    for custom_id, (image_path, _) in list(failures.items()):
+        image_path = Path(image_path)
+        output_file = image_path.parent.parent / f"{image_path.parent.parent.parent.name}_figures_description.json"
+        if output_file not in book_descriptions:
+            book_descriptions[output_file] = load_descriptions(output_file, DescriptionJournal(journal_path_for(output_file)))
+        if book_descriptions[output_file].get(image_path.name):
+            failures.pop(custom_id)
+    
+    if failures:
+        print("失败原因统计:")
+        for reason, count in Counter(error.split(':')[0].split(' (')[0] for _, error in failures.values()).most_common():
+            print(f"  {reason}: {count}")
+    return written, failures
+
+def main():
+    parser = argparse.ArgumentParser(description="把 Batch API 结果写回每本书的描述文件")
+    parser.add_argument("results", nargs='+', help="Batch 的输出文件和错误文件（jsonl 或 jsonl.gz）")
+    parser.add_argument("--manifests", nargs='*', default=[], help="请求分片的 manifest 文件（支持通配符）")
+    parser.add_argument("--root-dir", default="/root/rawdata/gcs/textbook_ocr",
+                        help="manifest 中找不到时，按 custom_id 中的书名在该目录下定位")
+    parser.add_argument("--retry-output", default=None, help="为失败的请求生成重试分片，例如 retry_requests.jsonl")
+    parser.add_argument("--upload-format", default=None, help="重试分片的图片格式，默认保持原格式")
+    parser.add_argument("--catalog", default=DEFAULT_CATALOG_PATH, help="图片目录数据库")
+    parser.add_argument("--no-catalog", action="store_true", help="不写入图片目录")
+    args = parser.parse_args()
+    
+    start_time = time.time()
+    manifest_images = load_manifest_images(args.manifests)
+    catalog = None if args.no_catalog else FigureCatalog(args.catalog)
+    _, failures = ingest_results(args.results, manifest_images, args.root_dir, catalog)
+    if catalog is not None:
+        catalog.close()
+    print(f"写回完成，用时 {time.time() - start_time:.1f} 秒")
+    
+    if failures and args.retry_output:
+        image_paths = [image_path for image_path, _ in failures.values() if Path(image_path).exists()]
+        print(f"为 {len(image_paths)} 张图片生成重试分片")
+        asyncio.run(write_batch_requests(
+            image_paths, args.retry_output,
+            max_bytes=MAX_SHARD_BYTES,
+            max_requests=MAX_SHARD_REQUESTS,
+            upload_format=args.upload_format,
+        ))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+# 这个模块用于把同一页中重叠、嵌套或相邻的 bbox 聚成一组
+# MinerU 经常把图片主体和标题、拆开的子图输出成多个有重叠的块，分别截图会产生几乎相同的图片
+# 这里按 x 方向做区间扫描（sweep line），只比较 x 区间可能相交的候选框，再用并查集合并
+
+def bbox_area(bbox):
+    return max(0.0, bbox[2] - bbox[0]) * max(0.0, bbox[3] - bbox[1])
+
+def intersection_area(a, b):
+    width = min(a[2], b[2]) - max(a[0], b[0])
+    height = min(a[3], b[3]) - max(a[1], b[1])
+    if width <= 0 or height <= 0:
+        return 0.0
+    return width * height
+
+def bbox_gap(a, b):
+    """两个框之间的距离（取水平和垂直间距中较大的一个），相交时为 0"""
+    dx = max(0.0, max(a[0], b[0]) - min(a[2], b[2]))
+    dy = max(0.0, max(a[1], b[1]) - min(a[3], b[3]))
+    return max(dx, dy)
+
+def union_bbox(bboxes):
+    return [
+        min(b[0] for b in bboxes),
+        min(b[1] for b in bboxes),
+        max(b[2] for b in bboxes),
+        max(b[3] for b in bboxes),
+    ]
+
+def should_merge(a, b, iou_threshold=0.3, contain_threshold=0.8, max_gap=None):
+    """
+    判断两个框是否应该合并
+    
+    参数:
+        iou_threshold: IoU 不小于该值时合并
+        contain_threshold: 交集占较小框面积的比例不小于该值时合并（嵌套的块）
+        max_gap: 不为 None 时，间距不超过该值（单位: pt）的相邻框也合并
+    """
+    if max_gap is not None and bbox_gap(a, b) <= max_gap:
+        return True
+    inter = intersection_area(a, b)
+    if inter <= 0:
+        return False
+    area_a, area_b = bbox_area(a), bbox_area(b)
+    union = area_a + area_b - inter
+    if union > 0 and inter / union >= iou_threshold:
+        return True
+    smaller = min(area_a, area_b)
+    return smaller > 0 and inter / smaller >= contain_threshold
+
+def cluster_bboxes(bboxes, iou_threshold=0.3, contain_threshold=0.8, max_gap=None):
+    """
+    把框聚类，返回每个簇的成员下标列表（簇内按下标升序，簇之间按最小下标排序）
+    """
+    parent = list(range(len(bboxes)))
+    
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+    
+    reach = max_gap or 0.0
+    order = sorted(range(len(bboxes)), key=lambda i: bboxes[i][0])
+    active = []
+    for i in order:
+        x0 = bboxes[i][0]
+        # x 方向已经不可能相交/相邻的框移出候选区间
+        active = [j for j in active if bboxes[j][2] + reach >= x0]
+        for j in active:
+            if find(i) != find(j) and should_merge(bboxes[i], bboxes[j], iou_threshold, contain_threshold, max_gap):
+                parent[find(i)] = find(j)
+        active.append(i)
+    
+    clusters = {}
+    for i in range(len(bboxes)):
+        clusters.setdefault(find(i), []).append(i)
+    return sorted(clusters.values(), key=lambda members: members[0])
\ No newline at end of file
@@ -0,0 +1,170 @@
+# 这个模块提供按内容寻址的图片描述缓存（SQLite）
+# 键为 sha256(图片字节 + 提示词 + 模型 + 参数)，和文件名无关：改名的文件、重新截图的书、不同书里相同的图片都不会重复付费
+# 调用API之前先查缓存，拿到描述后写入缓存；缓存超过 max_bytes 时按最近使用时间淘汰
+# 写入和命中时更新的最近使用时间先缓存在内存中，满 FLUSH_EVERY 条或调用 flush 时一次提交，不必每次查询都提交一次
+#
+# 使用示例：
+#     # 查看缓存大小
+#     python description_cache.py /root/rawdata/figure_description_cache.sqlite
+
+import argparse
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+DEFAULT_CACHE_PATH = '/root/rawdata/figure_description_cache.sqlite'
+DEFAULT_MAX_BYTES = 2 << 30
+FLUSH_EVERY = 200
+
+def make_cache_key(image_bytes, prompt, model, params=None):
+    """图片内容和请求参数的 sha256"""
+    digest = hashlib.sha256()
+    digest.update(hashlib.sha256(image_bytes).digest())
+    digest.update(json.dumps({'prompt': prompt, 'model': model, 'params': params or {}},
+                             ensure_ascii=False, sort_keys=True).encode('utf-8'))
+    return digest.hexdigest()
+
+class DescriptionCache:
+    """
+    SQLite 描述缓存，第一次使用时才打开数据库
+    
+    参数:
+        path: 数据库文件路径
+        max_bytes: 描述文本总字节数上限，超出时淘汰最久未使用的条目，降到上限的90%
+    """
+    def __init__(self, path=DEFAULT_CACHE_PATH, max_bytes=DEFAULT_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.conn = None
+        self.total_bytes = 0
+        # 还没提交的写入 {key: (描述, 字节数, 时间)} 和最近使用时间 {key: 时间}
+        self.pending = {}
+        self.touched = {}
+        self.stats = {'hits': 0, 'misses': 0, 'writes': 0, 'evicted': 0}
+    
+    def _connect(self):
+        if self.conn is not None:
+            return self.conn
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        # 多个进程可以同时读写同一个缓存
+        self.conn = sqlite3.connect(self.path, timeout=30)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS descriptions (
+                key TEXT PRIMARY KEY,
+                description TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                last_used REAL NOT NULL
+            )
+        ''')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS idx_last_used ON descriptions (last_used)')
+        self.conn.commit()
+        self.total_bytes = self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM descriptions').fetchone()[0]
+        return self.conn
+    
+    def get(self, key):
+        """返回缓存的描述，不存在时返回 None"""
+        if key in self.pending:
+            self.stats['hits'] += 1
+            return self.pending[key][0]
+        conn = self._connect()
+        row = conn.execute('SELECT description FROM descriptions WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            self.stats['misses'] += 1
+            return None
+        self.touched[key] = time.time()
+        self.stats['hits'] += 1
+        self._flush_if_full()
+        return row[0]
+    
+    def put(self, key, description):
+        """写入描述（先缓存，满 FLUSH_EVERY 条或调用 flush 时写入），空描述（请求失败）不缓存"""
+        if not description:
+            return
+        size = len(description.encode('utf-8'))
+        if key in self.pending:
+            old_size = self.pending[key][1]
+        else:
+            old = self._connect().execute('SELECT size FROM descriptions WHERE key = ?', (key,)).fetchone()
+            old_size = old[0] if old else 0
+        self.pending[key] = (description, size, time.time())
+        self.touched.pop(key, None)
+        self.total_bytes += size - old_size
+        self.stats['writes'] += 1
+        self._flush_if_full()
+    
+    def _flush_if_full(self):
+        if len(self.pending) + len(self.touched) >= FLUSH_EVERY:
+            self.flush()
+    
+    def flush(self):
+        if not self.pending and not self.touched:
+            return
+        conn = self._connect()
+        conn.executemany(
+            'INSERT OR REPLACE INTO descriptions (key, description, size, created_at, last_used) VALUES (?, ?, ?, ?, ?)',
+            [(key, description, size, now, now) for key, (description, size, now) in self.pending.items()]
+        )
+        conn.executemany('UPDATE descriptions SET last_used = ? WHERE key = ?',
+                         [(now, key) for key, now in self.touched.items()])
+        conn.commit()
+        self.pending = {}
+        self.touched = {}
+        if self.total_bytes > self.max_bytes:
+            self.evict()
+    
+    def evict(self, target_bytes=None):
+        """按最近使用时间淘汰，直到总大小不超过 target_bytes（默认 max_bytes 的90%）"""
+        self.flush()
+        conn = self._connect()
+        target_bytes = int(self.max_bytes * 0.9) if target_bytes is None else target_bytes
+        # 其他进程也可能写入，淘汰前重新统计
+        self.total_bytes = conn.execute('SELECT COALESCE(SUM(size), 0) FROM descriptions').fetchone()[0]
+        evicted = []
+        freed = 0
+        for key, size in conn.execute('SELECT key, size FROM descriptions ORDER BY last_used'):
+            if self.total_bytes - freed <= target_bytes:
+                break
+            evicted.append((key,))
+            freed += size
+        conn.executemany('DELETE FROM descriptions WHERE key = ?', evicted)
+        conn.commit()
+        self.total_bytes -= freed
+        self.stats['evicted'] += len(evicted)
+    
+    def count(self):
+        self.flush()
+        return self._connect().execute('SELECT COUNT(*) FROM descriptions').fetchone()[0]
+    
+    def report(self):
+        stats = self.stats
+        lookups = stats['hits'] + stats['misses']
+        hit_rate = stats['hits'] / lookups * 100 if lookups else 0.0
+        print(f"缓存统计: 命中 {stats['hits']} 次, 未命中 {stats['misses']} 次 (命中率 {hit_rate:.1f}%), "
+              f"写入 {stats['writes']} 条, 淘汰 {stats['evicted']} 条, "
+              f"缓存大小 {self.total_bytes / (1024 * 1024):.2f} MB")
+    
+    def close(self):
+        if self.conn is not None:
+            self.flush()
+            self.conn.close()
+            self.conn = None
+
+def main():
+    parser = argparse.ArgumentParser(description="查看或清理图片描述缓存")
+    parser.add_argument("path", nargs='?', default=DEFAULT_CACHE_PATH, help="缓存数据库路径")
+    parser.add_argument("--max-mb", type=int, default=None, help="淘汰到该大小（MB）以下")
+    args = parser.parse_args()
+    
+    cache = DescriptionCache(args.path)
+    if args.max_mb is not None:
+        cache.evict(args.max_mb * (1 << 20))
+    print(f"缓存: {args.path}, 共 {cache.count()} 条")
+    cache.report()
+    cache.close()
+
+if __name__ == "__main__":
+    main()
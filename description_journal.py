@@ -0,0 +1,80 @@
+# 每本书的图片描述文件 auto/<书名>_figures_description.json 及其增量日志
+# 描述完成一张就追加到 .jsonl 日志，全部完成后合并成最终的JSON；
+# figure_descriper.py、figure_pipeline.py 和 batch_result_ingest.py 都通过这里读写描述文件
+
+import json
+import os
+from pathlib import Path
+from typing import Dict
+
+class DescriptionJournal:
+    """
+    每完成一张图片就追加一行 {"name": ..., "description": ...} 到 JSONL 日志
+    
+    中途崩溃、OOM 或 Ctrl-C 时已经付费拿到的描述不会丢失，重新运行时先回放日志
+    """
+    def __init__(self, journal_path):
+        self.journal_path = Path(journal_path)
+        self.file = None
+    
+    def replay(self) -> Dict[str, str]:
+        """读取日志中已完成的描述，最后一行写了一半时忽略"""
+        descriptions = {}
+        if not self.journal_path.exists():
+            return descriptions
+        with open(self.journal_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                descriptions[record['name']] = record['description']
+        return descriptions
+    
+    def append(self, name: str, description: str):
+        if self.file is None:
+            self.file = open(self.journal_path, 'a', encoding='utf-8')
+            # 上次崩溃时最后一行可能没写完，先换行，避免和新记录连在一起
+            if self.file.tell() > 0:
+                with open(self.journal_path, 'rb') as f:
+                    f.seek(-1, os.SEEK_END)
+                    if f.read(1) != b'\n':
+                        self.file.write('\n')
+        self.file.write(json.dumps({'name': name, 'description': description}, ensure_ascii=False) + '\n')
+        self.file.flush()
+    
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+    
+    def compact(self, output_file, descriptions: Dict[str, str]):
+        """把全部描述写成最终的JSON（先写临时文件再替换），然后删除日志"""
+        self.close()
+        output_file = Path(output_file)
+        tmp_file = output_file.with_name(output_file.name + '.tmp')
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump(descriptions, f, ensure_ascii=False, indent=2)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, output_file)
+        if self.journal_path.exists():
+            self.journal_path.unlink()
+
+def journal_path_for(output_file) -> Path:
+    """<书名>_figures_description.json 的日志为 <书名>_figures_description.jsonl"""
+    return Path(output_file).with_suffix('.jsonl')
+
+def load_descriptions(output_file, journal: DescriptionJournal) -> Dict[str, str]:
+    """读取已保存的JSON，再回放日志中之后完成的描述"""
+    output_file = Path(output_file)
+    descriptions = {}
+    if output_file.exists():
+        with open(output_file, 'r', encoding='utf-8') as f:
+            descriptions = json.load(f)
+            print(f"找到已存在的处理结果，已处理{len(descriptions)}张图片")
+    replayed = journal.replay()
+    if replayed:
+        print(f"从日志中恢复了{len(replayed)}张图片的描述")
+        descriptions.update(replayed)
+    return descriptions
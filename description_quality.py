@@ -0,0 +1,79 @@
+# 图片描述的质量检查：描述协程拿到结果后立即检查，不合格的马上重新请求，不再事后用 short_figure_description_detector.py 扫全部文件
+# 重试次数用完仍不合格的图片不写入描述文件，记录到 auto/<书名>_figures_rejects.jsonl，图片本身保留
+#   - empty：请求出错返回的空描述，下次运行时重新处理
+#   - unreadable：图片文件读取失败（见 figure_descriper.py），下次运行时重新处理
+#   - too_short / refusal：模型给出的描述过短或拒绝回答，视为永久不合格，下次运行时跳过（删除 rejects 文件即可重新处理）
+
+import json
+import re
+import time
+from pathlib import Path
+from typing import Dict, Optional
+
+# 提示词要求100-300字
+MIN_DESCRIPTION_LENGTH = 100
+
+# 描述不合格时最多重新请求的次数
+QUALITY_RETRIES = 2
+
+# 模型拒绝回答或无法识别图片时的常见说法，只检查开头部分，避免误伤正文中的"无法"等词
+REFUSAL_PATTERNS = re.compile(
+    r"(抱歉|对不起|很遗憾|我无法|无法(识别|查看|看到|处理|描述|提供)|不能(识别|查看|描述)|图片(无法|不清晰|模糊)|"
+    r"I'?m sorry|I am sorry|I can(no|')t|I am unable|I'm unable|unable to (view|see|process|describe))",
+    re.IGNORECASE
+)
+REFUSAL_CHECK_CHARS = 60
+
+PERMANENT_REASONS = {'too_short', 'refusal'}
+
+def check_description(description: Optional[str], min_length: int = MIN_DESCRIPTION_LENGTH) -> Optional[str]:
+    """合格时返回 None，否则返回原因：empty / refusal / too_short"""
+    text = (description or '').strip()
+    if not text:
+        return 'empty'
+    if REFUSAL_PATTERNS.search(text[:REFUSAL_CHECK_CHARS]):
+        return 'refusal'
+    if len(text) < min_length:
+        return 'too_short'
+    return None
+
+def rejects_path_for(output_file) -> Path:
+    """<书名>_figures_description.json 对应的 <书名>_figures_rejects.jsonl"""
+    output_file = Path(output_file)
+    return output_file.with_name(output_file.name.replace('_figures_description.json', '_figures_rejects.jsonl'))
+
+class RejectManifest:
+    """追加写入的不合格描述记录，每行一个 {"name", "reason", "attempts", "length", "description", "time"}"""
+    def __init__(self, path):
+        self.path = Path(path)
+        self.records = self._load()
+    
+    def _load(self) -> Dict[str, dict]:
+        records = {}
+        if not self.path.exists():
+            return records
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                records[record['name']] = record
+        return records
+    
+    def permanent(self):
+        """永久不合格、下次运行时跳过的图片文件名"""
+        return {name for name, record in self.records.items() if record['reason'] in PERMANENT_REASONS}
+    
+    def add(self, name: str, description: str, reason: str, attempts: int):
+        record = {
+            'name': name,
+            'reason': reason,
+            'attempts': attempts,
+            'length': len(description or ''),
+            'description': description or '',
+            'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+        }
+        self.records[name] = record
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(record, ensure_ascii=False) + '\n')
@@ -0,0 +1,302 @@
+# 全部书籍图片的目录（SQLite）：每张截图一行，记录所在页、bbox、文件哈希、描述、描述长度、状态和上传状态
+# 截图（figure_crop.py / figure_pipeline.py）和描述（figure_descriper.py / batch_result_ingest.py）时增量写入，
+# 查找短描述、未描述的图片、需要上传的书都变成带索引的查询，不再遍历几十万个文件、读取每个JSON
+#
+# 使用示例：
+#     # 第一次使用时从已有的文件补全目录（只需要运行一次）
+#     python figure_catalog.py scan /root/rawdata/gcs/textbook_ocr
+#     # 描述不足100字的图片
+#     python figure_catalog.py short --min-length 100
+#     # 还没有描述的图片 / 描述更新后还没有上传的书
+#     python figure_catalog.py undescribed
+#     python figure_catalog.py not-uploaded
+
+import argparse
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from pathlib import Path
+from description_quality import PERMANENT_REASONS, RejectManifest, rejects_path_for
+
+DEFAULT_CATALOG_PATH = '/root/rawdata/figure_catalog.sqlite'
+
+# cropped：已截图，还没有描述；described：已有合格的描述；rejected：描述不合格（见 description_quality.py）
+STATUSES = ('cropped', 'described', 'rejected')
+
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.webp'}
+
+# 需要（重新）描述的图片：还没有描述，或者因为请求出错（不是永久不合格）被拒绝
+UNDESCRIBED_CONDITION = "(status = 'cropped' OR (status = 'rejected' AND reject_reason NOT IN ({})))".format(
+    ', '.join(f"'{reason}'" for reason in sorted(PERMANENT_REASONS))
+)
+
+# 描述结果先缓存在内存中，凑够这么多条再写入一次
+FLUSH_EVERY = 200
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+class FigureCatalog:
+    """
+    图片目录，第一次使用时才打开数据库
+    
+    参数:
+        path: 数据库文件路径
+    """
+    def __init__(self, path=DEFAULT_CATALOG_PATH):
+        self.path = path
+        self.conn = None
+        self.pending = []
+    
+    def _connect(self):
+        if self.conn is not None:
+            return self.conn
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        # 截图、描述和上传脚本可以同时读写
+        self.conn = sqlite3.connect(self.path, timeout=30)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.executescript('''
+            CREATE TABLE IF NOT EXISTS books (
+                book TEXT PRIMARY KEY,
+                auto_dir TEXT NOT NULL,
+                uploaded_at REAL
+            );
+            CREATE TABLE IF NOT EXISTS figures (
+                book TEXT NOT NULL,
+                name TEXT NOT NULL,
+                page_idx INTEGER,
+                kind TEXT,
+                bbox TEXT,
+                path TEXT,
+                file_hash TEXT,
+                file_bytes INTEGER,
+                description TEXT,
+                description_length INTEGER,
+                status TEXT NOT NULL DEFAULT 'cropped',
+                reject_reason TEXT,
+                cropped_at REAL,
+                described_at REAL,
+                PRIMARY KEY (book, name)
+            );
+            CREATE INDEX IF NOT EXISTS idx_figures_status ON figures (status, book);
+            CREATE INDEX IF NOT EXISTS idx_figures_length ON figures (description_length);
+            CREATE INDEX IF NOT EXISTS idx_figures_hash ON figures (file_hash);
+        ''')
+        self.conn.commit()
+        return self.conn
+    
+    def add_book(self, book, auto_dir):
+        conn = self._connect()
+        conn.execute(
+            'INSERT INTO books (book, auto_dir) VALUES (?, ?) ON CONFLICT(book) DO UPDATE SET auto_dir = excluded.auto_dir',
+            (book, str(auto_dir))
+        )
+        conn.commit()
+    
+    def add_figures(self, book, figures):
+        """
+        记录截图，figures 为 [{'name', 'page_idx', 'type', 'bbox', 'path', 'sha256', 'bytes'}, ...]
+        
+        已有的描述和状态保持不变；path 为 None（截图没有保存，例如 figure_pipeline.py 不带 --save-images）时保留已有的文件信息
+        """
+        now = time.time()
+        conn = self._connect()
+        conn.executemany('''
+            INSERT INTO figures (book, name, page_idx, kind, bbox, path, file_hash, file_bytes, cropped_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(book, name) DO UPDATE SET
+                page_idx = excluded.page_idx, kind = excluded.kind, bbox = excluded.bbox,
+                path = COALESCE(excluded.path, figures.path),
+                file_hash = CASE WHEN excluded.path IS NULL THEN figures.file_hash ELSE excluded.file_hash END,
+                file_bytes = CASE WHEN excluded.path IS NULL THEN figures.file_bytes ELSE excluded.file_bytes END,
+                cropped_at = excluded.cropped_at
+        ''', [
+            (book, figure['name'], figure.get('page_idx'), figure.get('type'),
+             json.dumps(figure['bbox']) if figure.get('bbox') is not None else None,
+             figure.get('path'), figure.get('sha256'), figure.get('bytes'), now)
+            for figure in figures
+        ])
+        conn.commit()
+    
+    def record_description(self, book, name, description):
+        """记录合格的描述（先缓存，满 FLUSH_EVERY 条或调用 flush 时写入）"""
+        self.pending.append((book, name, description, len(description), 'described', None, time.time()))
+        if len(self.pending) >= FLUSH_EVERY:
+            self.flush()
+    
+    def record_reject(self, book, name, description, reason):
+        """记录重试后仍不合格的描述"""
+        description = description or ''
+        self.pending.append((book, name, description, len(description), 'rejected', reason, time.time()))
+        if len(self.pending) >= FLUSH_EVERY:
+            self.flush()
+    
+    def flush(self):
+        if not self.pending:
+            return
+        conn = self._connect()
+        conn.executemany('''
+            INSERT INTO figures (book, name, description, description_length, status, reject_reason, described_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(book, name) DO UPDATE SET
+                description = excluded.description, description_length = excluded.description_length,
+                status = excluded.status, reject_reason = excluded.reject_reason, described_at = excluded.described_at
+        ''', self.pending)
+        conn.commit()
+        self.pending = []
+    
+    def clear_descriptions(self, book, names):
+        """描述被删除（例如 short_figure_description_detector.py --remove-entries）后恢复为未描述"""
+        conn = self._connect()
+        conn.executemany('''
+            UPDATE figures SET description = NULL, description_length = NULL, status = 'cropped',
+                reject_reason = NULL, described_at = NULL
+            WHERE book = ? AND name = ?
+        ''', [(book, name) for name in names])
+        conn.commit()
+    
+    def mark_uploaded(self, book, uploaded_at=None):
+        conn = self._connect()
+        conn.execute('UPDATE books SET uploaded_at = ? WHERE book = ?', (uploaded_at or time.time(), book))
+        conn.commit()
+    
+    def book_dirs(self, books=None):
+        """返回 {书名: auto目录}"""
+        rows = self._connect().execute('SELECT book, auto_dir FROM books ORDER BY book').fetchall()
+        return {book: auto_dir for book, auto_dir in rows if books is None or book in books}
+    
+    def short_descriptions(self, min_length, book=None):
+        """描述不足 min_length 字的图片，返回 [(书名, 文件名, 描述), ...]"""
+        self.flush()
+        query = 'SELECT book, name, description FROM figures WHERE status = ? AND description_length < ?'
+        params = ['described', min_length]
+        if book is not None:
+            query += ' AND book = ?'
+            params.append(book)
+        return self._connect().execute(query + ' ORDER BY book, name', params).fetchall()
+    
+    def undescribed(self, book=None):
+        """已截图但还没有描述（或请求出错需要重试）的图片，返回 [(书名, 文件名, 路径), ...]"""
+        self.flush()
+        query = f'SELECT book, name, path FROM figures WHERE {UNDESCRIBED_CONDITION}'
+        params = []
+        if book is not None:
+            query += ' AND book = ?'
+            params.append(book)
+        return self._connect().execute(query + ' ORDER BY book, name', params).fetchall()
+    
+    def books_with_undescribed(self):
+        self.flush()
+        rows = self._connect().execute(
+            f'SELECT DISTINCT book FROM figures WHERE {UNDESCRIBED_CONDITION} ORDER BY book'
+        ).fetchall()
+        return [book for book, in rows]
+    
+    def not_uploaded(self):
+        """上次上传之后有新描述的书，返回 [(书名, auto目录, 新描述数), ...]"""
+        self.flush()
+        return self._connect().execute('''
+            SELECT b.book, b.auto_dir, COUNT(*)
+            FROM books b JOIN figures f ON f.book = b.book
+            WHERE f.status = 'described' AND (b.uploaded_at IS NULL OR f.described_at > b.uploaded_at)
+            GROUP BY b.book ORDER BY b.book
+        ''').fetchall()
+    
+    def stats(self):
+        """返回 {状态: 图片数}"""
+        self.flush()
+        rows = self._connect().execute('SELECT status, COUNT(*) FROM figures GROUP BY status').fetchall()
+        return dict(rows)
+    
+    def scan_book(self, book, auto_dir, compute_hash=False):
+        """从已有的 figures 目录、描述文件和 rejects 文件补全一本书的记录"""
+        auto_dir = Path(auto_dir)
+        self.add_book(book, auto_dir)
+        
+        figures = []
+        figure_dir = auto_dir / 'figures'
+        if figure_dir.exists():
+            with os.scandir(figure_dir) as entries:
+                for entry in entries:
+                    if Path(entry.name).suffix.lower() not in IMAGE_EXTENSIONS:
+                        continue
+                    figures.append({
+                        'name': entry.name,
+                        'path': entry.path,
+                        'bytes': entry.stat().st_size,
+                        'sha256': file_sha256(entry.path) if compute_hash else None,
+                    })
+        self.add_figures(book, figures)
+        
+        output_file = auto_dir / f"{book}_figures_description.json"
+        if output_file.exists():
+            with open(output_file, 'r', encoding='utf-8') as f:
+                for name, description in json.load(f).items():
+                    self.record_description(book, name, description)
+        for name, record in RejectManifest(rejects_path_for(output_file)).records.items():
+            self.record_reject(book, name, record['description'], record['reason'])
+        self.flush()
+        return len(figures)
+    
+    def close(self):
+        if self.conn is not None:
+            self.flush()
+            self.conn.close()
+            self.conn = None
+
+def main():
+    parser = argparse.ArgumentParser(description="查询图片目录")
+    parser.add_argument("--db", default=DEFAULT_CATALOG_PATH, help="目录数据库路径")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    
+    scan_parser = subparsers.add_parser("scan", help="从已有的文件补全目录")
+    scan_parser.add_argument("base_dir", help="textbook_ocr 目录")
+    scan_parser.add_argument("--hash", action="store_true", help="同时计算图片文件的 sha256")
+    
+    short_parser = subparsers.add_parser("short", help="描述过短的图片")
+    short_parser.add_argument("--min-length", type=int, default=100, help="描述的最短字数")
+    short_parser.add_argument("--book", default=None, help="只查询这本书")
+    
+    undescribed_parser = subparsers.add_parser("undescribed", help="还没有描述的图片")
+    undescribed_parser.add_argument("--book", default=None, help="只查询这本书")
+    
+    subparsers.add_parser("not-uploaded", help="描述更新后还没有上传的书")
+    subparsers.add_parser("stats", help="各状态的图片数")
+    args = parser.parse_args()
+    
+    catalog = FigureCatalog(args.db)
+    if args.command == "scan":
+        base_dir = Path(args.base_dir)
+        for folder in sorted(base_dir.iterdir()):
+            if folder.is_dir() and (folder / 'auto').exists():
+                count = catalog.scan_book(folder.name, folder / 'auto', compute_hash=args.hash)
+                print(f"{folder.name}: {count} 张图片")
+    elif args.command == "short":
+        rows = catalog.short_descriptions(args.min_length, args.book)
+        for book, name, description in rows:
+            print(f"{book}\t{name}\t{len(description)}\t{description}")
+        print(f"共 {len(rows)} 张图片的描述不足 {args.min_length} 字")
+    elif args.command == "undescribed":
+        rows = catalog.undescribed(args.book)
+        for book, name, path in rows:
+            print(f"{book}\t{name}\t{path or ''}")
+        print(f"共 {len(rows)} 张图片还没有描述")
+    elif args.command == "not-uploaded":
+        rows = catalog.not_uploaded()
+        for book, auto_dir, count in rows:
+            print(f"{book}\t{count} 条新描述\t{auto_dir}")
+        print(f"共 {len(rows)} 本书需要上传")
+    
+    stats = catalog.stats()
+    print("目录统计: " + ", ".join(f"{status} {stats.get(status, 0)}" for status in STATUSES))
+    catalog.close()
+
+if __name__ == "__main__":
+    main()
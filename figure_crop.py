@@ -6,7 +6,23 @@ import os
 from pathlib import Path
 import hashlib
 import logging
+import argparse
+import threading
+import time
+import multiprocessing
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from datetime import datetime
+from PIL import Image
+from image_encoder import FORMAT_EXTENSIONS, FORMAT_MIME_TYPES, EncodeStage, EncodeStats, ImageEncoder, pixmap_to_image
+from openai_image_tokenizer import count_high_detail_tiles, effective_high_detail_size
+from layout_stream import iter_bboxes, iter_pages
+from layout_index import PageReader, load_page_index
+from layout_store import load_layout_store
+from bbox_cluster import cluster_bboxes, union_bbox
+from figure_dedup import RepeatIndex, dhash
+from image_shards import ShardWriter
+from figure_catalog import DEFAULT_CATALOG_PATH, FigureCatalog
 
 def setup_logging():
     """设置日志配置"""
@@ -25,113 +41,444 @@ def setup_logging():
     )
     return logging.getLogger(__name__)
 
+# 截图渲染模式:
+#   per_block   - 每个图表单独调用 page.get_pixmap（旧行为，同一页会被光栅化多次）
+#   displaylist - 每页只解析一次页面内容生成 fitz.DisplayList，所有截图都从它渲染
+#   page        - 每页只光栅化一次（覆盖所有图表的最小区域），再从同一块像素缓冲中裁剪
+RENDER_MODES = ('per_block', 'displaylist', 'page')
+
+# 截图分辨率模式:
+#   fixed  - 所有截图都按 dpi 渲染
+#   budget - 按视觉模型 high detail 的有效分辨率（2048px 内、最短边 768px）为每个截图选择缩放，
+#            限制在 [min_dpi, dpi] 之间，可选再用 max_tiles 限制512px方块数
+DPI_MODES = ('fixed', 'budget')
+
+# 重复图片的处理方式:
+#   skip - 重复出现的截图全部跳过
+#   link - 保留第一次出现的截图，其余在清单中链接到它
+REPEAT_ACTIONS = ('skip', 'link')
+
 class PDFElementExtractor:
-    def __init__(self, pdf_path, layout_json_path, output_dir):
+    def __init__(self, pdf_path, layout_json_path, output_dir, encoder=None, encode_workers=2,
+                 render_mode='displaylist', dpi=600, page_range=None, pixmap_semaphore=None,
+                 dpi_mode='fixed', min_dpi=150, max_tiles=None, use_layout_store=False,
+                 merge_overlaps=False, merge_iou=0.3, merge_contain=0.8, merge_gap=None,
+                 repeat_threshold=None, repeat_action='skip', repeat_distance=4, repeat_dpi=72,
+                 suppressed=None, shard_bytes=None):
         print(f"初始化PDF提取器...")
+        if render_mode not in RENDER_MODES:
+            raise ValueError(f"不支持的渲染模式: {render_mode}")
+        if dpi_mode not in DPI_MODES:
+            raise ValueError(f"不支持的分辨率模式: {dpi_mode}")
+        if repeat_action not in REPEAT_ACTIONS:
+            raise ValueError(f"不支持的重复图片处理方式: {repeat_action}")
         self.pdf_doc = fitz.open(pdf_path)
         self.layout_json_path = layout_json_path
         
         # 提取 PDF 文件名
         self.pdf_name = Path(pdf_path).stem  # 获取文件名（不带扩展名）
         
-        with open(layout_json_path, 'r', encoding='utf-8') as f:
-            self.layout_data = json.load(f)
-            
         self.output_dir = Path(output_dir)
         self.output_dir.mkdir(parents=True, exist_ok=True)
+        
+        # 编码在独立线程池中执行，渲染不等待PNG压缩
+        self.encoder = encoder or ImageEncoder()
+        self.encode_workers = encode_workers
+        self.encode_stats = EncodeStats()
+        
+        self.render_mode = render_mode
+        self.dpi = dpi
+        self.dpi_mode = dpi_mode
+        self.min_dpi = min_dpi
+        self.max_tiles = max_tiles
+        
+        # 只处理 [start, end) 范围内的页面，用于按页分片并行
+        self.page_range = page_range
+        # 限制同时存在的高分辨率像素缓冲数量（可跨进程共享）
+        self.pixmap_semaphore = pixmap_semaphore
+        # 使用列式 bbox 文件（X_middle.layout.npz），不再解析 _middle.json
+        self.use_layout_store = use_layout_store
+        
+        # 渲染前把同一页中重叠/嵌套/相邻的图表合并成一个截图
+        self.merge_overlaps = merge_overlaps
+        self.merge_iou = merge_iou
+        self.merge_contain = merge_contain
+        self.merge_gap = merge_gap
+        
+        # 全书出现次数不少于 repeat_threshold 的相似截图（图标、logo、装饰）不再按高分辨率截图
+        #   skip - 全部跳过
+        #   link - 只保留第一次出现的截图，其余记录为指向它的链接
+        # suppressed 为预先算好的 {文件名: 记录}（并行时由整本书的预扫描得到），
+        # 为 None 且设置了 repeat_threshold 时在 extract_elements 中自行扫描
+        self.repeat_threshold = repeat_threshold
+        self.repeat_action = repeat_action
+        self.repeat_distance = repeat_distance
+        self.repeat_dpi = repeat_dpi
+        self.suppressed = suppressed
+        # shard_bytes 不为 None 时截图写入输出目录下按大小切分的 tar 分片，而不是每张图片一个文件；
+        # 按页分片并行时每个页段写自己的分片，文件名前缀带上起始页
+        self.shard_writer = None
+        if shard_bytes:
+            prefix = self.pdf_name if not page_range else f"{self.pdf_name}_p{page_range[0]:05d}"
+            self.shard_writer = ShardWriter(self.output_dir, prefix, max_bytes=shard_bytes)
+        # 预扫描时缓存的 [(page_idx, crops), ...]，正式截图时不再重新读取布局
+        self._prepared_crops = None
+        
+        # 记录合并、跳过等处理结果，写入 <书名>_figures_manifest.json
+        self.manifest = {'merged': [], 'suppressed': []}
+        # 已保存的截图 [{'name', 'page_idx', 'type', 'bbox', 'path', 'sha256', 'bytes'}, ...]，写入图片目录（figure_catalog.py）
+        self.figures = []
+
+    def _iter_page_data(self):
+        """逐页返回需要处理的页面数据，按页分片时优先通过页索引只读取本分片的页面"""
+        if self.page_range:
+            try:
+                reader = PageReader(self.layout_json_path, rebuild=False)
+            except FileNotFoundError:
+                reader = None
+            if reader is not None:
+                with reader:
+                    yield from reader.iter_page_range(*self.page_range)
+                return
+        
+        # 没有索引时逐页流式读取pdf_info数组
+        for page_data in iter_pages(self.layout_json_path):
+            page_idx = int(page_data.get('page_idx', 0))
+            if self.page_range and not (self.page_range[0] <= page_idx < self.page_range[1]):
+                continue
+            yield page_data
+    
+    def _collect_page_crops(self, page_data, page_idx):
+        """收集一页中所有图片和表格的截图区域"""
+        crops = []
+        
+        # 遍历preproc_blocks
+        for block in page_data.get('preproc_blocks', []):
+            block_type = block.get('type')
+            if block_type not in ['image', 'table']:
+                continue
+            print(f"发现 {block_type}...")
+            # 遍历这个block中嵌套的所有bbox
+            valid_bboxes = []
+            for bbox in iter_bboxes(block):
+                # 添加验证确保bbox格式正确
+                if isinstance(bbox, (list, tuple)) and len(bbox) == 4:
+                    valid_bboxes.append(bbox)
+                else:
+                    print(f"警告：跳过无效的bbox格式: {bbox}")
+            
+            # 检查是否有有效的bbox
+            if not valid_bboxes:
+                print(f"警告：在{block_type}中没有找到有效的bbox")
+                continue
+            
+            max_bbox = [
+                min(b[0] for b in valid_bboxes),  # x0
+                min(b[1] for b in valid_bboxes),  # y0
+                max(b[2] for b in valid_bboxes),  # x1
+                max(b[3] for b in valid_bboxes)   # y1
+            ]
+            print(f"最大矩形的bbox: {max_bbox}")
+            
+            crops.append({
+                'type': block_type,
+                'page_num': f"page_{page_idx + 1}",
+                'bbox': max_bbox,  # 使用计算出的最大bbox
+                'index': block.get('index', 0)
+            })
+        return crops
+    
+    def _iter_page_crops(self):
+        """逐页返回 (page_idx, 截图列表)"""
+        if self.use_layout_store:
+            # 列式文件中按块向量化求最大bbox，再按页分组
+            store = load_layout_store(self.layout_json_path, rebuild=True)
+            store = store.select(page_range=self.page_range, types=('image', 'table'))
+            crops_by_page = {}
+            for page_idx, block_type, index, bbox in store.iter_blocks():
+                crops_by_page.setdefault(page_idx, []).append({
+                    'type': block_type,
+                    'page_num': f"page_{page_idx + 1}",
+                    'bbox': bbox,
+                    'index': index
+                })
+            for page_idx, crops in crops_by_page.items():
+                print(f"处理第 {page_idx} 页")
+                yield page_idx, crops
+            return
+        
+        for page_data in self._iter_page_data():
+            page_idx = int(page_data.get('page_idx', 0))
+            print(f"处理第 {page_idx} 页")
+            yield page_idx, self._collect_page_crops(page_data, page_idx)
+    
+    def _merge_page_crops(self, page_idx, crops):
+        """用空间索引把一页中重叠的截图聚成簇，每个簇只输出一个截图"""
+        clusters = cluster_bboxes(
+            [metadata['bbox'] for metadata in crops],
+            iou_threshold=self.merge_iou,
+            contain_threshold=self.merge_contain,
+            max_gap=self.merge_gap,
+        )
+        merged_crops = []
+        for members in clusters:
+            metadata = dict(crops[members[0]])
+            if len(members) > 1:
+                metadata['bbox'] = union_bbox([crops[i]['bbox'] for i in members])
+                # 只要簇里有图片就按图片命名
+                if any(crops[i]['type'] == 'image' for i in members):
+                    metadata['type'] = 'image'
+                metadata['members'] = [crops[i]['index'] for i in members]
+                self.manifest['merged'].append({
+                    'file': self._generate_filename(metadata),
+                    'page_idx': page_idx,
+                    'members': [{'type': crops[i]['type'], 'index': crops[i]['index']} for i in members],
+                    'bbox': metadata['bbox'],
+                })
+                print(f"合并 {len(members)} 个重叠的图表: {metadata['members']} -> {metadata['bbox']}")
+            merged_crops.append(metadata)
+        return merged_crops
+    
+    def _iter_prepared_crops(self):
+        """返回需要截图的 (page_idx, crops)，已合并重叠的截图；预扫描过时直接复用"""
+        if self._prepared_crops is not None:
+            yield from self._prepared_crops
+            return
+        for page_idx, crops in self._iter_page_crops():
+            # 没有图表的页面不做任何渲染
+            if not crops:
+                continue
+            if self.merge_overlaps:
+                crops = self._merge_page_crops(page_idx, crops)
+            yield page_idx, crops
+    
+    def find_repeated_crops(self):
+        """
+        按 repeat_dpi 低分辨率渲染所有截图并计算 dHash，找出重复出现的截图
+        
+        返回 {文件名: {'reason', 'count', 'hash', 'link'}}
+        """
+        self._prepared_crops = list(self._iter_prepared_crops())
+        matrix = fitz.Matrix(self.repeat_dpi / 72, self.repeat_dpi / 72)
+        index = RepeatIndex(self.repeat_distance)
+        for page_idx, crops in self._prepared_crops:
+            display_list = self.pdf_doc[page_idx].get_displaylist()
+            for metadata in crops:
+                pix = display_list.get_pixmap(matrix=matrix, clip=fitz.Rect(metadata['bbox']), alpha=False)
+                if pix.width == 0 or pix.height == 0:
+                    continue
+                index.add(dhash(pixmap_to_image(pix)), self._generate_filename(metadata))
+        
+        suppressed = {}
+        for value, files in index.groups(min_count=self.repeat_threshold):
+            kept = files[0] if self.repeat_action == 'link' else None
+            for filename in files:
+                if filename == kept:
+                    continue
+                suppressed[filename] = {
+                    'reason': 'repeated',
+                    'count': len(files),
+                    'hash': f"{value:016x}",
+                    'link': kept,
+                }
+            print(f"重复出现 {len(files)} 次的图片: {files[0]} 等")
+        print(f"预扫描完成: 共 {len(suppressed)} 个重复截图将被跳过")
+        return suppressed
+    
+    def _acquire_pixmap(self, uses=1):
+        """
+        申请一个像素缓冲配额，返回释放函数
+        
+        uses 表示由这块缓冲派生出的图片数量，全部编码完成后才真正释放配额
+        """
+        if self.pixmap_semaphore is None:
+            return lambda: None
+        self.pixmap_semaphore.acquire()
+        remaining = [uses]
+        lock = threading.Lock()
+        
+        def release():
+            with lock:
+                remaining[0] -= 1
+                if remaining[0] == 0:
+                    self.pixmap_semaphore.release()
+        return release
+    
+    def _crop_zoom(self, bbox):
+        """计算截图的缩放因子，budget 模式下不渲染API会缩掉的像素"""
+        max_zoom = self.dpi / 72
+        if self.dpi_mode == 'fixed':
+            return max_zoom
+        
+        width_pt = bbox[2] - bbox[0]
+        height_pt = bbox[3] - bbox[1]
+        if width_pt <= 0 or height_pt <= 0:
+            return max_zoom
+        
+        # 按最高DPI渲染时的尺寸，经API缩放后的有效尺寸
+        width, height = effective_high_detail_size(width_pt * max_zoom, height_pt * max_zoom)
+        zoom = width / width_pt
+        
+        # 进一步限制512px方块数
+        if self.max_tiles:
+            while zoom > 0 and count_high_detail_tiles(width_pt * zoom, height_pt * zoom) > self.max_tiles:
+                zoom *= 0.9
+        
+        return min(max(zoom, self.min_dpi / 72), max_zoom)
+    
+    def _render_crops(self, pdf_page, crops):
+        """按渲染模式生成一页所有截图，逐个返回 (metadata, PIL图片, 配额释放函数)"""
+        # 每个截图的缩放因子（fixed 模式下都是 dpi / 72，默认600 DPI）
+        for metadata in crops:
+            metadata['zoom'] = self._crop_zoom(metadata['bbox'])
+        
+        if self.render_mode == 'per_block':
+            for metadata in crops:
+                clip = fitz.Rect(metadata['bbox'])
+                matrix = fitz.Matrix(metadata['zoom'], metadata['zoom'])
+                release = self._acquire_pixmap()
+                pix = pdf_page.get_pixmap(matrix=matrix, clip=clip, alpha=False)
+                yield metadata, pixmap_to_image(pix), release
+        
+        elif self.render_mode == 'displaylist':
+            # 页面内容只解析一次，每个截图只光栅化自己的区域
+            display_list = pdf_page.get_displaylist()
+            for metadata in crops:
+                clip = fitz.Rect(metadata['bbox'])
+                matrix = fitz.Matrix(metadata['zoom'], metadata['zoom'])
+                release = self._acquire_pixmap()
+                pix = display_list.get_pixmap(matrix=matrix, clip=clip, alpha=False)
+                yield metadata, pixmap_to_image(pix), release
+                
+        else:
+            # 只光栅化覆盖所有截图的最小区域，再按像素坐标裁剪；
+            # 按本页截图中最大的缩放渲染，缩放较小的截图裁剪后再缩小
+            zoom = max(metadata['zoom'] for metadata in crops)
+            matrix = fitz.Matrix(zoom, zoom)
+            union = fitz.Rect(crops[0]['bbox'])
+            for metadata in crops[1:]:
+                union |= fitz.Rect(metadata['bbox'])
+            # 整块缓冲只占一个配额，所有裁剪结果编码完成后释放
+            release = self._acquire_pixmap(uses=len(crops))
+            pix = pdf_page.get_pixmap(matrix=matrix, clip=union, alpha=False)
+            page_image = pixmap_to_image(pix)
+            pix_x, pix_y = pix.x, pix.y
+            del pix
+            for metadata in crops:
+                irect = (fitz.Rect(metadata['bbox']) * matrix).round()
+                box = (irect.x0 - pix_x, irect.y0 - pix_y, irect.x1 - pix_x, irect.y1 - pix_y)
+                image = page_image.crop(box)
+                if metadata['zoom'] < zoom:
+                    target = (fitz.Rect(metadata['bbox']) * fitz.Matrix(metadata['zoom'], metadata['zoom'])).round()
+                    image = image.resize((max(1, target.width), max(1, target.height)), Image.LANCZOS)
+                yield metadata, image, release
 
     def extract_elements(self):
         """提取所有图片和表格"""
         print("开始提取元素...")
         
-        def extract_bboxes_recursive(data):
-            bboxes = []
+        stage = EncodeStage(self.encoder, workers=self.encode_workers)
+        
+        def collect(finished):
+            for (filename_base, record), result in finished:
+                if 'error' in result:
+                    print(f"警告：图片编码失败: {result['error']}")
+                    continue
+                self.encode_stats.record_result(result)
+                # 写入 tar 分片时路径为 "<分片>::<文件名>"，目录中的文件名要和描述文件的键一致
+                name = os.path.basename(self.encoder.output_path(filename_base, result['format']))
+                self._record_figure(record, result['path'], result['sha256'], result['bytes'], name)
+                print(f"保存图片: {result['path']}")
+        
+        try:
+            for filename_base, record, image, release in self._iter_rendered_crops():
+                # 交给编码线程保存，编码完成后释放像素配额
+                collect(stage.submit(image, str(self.output_dir / filename_base), context=(filename_base, record),
+                                     on_done=release, writer=self.shard_writer))
+                del image
+            
+            collect(stage.drain())
+        finally:
+            stage.close()
+        self.encode_stats.report()
+        return self.encode_stats
+
+    def _iter_rendered_crops(self, skip=None):
+        """
+        逐个渲染需要截图的图表，返回 (文件名前缀, 图表信息, PIL图片, 配额释放函数)
+        
+        skip 为不需要再截图的文件名前缀集合（例如已经有描述的图片）
+        """
+        if self.repeat_threshold and self.suppressed is None:
+            self.suppressed = self.find_repeated_crops()
+        
+        for page_idx, crops in self._iter_prepared_crops():
+            if self.suppressed:
+                crops = self._drop_suppressed(page_idx, crops)
+            if skip:
+                crops = [metadata for metadata in crops if self._generate_filename(metadata) not in skip]
+            if not crops:
+                continue
             
-            # 基本情况:如果是非列表或字典类型,直接返回空列表
-            if not isinstance(data, (list, dict)):
-                return []
-                
-            # 如果是列表,递归处理每个元素
-            if isinstance(data, list):
-                for item in data:
-                    bboxes.extend(extract_bboxes_recursive(item))
-                    
-            # 如果是字典
-            if isinstance(data, dict):
-                if 'bbox' in data:
-                    bboxes.append(data['bbox'])
-                    
-                # 递归处理字典的所有值
-                for value in data.values():
-                    bboxes.extend(extract_bboxes_recursive(value))
-                    
-            return bboxes
-
-        # 获取pdf_info数组
-        pdf_info = self.layout_data.get('pdf_info', [])
-        
-        for page_data in pdf_info:
-            page_idx = int(page_data.get('page_idx', 0))
             pdf_page = self.pdf_doc[page_idx]
-            print(f"处理第 {page_idx} 页")
+            for metadata, image, release in self._render_crops(pdf_page, crops):
+                record = {'page_idx': page_idx, 'type': metadata['type'], 'bbox': list(metadata['bbox'])}
+                yield self._generate_filename(metadata), record, image, release
+    
+    def iter_encoded_crops(self, skip=None, save_images=False):
+        """
+        在内存中渲染并编码截图，逐个返回 {'name', 'path', 'format', 'mime_type', 'data'}
+        
+        供截图后直接描述的流水线使用，save_images 为 True 时同时把图片写入输出目录
+        """
+        for filename_base, record, image, release in self._iter_rendered_crops(skip):
+            try:
+                start_time = time.perf_counter()
+                fmt, data = self.encoder.encode(image)
+                self.encode_stats.record(fmt, len(data), time.perf_counter() - start_time)
+            finally:
+                release()
+            del image
             
-            all_bboxes = []
-
-            # 遍历preproc_blocks
-            for block in page_data.get('preproc_blocks', []):
-                block_type = block.get('type')
-                if block_type in ['image', 'table']:
-                    print(f"发现 {block_type}...")
-                    # 对这个block开始递归提取bbox
-                    extracted_bboxes = extract_bboxes_recursive(block)
-                    
-                    # 添加验证确保bbox格式正确
-                    valid_bboxes = []
-                    for bbox in extracted_bboxes:
-                        if isinstance(bbox, (list, tuple)) and len(bbox) == 4:
-                            valid_bboxes.append(bbox)
-                        else:
-                            print(f"警告：跳过无效的bbox格式: {bbox}")
-                    
-                    all_bboxes.extend(valid_bboxes)
-                    
-                    # 检查是否有有效的bbox
-                    if valid_bboxes:
-                        max_bbox = [
-                            min(b[0] for b in valid_bboxes),  # x0
-                            min(b[1] for b in valid_bboxes),  # y0
-                            max(b[2] for b in valid_bboxes),  # x1
-                            max(b[3] for b in valid_bboxes)   # y1
-                        ]
-                        print(f"最大矩形的bbox: {max_bbox}")
-                        
-                        metadata = {
-                            'type': block_type,
-                            'page_num': f"page_{page_idx + 1}",
-                            'bbox': max_bbox,  # 使用计算出的最大bbox
-                            'index': block.get('index', 0)
-                        }
-                        
-                        # 生成截图
-                        clip = fitz.Rect(max_bbox)  # 使用最大bbox进行截图
-                        # 设置缩放因子以实现600 DPI
-                        zoom_x = 600 / 72  # 水平缩放因子
-                        zoom_y = 600 / 72  # 垂直缩放因子
-                        matrix = fitz.Matrix(zoom_x, zoom_y)  # 创建矩阵
-                        pix = pdf_page.get_pixmap(matrix=matrix, clip=clip, alpha=False)  # 使用矩阵生成图片
-                        
-                        # 生成文件名并保存
-                        filename_base = self._generate_filename(metadata)
-                        image_path = self.output_dir / f"{filename_base}.png"
-                        pix.save(str(image_path))
-                        print(f"保存图片: {image_path}")
-                    else:
-                        print(f"警告：在{block_type}中没有找到有效的bbox")
-                        continue
-
+            output_path = self.encoder.output_path(str(self.output_dir / filename_base), fmt)
+            name = os.path.basename(output_path)
+            if save_images and self.shard_writer is not None:
+                output_path = self.shard_writer.write(name, data)
+            elif save_images:
+                with open(output_path, 'wb') as f:
+                    f.write(data)
+            self._record_figure(record, output_path if save_images else None,
+                                hashlib.sha256(data).hexdigest(), len(data), name=name)
+            yield {
+                'name': name,
+                'path': output_path,
+                'format': fmt,
+                'mime_type': FORMAT_MIME_TYPES[fmt],
+                'data': data,
+            }
+    
+    def _record_figure(self, record, path, sha256, num_bytes, name):
+        self.figures.append(dict(record, name=name, path=path,
+                                 sha256=sha256, bytes=num_bytes))
+    
+    def _drop_suppressed(self, page_idx, crops):
+        """去掉预扫描判定为重复的截图，并记录到清单"""
+        kept = []
+        for metadata in crops:
+            filename = self._generate_filename(metadata)
+            record = self.suppressed.get(filename)
+            if record is None:
+                kept.append(metadata)
+                continue
+            self.manifest['suppressed'].append({'file': filename, 'page_idx': page_idx, **record})
+            print(f"跳过重复图片: {filename}")
+        return kept
+    
     def close(self):
-        """关闭PDF文档"""
+        """关闭PDF文档，写完最后一个图片分片"""
         self.pdf_doc.close()
+        if self.shard_writer is not None:
+            self.shard_writer.close()
 
     def _generate_filename(self, metadata):
         """生成唯一的文件名"""
@@ -139,13 +486,9 @@ class PDFElementExtractor:
         filename = f"{self.pdf_name}_{metadata['page_num']}_{type_str}_{metadata['index']}"
         return filename
 
-def main():
-    # 设置日志
-    logger = setup_logging()
-    logger.info("开始处理PDF文件提取任务")
-    
-    # 基础路径
-    base_dir = "/root/rawdata/gcs/textbook_ocr"
+def find_books(base_dir, logger):
+    """查找 textbook_ocr 下所有可以处理的书，返回 [(书名, pdf路径, json路径, 输出目录), ...]"""
+    books = []
     
     # 遍历textbook_ocr下的所有子文件夹
     for subdir in os.listdir(base_dir):
@@ -167,24 +510,223 @@ def main():
         if not os.path.exists(pdf_path) or not os.path.exists(layout_json_path):
             logger.warning(f"跳过 {subdir}: PDF或JSON文件不存在")
             continue
-            
-        logger.info(f"处理文件夹: {subdir}")
-        logger.info(f"PDF路径: {pdf_path}")
-        logger.info(f"JSON路径: {layout_json_path}")
-        logger.info(f"输出目录: {output_dir}")
         
-        # 创建输出目录
-        os.makedirs(output_dir, exist_ok=True)
-        
-        # 创建提取器并处理
-        extractor = PDFElementExtractor(pdf_path, layout_json_path, output_dir)
+        books.append((subdir, pdf_path, layout_json_path, output_dir))
+    return books
+
+# 工作进程内共享的像素缓冲配额
+_pixmap_semaphore = None
+
+def _init_worker(pixmap_semaphore):
+    global _pixmap_semaphore
+    _pixmap_semaphore = pixmap_semaphore
+
+def ensure_page_index(layout_json_path):
+    """在工作进程中为 _middle.json 建立（或复用）页偏移索引"""
+    load_page_index(layout_json_path, rebuild=True)
+    return layout_json_path
+
+def ensure_layout_store(layout_json_path):
+    """在工作进程中生成（或复用）列式 bbox 文件"""
+    load_layout_store(layout_json_path, rebuild=True)
+    return layout_json_path
+
+def extract_book_shard(task):
+    """在工作进程中处理一本书的一段页面"""
+    subdir, pdf_path, layout_json_path, output_dir, page_range, options = task
+    extractor = PDFElementExtractor(
+        pdf_path, layout_json_path, output_dir,
+        page_range=page_range,
+        pixmap_semaphore=_pixmap_semaphore,
+        **options
+    )
+    try:
+        stats = extractor.extract_elements()
+    finally:
+        extractor.close()
+    return {'by_format': stats.by_format, 'manifest': extractor.manifest, 'figures': extractor.figures}
+
+def find_book_repeats(task):
+    """在工作进程中对整本书做低分辨率预扫描，返回重复截图 {文件名: 记录}"""
+    subdir, pdf_path, layout_json_path, output_dir, _, options = task
+    extractor = PDFElementExtractor(pdf_path, layout_json_path, output_dir, **options)
+    try:
+        return extractor.find_repeated_crops()
+    finally:
+        extractor.close()
+
+def write_book_manifest(output_dir, subdir, manifest):
+    """把一本书所有分片的处理记录写入 auto/<书名>_figures_manifest.json"""
+    if not any(manifest.values()):
+        return None
+    for entries in manifest.values():
+        entries.sort(key=lambda entry: (entry['page_idx'], entry['file']))
+    manifest_path = os.path.join(os.path.dirname(output_dir), f"{subdir}_figures_manifest.json")
+    with open(manifest_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    return manifest_path
+
+def run_parallel_extraction(books, logger, max_workers=None, pages_per_shard=200,
+                            max_pixmaps=None, catalog=None, **options):
+    """
+    用进程池按 (书, 页段) 并行提取所有书的图表
+    
+    参数:
+        books: find_books 的返回值
+        max_workers: 进程数，默认等于CPU核数
+        pages_per_shard: 每个分片的页数
+        max_pixmaps: 所有进程合计同时存在的高分辨率像素缓冲上限，None 表示不限制
+        catalog: FigureCatalog，不为 None 时每个分片完成后把截图写入图片目录
+        options: 传给 PDFElementExtractor 的其他参数（encoder、render_mode、dpi 等）
+    """
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    
+    # 生成分片任务，打不开的PDF记为失败，不影响其他书
+    tasks = []
+    failed_books = set()
+    book_pages = {}
+    for subdir, pdf_path, layout_json_path, output_dir in books:
         try:
-            extractor.extract_elements()
-            logger.info(f"成功处理完成: {subdir}")
+            with fitz.open(pdf_path) as pdf:
+                total_pages = pdf.page_count
         except Exception as e:
-            logger.error(f"处理 {subdir} 时发生错误: {str(e)}", exc_info=True)
-        finally:
-            extractor.close()
+            failed_books.add(subdir)
+            logger.error(f"处理 {subdir} 时发生错误: {str(e)}")
+            continue
+        book_pages[subdir] = total_pages
+        os.makedirs(output_dir, exist_ok=True)
+        for start in range(0, total_pages, pages_per_shard):
+            page_range = (start, min(start + pages_per_shard, total_pages))
+            tasks.append((subdir, pdf_path, layout_json_path, output_dir, page_range, options))
+    books = [book for book in books if book[0] in book_pages]
+    # 最大分片优先，页数相同时大书优先，避免大书的尾巴拖到最后
+    tasks.sort(key=lambda task: (task[4][1] - task[4][0], book_pages[task[0]]), reverse=True)
+    
+    # 被拆成多个分片的书先建立页索引，各分片只读取自己的页面，不用每个分片都解析整个 _middle.json
+    shard_counts = Counter(task[2] for task in tasks)
+    sharded_jsons = [path for path, count in shard_counts.items() if count > 1]
+    logger.info(f"共 {len(books)} 本书，拆分为 {len(tasks)} 个分片，进程数: {max_workers}，"
+                f"像素缓冲上限: {max_pixmaps or '不限制'}")
+    
+    remaining = {}
+    for task in tasks:
+        remaining[task[0]] = remaining.get(task[0], 0) + 1
+    total_stats = EncodeStats()
+    book_manifests = {}
+    
+    pixmap_semaphore = multiprocessing.BoundedSemaphore(max_pixmaps) if max_pixmaps else None
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker,
+                             initargs=(pixmap_semaphore,)) as executor:
+        if options.get('use_layout_store'):
+            # 使用列式文件时每本书只需要转换一次，不再需要页索引
+            for layout_json_path in executor.map(ensure_layout_store, list(shard_counts)):
+                logger.info(f"列式文件已就绪: {layout_json_path}")
+        else:
+            for layout_json_path in executor.map(ensure_page_index, sharded_jsons):
+                logger.info(f"页索引已就绪: {layout_json_path}")
+        
+        if options.get('repeat_threshold'):
+            # 重复次数要按整本书统计，先对每本书做一次低分辨率预扫描，再把结果分发给各分片
+            book_tasks = [(subdir, pdf_path, layout_json_path, output_dir, None, options)
+                          for subdir, pdf_path, layout_json_path, output_dir in books]
+            suppressed = {}
+            for book_task, book_suppressed in zip(book_tasks, executor.map(find_book_repeats, book_tasks)):
+                suppressed[book_task[0]] = book_suppressed
+                logger.info(f"预扫描完成: {book_task[0]}，跳过 {len(book_suppressed)} 个重复截图")
+            tasks = [task[:5] + (dict(task[5], suppressed=suppressed[task[0]]),) for task in tasks]
+        
+        future_to_task = {executor.submit(extract_book_shard, task): task for task in tasks}
+        for future in as_completed(future_to_task):
+            subdir, _, _, output_dir, page_range, _ = future_to_task[future]
+            try:
+                result = future.result()
+                total_stats.merge(result['by_format'])
+                for key, entries in result['manifest'].items():
+                    book_manifests.setdefault(subdir, {}).setdefault(key, []).extend(entries)
+                if catalog is not None:
+                    # 截图只在工作进程中生成，目录由主进程统一写入
+                    catalog.add_book(subdir, os.path.dirname(output_dir))
+                    catalog.add_figures(subdir, result['figures'])
+            except Exception as e:
+                failed_books.add(subdir)
+                logger.error(f"处理 {subdir} 第 {page_range[0]}-{page_range[1]} 页时发生错误: {str(e)}")
+            
+            remaining[subdir] -= 1
+            if remaining[subdir] == 0:
+                if subdir in failed_books:
+                    logger.error(f"处理失败: {subdir}")
+                else:
+                    logger.info(f"成功处理完成: {subdir}")
+                manifest_path = write_book_manifest(output_dir, subdir, book_manifests.pop(subdir, {}))
+                if manifest_path:
+                    logger.info(f"处理记录已保存: {manifest_path}")
+    
+    total_stats.report()
+    return failed_books
+
+def main():
+    parser = argparse.ArgumentParser(description="从PDF中并行提取图片和表格")
+    parser.add_argument("--base-dir", default="/root/rawdata/gcs/textbook_ocr", help="textbook_ocr 目录")
+    parser.add_argument("--workers", type=int, default=None, help="进程数，默认等于CPU核数")
+    parser.add_argument("--pages-per-shard", type=int, default=200, help="每个分片的页数")
+    parser.add_argument("--max-pixmaps", type=int, default=None,
+                        help="同时存在的高分辨率像素缓冲上限（600 DPI 整页约100MB）")
+    parser.add_argument("--render-mode", choices=RENDER_MODES, default="displaylist", help="截图渲染模式")
+    parser.add_argument("--format", choices=sorted(FORMAT_EXTENSIONS), default="png", help="输出图片格式")
+    parser.add_argument("--dpi-mode", choices=DPI_MODES, default="fixed",
+                        help="截图分辨率模式：fixed 按 --max-dpi 渲染（原来的行为），budget 按模型实际使用的尺寸选择较低的DPI")
+    parser.add_argument("--min-dpi", type=int, default=150, help="budget 模式下的最低DPI")
+    parser.add_argument("--max-dpi", type=int, default=600, help="最高DPI（fixed 模式下即渲染DPI）")
+    parser.add_argument("--max-tiles", type=int, default=None, help="budget 模式下每个截图最多占用的512px方块数")
+    parser.add_argument("--merge-overlaps", action="store_true", help="渲染前合并同一页中重叠/嵌套的图表")
+    parser.add_argument("--merge-iou", type=float, default=0.3, help="IoU 不小于该值的图表合并")
+    parser.add_argument("--merge-contain", type=float, default=0.8, help="交集占较小框面积比例不小于该值的图表合并")
+    parser.add_argument("--merge-gap", type=float, default=None, help="间距不超过该值（pt）的相邻图表也合并")
+    parser.add_argument("--repeat-threshold", type=int, default=None,
+                        help="全书出现次数不少于该值的相似图片（图标、logo等）不再截图，默认不过滤")
+    parser.add_argument("--repeat-action", choices=REPEAT_ACTIONS, default="skip", help="重复图片的处理方式")
+    parser.add_argument("--repeat-distance", type=int, default=4, help="dHash 汉明距离不超过该值视为相同图片")
+    parser.add_argument("--repeat-dpi", type=int, default=72, help="预扫描时的渲染DPI")
+    parser.add_argument("--shard-mb", type=int, default=None,
+                        help="把截图写入每个约该大小（MB）的 tar 分片，默认每张图片一个文件")
+    parser.add_argument("--layout-store", action="store_true",
+                        help="使用列式 bbox 文件（首次运行时自动从 _middle.json 生成）")
+    parser.add_argument("--catalog", default=DEFAULT_CATALOG_PATH, help="图片目录数据库")
+    parser.add_argument("--no-catalog", action="store_true", help="不写入图片目录")
+    args = parser.parse_args()
+    
+    # 设置日志
+    logger = setup_logging()
+    logger.info("开始处理PDF文件提取任务")
+    
+    books = find_books(args.base_dir, logger)
+    catalog = None if args.no_catalog else FigureCatalog(args.catalog)
+    run_parallel_extraction(
+        books, logger,
+        max_workers=args.workers,
+        catalog=catalog,
+        pages_per_shard=args.pages_per_shard,
+        max_pixmaps=args.max_pixmaps,
+        render_mode=args.render_mode,
+        encoder=ImageEncoder(args.format),
+        dpi=args.max_dpi,
+        dpi_mode=args.dpi_mode,
+        min_dpi=args.min_dpi,
+        max_tiles=args.max_tiles,
+        use_layout_store=args.layout_store,
+        merge_overlaps=args.merge_overlaps,
+        merge_iou=args.merge_iou,
+        merge_contain=args.merge_contain,
+        merge_gap=args.merge_gap,
+        repeat_threshold=args.repeat_threshold,
+        repeat_action=args.repeat_action,
+        repeat_distance=args.repeat_distance,
+        repeat_dpi=args.repeat_dpi,
+        shard_bytes=args.shard_mb * (1 << 20) if args.shard_mb else None,
+    )
+    if catalog is not None:
+        catalog.close()
     
     logger.info("所有PDF处理任务完成")
 
@@ -0,0 +1,61 @@
+# 这个模块用感知哈希（dHash）找出一本书里反复出现的图片
+# 章节图标、logo、页面装饰等会在每一章甚至每一页重复出现，逐个按600 DPI截图、再逐个调用视觉模型描述都是浪费
+# 截图前先用低分辨率渲染计算 dHash，按汉明距离把相近的哈希归为一组，统计每组在全书出现的次数
+#
+# 近似查找用分段索引：把64位哈希切成 max_distance + 1 段，
+# 汉明距离不超过 max_distance 的两个哈希至少有一段完全相同（抽屉原理），只需要比较有相同段的候选
+
+from PIL import Image
+
+def dhash(image, hash_size=8):
+    """计算差值哈希：缩放成 (hash_size+1) x hash_size 的灰度图，比较每行相邻像素的亮度"""
+    small = image.convert('L').resize((hash_size + 1, hash_size), Image.LANCZOS)
+    pixels = list(small.getdata())
+    value = 0
+    for row in range(hash_size):
+        offset = row * (hash_size + 1)
+        for col in range(hash_size):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return value
+
+def hamming(a, b):
+    return bin(a ^ b).count('1')
+
+class RepeatIndex:
+    """
+    按汉明距离对哈希分组并计数
+    
+    每组以第一个加入的哈希作为代表，新哈希与某组代表的距离不超过 max_distance 时计入该组
+    """
+    def __init__(self, max_distance=4, hash_bits=64):
+        self.max_distance = max_distance
+        bands = max_distance + 1
+        width = -(-hash_bits // bands)
+        self.bands = [(shift, (1 << width) - 1) for shift in range(0, hash_bits, width)]
+        self.tables = [{} for _ in self.bands]
+        self.representatives = []
+        self.members = []
+    
+    def add(self, value, item=None):
+        """加入一个哈希，返回所在组的编号"""
+        keys = [(value >> shift) & mask for shift, mask in self.bands]
+        for table, key in zip(self.tables, keys):
+            for group in table.get(key, ()):
+                if hamming(value, self.representatives[group]) <= self.max_distance:
+                    self.members[group].append(item)
+                    return group
+        
+        group = len(self.representatives)
+        self.representatives.append(value)
+        self.members.append([item])
+        for table, key in zip(self.tables, keys):
+            table.setdefault(key, []).append(group)
+        return group
+    
+    def groups(self, min_count=1):
+        """返回出现次数不少于 min_count 的组 [(代表哈希, [成员, ...]), ...]"""
+        return [
+            (self.representatives[group], members)
+            for group, members in enumerate(self.members)
+            if len(members) >= min_count
+        ]
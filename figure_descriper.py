@@ -1,132 +1,320 @@
+import argparse
 import asyncio
 import base64
-import json
 import os
 from pathlib import Path
 from openai import AsyncOpenAI
 from typing import Dict
 import time
 import glob
+from async_io import DEFAULT_IO_WORKERS, LoopLagMonitor, configure_executor, read_file_bytes, run_blocking
+from image_encoder import ImageEncoder, prepare_for_upload
+from rate_limiter import RateLimiter, call_with_retry, estimate_request_tokens
+from description_cache import DescriptionCache, make_cache_key
+from description_journal import DescriptionJournal, journal_path_for, load_descriptions
+from description_quality import QUALITY_RETRIES, RejectManifest, check_description, rejects_path_for
+from figure_catalog import DEFAULT_CATALOG_PATH, FigureCatalog
+from figure_prompt import DESCRIPTION_PROMPT, DEFAULT_PROMPT_MODE, PROMPT_MODES, build_messages, build_packed_messages, parse_packed_response
+from openai_image_tokenizer import count_high_detail_tiles
 
 # 使用gpt-4o-mini模型，通过OpenAI API对科学教学图片进行智能描述。
 # 该脚本会读取指定目录下的图片，调用API生成规范的教学图片描述文本。
 # 描述文本包含开篇概述、核心内容、教学功能和补充说明等结构化内容。
 
-client = AsyncOpenAI()
+# 重试由 rate_limiter 统一处理（429/5xx 抖动退避），客户端自身不再重试
+client = AsyncOpenAI(max_retries=0)
 
-async def encode_image(image_path: str) -> str:
-    with open(image_path, "rb") as image_file:
-        return base64.b64encode(image_file.read()).decode('utf-8')
+# 账号的配额，实际配额以响应头 x-ratelimit-limit-* 为准，收到第一个响应后自动调整
+REQUESTS_PER_MINUTE = 5000
+TOKENS_PER_MINUTE = 2000000
+MODEL = "gpt-4o-mini"
+MAX_TOKENS = 1000
+DETAIL = "high"
 
-async def get_image_description(image_path: str) -> str:
-    prompt = '''
-        请详细描述这张科学教学示意图。要求：
+# 上传前的图片格式：None 保持原格式（缩小后仍为PNG），也可以设为 'jpeg' / 'webp' 进一步减小请求体
+UPLOAD_FORMAT = None
+UPLOAD_ENCODER = ImageEncoder(UPLOAD_FORMAT, jpeg_quality=90, webp_lossless=False, webp_quality=90) if UPLOAD_FORMAT else None
+limiter = RateLimiter(REQUESTS_PER_MINUTE, TOKENS_PER_MINUTE)
 
-        1. 描述长度：控制在100-300字之间
+# 请求结构：'system' 固定说明放在 system 消息里（前缀稳定，可命中提示词缓存），'user' 为原来的结构
+PROMPT_MODE = DEFAULT_PROMPT_MODE
 
-        2. 描述结构（请按以下顺序组织内容）：
-        A. 开篇概述（15-25字）：
-            - 说明图示的主要生物学概念/原理
-            - 点明图示类型（如截面图、流程图、结构图等）
-        
-        B. 核心内容（50-150字）：
-            - 详细解释图中展示的生物学原理或概念
-            - 描述关键组成部分及其关系
-            - 说明重要的因果关系或变化过程
-            - 解释图中的箭头、标注等视觉元素含义
-        
-        C. 教学功能（20-50字）：
-            - 说明该图在教学中的作用
-            - 指出图示帮助理解的关键点
+# 小图打包：不超过 PACK_MAX_TILES 个512px方块的图片，每 PACK_SIZE 张合成一个请求，说明只发送一次；
+# 设为1时不打包。凑不满一组时最多等待 PACK_WAIT 秒就发出
+PACK_SIZE = 1
+PACK_MAX_TILES = 1
+PACK_WAIT = 0.5
+
+# 按图片内容 + 提示词 + 模型 + 参数缓存描述，相同的图片不再重复请求
+cache = DescriptionCache()
+
+# 图片目录：记录每张图片的描述和状态，供查询短描述、未描述的图片和需要上传的书；
+# 由 main 按 --catalog 打开，为 None 时不写入
+catalog = None
+
+def prepare_payload(image_bytes: bytes):
+    """缩小到API实际使用的尺寸并做 base64，返回 (mime类型, base64字符串, (宽, 高))"""
+    mime_type, upload_bytes, size = prepare_for_upload(image_bytes, UPLOAD_ENCODER)
+    return mime_type, base64.b64encode(upload_bytes).decode('utf-8'), size
+
+async def request_description(mime_type: str, base64_image: str, width: int, height: int) -> str:
+    """单张图片的请求，出错时抛出异常"""
+    # 按图片尺寸估算本次请求占用的TPM
+    tokens = estimate_request_tokens(width, height, DESCRIPTION_PROMPT, MAX_TOKENS)
+    response = await call_with_retry(limiter, lambda: client.chat.completions.with_raw_response.create(
+        model=MODEL,
+        messages=build_messages(mime_type, base64_image, DETAIL, PROMPT_MODE),
+        max_tokens=MAX_TOKENS
+    ), tokens)
+    return response.choices[0].message.content
+
+class FigurePacker:
+    """
+    把同时在途的小图凑成一组，用一个请求描述多张图片
+    
+    每张小图调用 describe() 后等待结果；凑满 pack_size 张或等待超过 max_wait 秒时发出一组。
+    返回的JSON解析失败或缺少某张图片时，这些图片退回到单图请求。
+    """
+    def __init__(self, pack_size: int = PACK_SIZE, max_tiles: int = PACK_MAX_TILES, max_wait: float = PACK_WAIT):
+        self.pack_size = pack_size
+        self.max_tiles = max_tiles
+        self.max_wait = max_wait
+        self.pending = []
+        self.flush_handle = None
+        self.tasks = set()
+        self.stats = {'packed_requests': 0, 'packed_figures': 0, 'fallbacks': 0}
+    
+    def accepts(self, width: int, height: int) -> bool:
+        return self.pack_size > 1 and count_high_detail_tiles(width, height) <= self.max_tiles
+    
+    async def describe(self, mime_type: str, base64_image: str, width: int, height: int) -> str:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending.append((mime_type, base64_image, width, height, future))
+        if len(self.pending) >= self.pack_size:
+            self._flush()
+        elif self.flush_handle is None:
+            self.flush_handle = loop.call_later(self.max_wait, self._flush)
+        return await future
+    
+    def _flush(self):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        items, self.pending = self.pending, []
+        if items:
+            task = asyncio.get_running_loop().create_task(self._send(items))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+    
+    async def _send(self, items):
+        descriptions = {}
+        if len(items) > 1:
+            try:
+                descriptions = await self._request_packed(items)
+            except Exception as e:
+                print(f"打包请求失败，{len(items)} 张图片改为单独请求: {str(e)}")
         
-        D. 补充说明（如有必要，15-75字）：
-            - 相关的生物学应用场景
-            - 与其他生物学概念的联系
-            - 特殊的注意事项
-
-        3. 描述原则：
-        - 使用专业准确的生物学术语
-        - 保持逻辑性和连贯性
-        - 由表及里，由简到繁
-        - 注重概念间的关联性
+        missing = [index for index in range(len(items)) if index not in descriptions]
+        if len(items) > 1:
+            self.stats['fallbacks'] += len(missing)
+        results = await asyncio.gather(
+            *[request_description(*items[index][:4]) for index in missing], return_exceptions=True
+        )
+        descriptions.update(zip(missing, results))
         
-        4. 语言要求：
-        - 使用生物学教材的规范表述
-        - 避免过于口语化的表达
-        - 必要时使用专业术语
-        - 保持客观严谨的语气
-
-        5. 特别注意：
-        - 不要使用"这是一张..."等开场白
-        - 不评价图片的设计质量
-        - 如涉及步骤或过程，要清晰标明顺序
-        - 如有数值或单位，需准确描述
-        - 如有图例或备注，要包含在描述中
-    '''
-
-    base64_image = await encode_image(image_path)
+        for index, (*_, future) in enumerate(items):
+            if future.done():
+                continue
+            result = descriptions[index]
+            if isinstance(result, BaseException):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+    
+    async def _request_packed(self, items):
+        tokens = sum(estimate_request_tokens(width, height, '', MAX_TOKENS) for _, _, width, height, _ in items)
+        tokens += len(DESCRIPTION_PROMPT)
+        response = await call_with_retry(limiter, lambda: client.chat.completions.with_raw_response.create(
+            model=MODEL,
+            messages=build_packed_messages([(mime_type, base64_image) for mime_type, base64_image, *_ in items], DETAIL),
+            max_tokens=MAX_TOKENS * len(items),
+            response_format={"type": "json_object"}
+        ), tokens)
+        descriptions = parse_packed_response(response.choices[0].message.content, len(items))
+        self.stats['packed_requests'] += 1
+        self.stats['packed_figures'] += len(descriptions)
+        return descriptions
+    
+    def report(self):
+        if self.pack_size <= 1:
+            return
+        stats = self.stats
+        print(f"打包统计: 打包请求 {stats['packed_requests']} 次, 描述 {stats['packed_figures']} 张图片, "
+              f"退回单图请求 {stats['fallbacks']} 张")
+
+packer = FigurePacker()
+
+async def describe_image_bytes(image_bytes: bytes, name: str = "") -> str:
+    """对内存中已编码的图片生成描述，name 只用于出错时的提示"""
+    # 提示词文本不变，system/user 结构和是否打包不影响缓存键
+    cache_key = make_cache_key(image_bytes, DESCRIPTION_PROMPT, MODEL,
+                               {'max_tokens': MAX_TOKENS, 'detail': DETAIL, 'upload_format': UPLOAD_FORMAT})
+    cached = cache.get(cache_key)
+    # 早期缓存中可能有不合格的描述，当作未命中重新请求
+    if cached is not None and check_description(cached) is None:
+        return cached
     
     try:
-        response = await client.chat.completions.create(
-            model="gpt-4o-mini",
-            messages=[
-                {
-                    "role": "user",
-                    "content": [
-                        {"type": "text", "text": prompt},
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:image/jpeg;base64,{base64_image}",
-                                "detail": "high"
-                            }
-                        }
-                    ]
-                }
-            ],
-            max_tokens=1000
-        )
-        return response.choices[0].message.content
+        # 缩小和 base64 在线程池中执行，不阻塞事件循环；mime类型按实际格式填写
+        mime_type, base64_image, (width, height) = await run_blocking(prepare_payload, image_bytes)
+        
+        if packer.accepts(width, height):
+            description = await packer.describe(mime_type, base64_image, width, height)
+        else:
+            description = await request_description(mime_type, base64_image, width, height)
+        # 不合格的描述不缓存，重试时才会重新请求
+        if check_description(description) is None:
+            cache.put(cache_key, description)
+        return description
     except Exception as e:
-        print(f"处理图片 {image_path} 时出错: {str(e)}")
+        print(f"处理图片 {name} 时出错: {str(e)}")
         return ""
 
-async def process_images(image_dir: str, output_path: str, folder_name: str) -> Dict[str, str]:
-    # 检查checkpoint文件是否存在
-    output_file = Path(output_path) / f"{folder_name}_figures_description.json"
-    existing_descriptions = {}
+async def describe_validated(image_bytes: bytes, name: str = "", retries: int = QUALITY_RETRIES):
+    """
+    生成描述并检查质量，不合格时立即重新请求，最多重试 retries 次
+    
+    返回 (描述, 不合格原因, 请求次数)，合格时原因为 None
+    """
+    for attempt in range(1, retries + 2):
+        description = await describe_image_bytes(image_bytes, name)
+        reason = check_description(description)
+        if reason is None:
+            return description, None, attempt
+        if attempt <= retries:
+            print(f"图片 {name} 的描述不合格（{reason}，{len(description or '')}字），重新请求")
+    return description, reason, attempt
+
+async def get_image_description(image_path: str) -> str:
+    image_bytes = await read_file_bytes(image_path)
+    return await describe_image_bytes(image_bytes, name=image_path)
+
+# 支持的图片格式
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png'}
+
+# 发送速率由 limiter 按 RPM/TPM 控制，这里只决定同时在途的请求数（原来100并发时实测峰值只有800请求/分钟）
+WORKERS = 500
+QUEUE_SIZE = 1000
+
+class BookProgress:
+    """一本书的描述进度：已有描述、日志和还没完成的图片数"""
+    def __init__(self, folder_name: str, image_dir: str, output_path: str):
+        self.folder_name = folder_name
+        self.image_dir = Path(image_dir)
+        self.output_file = Path(output_path) / f"{folder_name}_figures_description.json"
+        self.journal = DescriptionJournal(journal_path_for(self.output_file))
+        self.descriptions = load_descriptions(self.output_file, self.journal)
+        self.described = len(self.descriptions)
+        self.rejects = RejectManifest(rejects_path_for(self.output_file))
+        if catalog is not None:
+            catalog.add_book(folder_name, output_path)
+        self.skipped = self.rejects.permanent()
+        self.queued = 0
+        self.pending = 0
+        self.listed = False
+        self.finished = False
     
-    if output_file.exists():
-        with open(output_file, 'r', encoding='utf-8') as f:
-            existing_descriptions = json.load(f)
-            print(f"找到已存在的处理结果，已处理{len(existing_descriptions)}张图片")
+    def iter_new_images(self):
+        """逐个返回还没有描述的图片，不一次性列出整个目录"""
+        with os.scandir(self.image_dir) as entries:
+            for entry in entries:
+                if Path(entry.name).suffix.lower() not in IMAGE_EXTENSIONS:
+                    continue
+                if entry.name not in self.descriptions and entry.name not in self.skipped:
+                    yield Path(entry.path)
     
-    # 支持的图片格式
-    image_extensions = {'.jpg', '.jpeg', '.png'}
-    descriptions = existing_descriptions.copy()
+    def record(self, name: str, description: str):
+        self.descriptions[name] = description
+        self.described += 1
+        self.journal.append(name, description)
+        if catalog is not None:
+            catalog.record_description(self.folder_name, name, description)
+        self.pending -= 1
     
-    # 获取所有图片文件
-    image_files = [
-        f for f in Path(image_dir).iterdir()
-        if f.suffix.lower() in image_extensions and f.name not in existing_descriptions
-    ]
+    def reject(self, name: str, description: str, reason: str, attempts: int):
+        """重试用完仍不合格：不写入描述文件，记录到 rejects 文件"""
+        self.rejects.add(name, description, reason, attempts)
+        if catalog is not None:
+            catalog.record_reject(self.folder_name, name, description, reason)
+        self.pending -= 1
     
-    print(f"需要处理的新图片数量: {len(image_files)}")
-    if not image_files:
-        print("没有新的图片需要处理")
-        return descriptions
+    def finish_if_done(self):
+        """所有图片都已入队并完成时，把日志合并为最终的JSON文件，之后不再在内存中保留这本书的描述"""
+        if self.finished or not self.listed or self.pending:
+            return
+        self.finished = True
+        if self.journal.journal_path.exists():
+            self.journal.compact(self.output_file, self.descriptions)
+        self.descriptions = None
+        print(f"完成处理 {self.folder_name}: 共 {self.described} 张图片")
+        if self.rejects.records:
+            print(f"{self.folder_name} 有 {len(self.rejects.records)} 张图片的描述不合格，见 {self.rejects.path}")
 
-    # 提高并发数到100，该任务实测峰值跑到800请求/分钟
-    semaphore = asyncio.Semaphore(100)
+async def process_books(books, workers: int = WORKERS, queue_size: int = QUEUE_SIZE) -> Dict[str, int]:
+    """
+    所有书共用一个有界队列和固定数量的协程
+    
+    一个生产者依次列出每本书还没有描述的图片放入队列，各协程取出后请求API并写入该书的日志；
+    一本书的最后一张图片完成时立即输出该书的结果，不必等其他书，也不会在书与书之间出现并发空档。
     
-    # 添加请求统计
+    参数:
+        books: [(书名, 图片目录, 输出目录), ...]
+    返回 {书名: 描述数量}，描述本身在每本书的描述文件里
+    """
+    queue = asyncio.Queue(maxsize=queue_size)
+    progresses = []
     start_time = time.time()
     processed_count = 0
-
-    async def process_single_image(image_path):
+    
+    async def produce():
+        try:
+            for folder_name, image_dir, output_path in books:
+                print(f"\n处理文件夹: {folder_name}")
+                book = BookProgress(folder_name, image_dir, output_path)
+                progresses.append(book)
+                for image_path in book.iter_new_images():
+                    book.queued += 1
+                    book.pending += 1
+                    await queue.put((book, image_path))
+                print(f"{folder_name} 需要处理的新图片数量: {book.queued}")
+                book.listed = True
+                book.finish_if_done()
+        finally:
+            for _ in range(workers):
+                await queue.put(None)
+    
+    async def worker():
         nonlocal processed_count
-        async with semaphore:
-            description = await get_image_description(str(image_path))
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            book, image_path = item
+            try:
+                image_bytes = await read_file_bytes(str(image_path))
+            except OSError as e:
+                # 读不了或已删除的图片只跳过这一张，记为 unreadable，下次运行时重新处理
+                print(f"读取 {image_path} 失败: {str(e)}")
+                book.reject(image_path.name, '', 'unreadable', 0)
+                book.finish_if_done()
+                continue
+            description, reason, attempts = await describe_validated(image_bytes, name=str(image_path))
+            if reason is None:
+                book.record(image_path.name, description)
+            else:
+                book.reject(image_path.name, description, reason, attempts)
+            book.finish_if_done()
             processed_count += 1
             
             # 每处理20个请求输出一次统计
@@ -134,35 +322,64 @@ async def process_images(image_dir: str, output_path: str, folder_name: str) ->
                 elapsed_time = time.time() - start_time
                 rate = processed_count / (elapsed_time / 60)
                 print(f"当前处理速率: {rate:.2f} 请求/分钟")
-            
-            return image_path.name, description
     
-    # 创建所有任务
-    tasks = [process_single_image(image_path) for image_path in image_files]
-    
-    # 执行所有任务并等待结果
-    results = await asyncio.gather(*tasks)
-    
-    # 将结果存入字典
-    descriptions.update(dict(results))
-    
-    # 保存结果到JSON文件
-    with open(output_file, 'w', encoding='utf-8') as f:
-        json.dump(descriptions, f, ensure_ascii=False, indent=2)
+    try:
+        async with LoopLagMonitor():
+            await asyncio.gather(produce(), *[worker() for _ in range(workers)])
+    finally:
+        # 中途出错时已完成的描述都在日志里，下次运行时回放
+        for book in progresses:
+            book.journal.close()
+        if catalog is not None:
+            catalog.flush()
+        cache.flush()
     
-    return descriptions
+    limiter.report()
+    packer.report()
+    cache.report()
+    return {book.folder_name: book.described for book in progresses}
+
+async def process_images(image_dir: str, output_path: str, folder_name: str) -> Dict[str, str]:
+    """处理单本书，返回这本书的全部描述"""
+    await process_books([(folder_name, image_dir, output_path)])
+    output_file = Path(output_path) / f"{folder_name}_figures_description.json"
+    return load_descriptions(output_file, DescriptionJournal(journal_path_for(output_file)))
 
 async def main():
-    base_dir = Path("/root/rawdata/gcs/textbook_ocr")
+    global catalog, PROMPT_MODE
+    parser = argparse.ArgumentParser(description="调用API描述所有书的图片")
+    parser.add_argument("--base-dir", default="/root/rawdata/gcs/textbook_ocr", help="textbook_ocr 目录")
+    parser.add_argument("--from-catalog", action="store_true",
+                        help="图片目录中已记录的书只处理还有未描述图片的，目录中没有记录的书照常处理")
+    parser.add_argument("--io-workers", type=int, default=DEFAULT_IO_WORKERS,
+                        help="读文件、缩小图片和 base64 使用的线程数")
+    parser.add_argument("--catalog", default=DEFAULT_CATALOG_PATH, help="图片目录数据库")
+    parser.add_argument("--no-catalog", action="store_true", help="不写入图片目录")
+    parser.add_argument("--prompt-mode", choices=PROMPT_MODES, default=PROMPT_MODE,
+                        help="system: 说明放在 system 消息里以命中提示词缓存；user: 原来的请求结构")
+    args = parser.parse_args()
+    if args.from_catalog and args.no_catalog:
+        parser.error("--from-catalog 需要图片目录，不能和 --no-catalog 同时使用")
+    
+    catalog = None if args.no_catalog else FigureCatalog(args.catalog)
+    PROMPT_MODE = args.prompt_mode
+    configure_executor(args.io_workers)
+    base_dir = Path(args.base_dir)
     
     # 获取所有以数字开头的子文件夹
     subfolders = [
         f for f in base_dir.glob("*") 
         if f.is_dir() and f.name[0].isdigit()
     ]
+    if args.from_catalog:
+        # 建立目录之前或用 --no-catalog 截图的书不在目录中，不能跳过
+        known = catalog.book_dirs()
+        pending = set(catalog.books_with_undescribed())
+        subfolders = [f for f in subfolders if f.name not in known or f.name in pending]
 
     print(f"找到 {len(subfolders)} 个以数字开头的文件夹需要处理")
     
+    books = []
     for folder in subfolders:
         folder_name = folder.name
         image_dir = folder / "auto" / "figures"
@@ -171,17 +388,12 @@ async def main():
         if not image_dir.exists():
             print(f"跳过 {folder_name}: figures目录不存在")
             continue
-            
-        print(f"\n处理文件夹: {folder_name}")
-        print(f"输入目录: {image_dir}")
-        print(f"输出目录: {output_dir}")
-        
-        descriptions = await process_images(
-            str(image_dir), 
-            str(output_dir),
-            folder_name
-        )
-        print(f"完成处理 {folder_name}: 共 {len(descriptions)} 张图片")
+        books.append((folder_name, str(image_dir), str(output_dir)))
+    
+    # 所有书的图片共用一个工作队列
+    await process_books(books)
+    if catalog is not None:
+        catalog.close()
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    asyncio.run(main())
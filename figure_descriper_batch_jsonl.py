@@ -1,142 +1,260 @@
+# 为 OpenAI Batch API 生成请求文件（价格比实时接口便宜一半）
+# 原来直接把600 DPI的PNG做base64，每40张图一个文件，体积巨大没法用；现在：
+#   - 图片先缩小到模型实际使用的尺寸（可选转成JPEG/WebP）再做base64
+#   - 按 Batch API 的限制（单文件200MB、50000个请求）切分文件，留一些余量
+#   - 缩放和编码在进程池中并行执行，结果按顺序流式写入文件
+#   - 可选在本地用 gzip 压缩分片（上传前需要解压，Batch API 只接受 .jsonl）
+#   - 每个分片旁边写一个 manifest，记录请求数、字节数和 custom_id 对应的图片路径
+#   - 读不了或损坏的图片跳过，原因记录在 manifest 的 errors 中
+#   - 提示词和实时接口共用 figure_prompt.py，固定说明放在 system 消息里
+#
+# 使用示例：
+#     python figure_descriper_batch_jsonl.py --root-dir /root/rawdata/gcs/textbook_ocr --output /root/rawdata/batch_request/batch_requests.jsonl
 
-# 因为base64编码会让文件体积变得巨大，这个脚本的方案不太能用
-
+import argparse
 import asyncio
 import base64
+import gzip
 import json
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from pathlib import Path
 from typing import List
+from async_io import LoopLagMonitor
+from figure_prompt import DEFAULT_PROMPT_MODE, PROMPT_MODES, build_messages
+from image_encoder import FORMAT_EXTENSIONS, ImageEncoder, prepare_for_upload
+
+# Batch API 单个输入文件最大200MB、最多50000个请求
+MAX_SHARD_BYTES = 190 * 1024 * 1024
+MAX_SHARD_REQUESTS = 50000
+
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png'}
+
+# custom_id 为 "<书名>::<图片文件名>"，不同书中同名的图片不会冲突，结果可以直接写回对应书的描述文件
+CUSTOM_ID_SEPARATOR = '::'
+
+def make_custom_id(book: str, image_name: str) -> str:
+    return f"{book}{CUSTOM_ID_SEPARATOR}{image_name}"
+
+def parse_custom_id(custom_id: str):
+    """返回 (书名, 图片文件名)，旧格式（只有文件名）的书名为 None"""
+    if CUSTOM_ID_SEPARATOR not in custom_id:
+        return None, custom_id
+    book, image_name = custom_id.split(CUSTOM_ID_SEPARATOR, 1)
+    return book, image_name
 
-async def encode_image(image_path: str) -> str:
-    with open(image_path, "rb") as image_file:
-        return base64.b64encode(image_file.read()).decode('utf-8')
+def custom_id_for_image(image_path: Path) -> str:
+    """图片路径为 <textbook_ocr>/<书名>/auto/figures/<文件名>"""
+    return make_custom_id(image_path.parent.parent.parent.name, image_path.name)
 
 def find_figure_dirs(root_dir: str) -> List[Path]:
     """查找所有包含 figures 文件夹的目录"""
     root_path = Path(root_dir)
     return list(root_path.rglob('figures'))
 
-async def generate_request(image_path: Path) -> dict:
-    """为单个图片生成请求格式"""
-    base64_image = await encode_image(str(image_path))
-    
-    prompt = '''
-        请详细描述这张科学教学示意图。要求：
-
-        1. 描述长度：控制在100-300字之间
-
-        2. 描述结构（请按以下顺序组织内容）：
-        A. 开篇概述（15-25字）：
-            - 说明图示的主要生物学概念/原理
-            - 点明图示类型（如截面图、流程图、结构图等）
-        
-        B. 核心内容（50-150字）：
-            - 详细解释图中展示的生物学原理或概念
-            - 描述关键组成部分及其关系
-            - 说明重要的因果关系或变化过程
-            - 解释图中的箭头、标注等视觉元素含义
-        
-        C. 教学功能（20-50字）：
-            - 说明该图在教学中的作用
-            - 指出图示帮助理解的关键点
-        
-        D. 补充说明（如有必要，15-75字）：
-            - 相关的生物学应用场景
-            - 与其他生物学概念的联系
-            - 特殊的注意事项
-
-        3. 描述原则：
-        - 使用专业准确的生物学术语
-        - 保持逻辑性和连贯性
-        - 由表及里，由简到繁
-        - 注重概念间的关联性
-        
-        4. 语言要求：
-        - 使用生物学教材的规范表述
-        - 避免过于口语化的表达
-        - 必要时使用专业术语
-        - 保持客观严谨的语气
-
-        5. 特别注意：
-        - 不要使用"这是一张..."等开场白
-        - 不评价图片的设计质量
-        - 如涉及步骤或过程，要清晰标明顺序
-        - 如有数值或单位，需准确描述
-        - 如有图例或备注，要包含在描述中
-    '''
-
+def build_request(custom_id: str, mime_type: str, base64_image: str, prompt_mode: str = DEFAULT_PROMPT_MODE) -> dict:
+    """生成 Batch API 的单条请求，prompt_mode 见 figure_prompt.PROMPT_MODES"""
     return {
-        "custom_id": image_path.stem,  # 使用文件名作为 custom_id
+        "custom_id": custom_id,
         "method": "POST",
         "url": "/v1/chat/completions",
         "body": {
             "model": "gpt-4o-mini",
-            "messages": [
-                {
-                    "role": "user",
-                    "content": [
-                        {
-                            "type": "text",
-                            "text": prompt
-                        },
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:image/jpeg;base64,{base64_image}",
-                                "detail": "high"
-                            }
-                        }
-                    ]
-                }
-            ],
+            "messages": build_messages(mime_type, base64_image, "high", prompt_mode),
             "max_tokens": 1000
         }
     }
 
-async def process_directory(output_base_path: str, batch_size: int = 40):
-    """处理目录下的图片并输出到多个jsonl文件，每个文件包含指定数量的图片"""
-    image_extensions = {'.jpg', '.jpeg', '.png'}
-    root_dir = "/root/rawdata/gcs/textbook_ocr/1 普通生物学（5）"
-    figure_dirs = find_figure_dirs(root_dir)
+def build_request_line(image_path: str, custom_id: str, upload_format=None, prompt_mode: str = DEFAULT_PROMPT_MODE) -> dict:
+    """
+    在工作进程中读取、缩小并编码图片，返回一行请求及统计
     
-    current_file_num = 1
-    current_batch_count = 0
-    current_file = None
+    upload_format 为 None 时保持原格式，也可以是 'jpeg' / 'webp'
+    """
+    with open(image_path, 'rb') as f:
+        image_bytes = f.read()
+    encoder = ImageEncoder(upload_format, jpeg_quality=90, webp_lossless=False, webp_quality=90) if upload_format else None
+    mime_type, upload_bytes, _ = prepare_for_upload(image_bytes, encoder)
+    request = build_request(custom_id, mime_type, base64.b64encode(upload_bytes).decode('ascii'), prompt_mode)
+    return {
+        'custom_id': custom_id,
+        'image_path': image_path,
+        'line': (json.dumps(request, ensure_ascii=False) + '\n').encode('utf-8'),
+        'original_bytes': len(image_bytes),
+        'upload_bytes': len(upload_bytes),
+    }
+
+class BatchShardWriter:
+    """
+    按字节数和请求数切分请求文件：<stem>_1.jsonl、<stem>_2.jsonl ...，
+    每个分片旁边写 <stem>_N.manifest.json
     
-    def get_output_file(base_path: str, num: int) -> str:
-        """生成输出文件路径"""
-        path = Path(base_path)
-        return str(path.parent / f"{path.stem}_{num}{path.suffix}")
+    跳过的图片记录在当前分片 manifest 的 errors 中，第一个分片打开前跳过的记到第一个分片
+    """
+    def __init__(self, output_base_path: str, max_bytes: int = MAX_SHARD_BYTES,
+                 max_requests: int = MAX_SHARD_REQUESTS, compress: bool = False):
+        path = Path(output_base_path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.directory = path.parent
+        self.stem = path.stem
+        self.max_bytes = max_bytes
+        self.max_requests = max_requests
+        self.compress = compress
+        self.shard_num = 0
+        self.file = None
+        self.manifests = []
+        self.errors = {}
     
-    try:
-        current_file = open(get_output_file(output_base_path, current_file_num), 'w', encoding='utf-8')
-        
-        for figure_dir in figure_dirs:
-            image_files = [f for f in figure_dir.iterdir() if f.suffix.lower() in image_extensions]
-            
-            for image_path in image_files:
-                # 如果当前批次已满，创建新文件
-                if current_batch_count >= batch_size:
-                    current_file.close()
-                    current_file_num += 1
-                    current_file = open(get_output_file(output_base_path, current_file_num), 'w', encoding='utf-8')
-                    current_batch_count = 0
-                
-                request = await generate_request(image_path)
-                json_line = json.dumps(request, ensure_ascii=False) + '\n'
-                current_file.write(json_line)
-                current_batch_count += 1
-                print(f"已处理: {image_path} -> batch_{current_file_num}.jsonl ({current_batch_count}/{batch_size})")
+    def _open(self):
+        self.shard_num += 1
+        suffix = '.jsonl.gz' if self.compress else '.jsonl'
+        self.path = self.directory / f"{self.stem}_{self.shard_num}{suffix}"
+        self.file = gzip.open(self.path, 'wb') if self.compress else open(self.path, 'wb')
+        self.manifest = {
+            'file': self.path.name,
+            'requests': 0,
+            'bytes': 0,
+            'original_image_bytes': 0,
+            'upload_image_bytes': 0,
+            'images': {},
+            'errors': self.errors,
+        }
+        self.errors = {}
+    
+    def _close(self):
+        if self.file is None:
+            return
+        self.file.close()
+        self.file = None
+        self.manifest['file_bytes'] = os.path.getsize(self.path)
+        manifest_path = self.directory / f"{self.stem}_{self.shard_num}.manifest.json"
+        with open(manifest_path, 'w', encoding='utf-8') as f:
+            json.dump(self.manifest, f, ensure_ascii=False, indent=2)
+        self.manifests.append(self.manifest)
+        print(f"分片完成: {self.path} ({self.manifest['requests']} 个请求, "
+              f"{self.manifest['bytes'] / (1024 * 1024):.1f} MB)")
+    
+    def skip(self, custom_id: str, image_path: str, error: str):
+        """记录没有写入请求的图片"""
+        print(f"跳过 {image_path}: {error}")
+        errors = self.manifest['errors'] if self.file is not None else self.errors
+        errors[custom_id] = {'image_path': image_path, 'error': error}
+    
+    def write(self, item: dict):
+        line = item['line']
+        if len(line) > self.max_bytes:
+            self.skip(item['custom_id'], item['image_path'], f"单个请求 {len(line)} 字节超过分片上限")
+            return
+        # 按未压缩的大小计算，Batch API 的限制针对解压后的文件
+        if self.file is not None and (self.manifest['bytes'] + len(line) > self.max_bytes
+                                      or self.manifest['requests'] >= self.max_requests):
+            self._close()
+        if self.file is None:
+            self._open()
+        self.file.write(line)
+        self.manifest['requests'] += 1
+        self.manifest['bytes'] += len(line)
+        self.manifest['original_image_bytes'] += item['original_bytes']
+        self.manifest['upload_image_bytes'] += item['upload_bytes']
+        self.manifest['images'][item['custom_id']] = item['image_path']
+    
+    def close(self):
+        self._close()
+        if self.errors:
+            print(f"没有生成任何分片，{len(self.errors)} 张图片被跳过")
+        return self.manifests
+
+def iter_images(root_dir: str):
+    """逐个返回 root_dir 下所有 figures 目录中的图片"""
+    for figure_dir in find_figure_dirs(root_dir):
+        for image_path in sorted(figure_dir.iterdir()):
+            if image_path.suffix.lower() in IMAGE_EXTENSIONS:
+                yield image_path
+
+async def write_batch_requests(image_paths, output_base_path: str, max_bytes: int = MAX_SHARD_BYTES,
+                               max_requests: int = MAX_SHARD_REQUESTS, compress: bool = False,
+                               upload_format=None, workers=None, prompt_mode: str = DEFAULT_PROMPT_MODE):
+    """为 image_paths 中的图片在进程池中并行生成请求，按顺序写入按大小切分的 jsonl 文件"""
+    workers = workers or os.cpu_count() or 1
+    writer = BatchShardWriter(output_base_path, max_bytes, max_requests, compress)
+    loop = asyncio.get_running_loop()
+    pending = deque()
+    count = 0
+    
+    async def write_next():
+        nonlocal count
+        image_path, future = pending.popleft()
+        try:
+            item = await future
+        except BrokenProcessPool:
+            raise
+        except Exception as e:
+            # 读不了或损坏的图片只跳过这一张
+            writer.skip(custom_id_for_image(image_path), str(image_path), f"{type(e).__name__}: {e}")
+            return
+        writer.write(item)
+        count += 1
+        if count % 100 == 0:
+            print(f"已处理 {count} 张图片 -> {writer.path.name}")
     
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for image_path in image_paths:
+                image_path = Path(image_path)
+                pending.append((image_path, loop.run_in_executor(
+                    executor, build_request_line, str(image_path), custom_id_for_image(image_path), upload_format,
+                    prompt_mode
+                )))
+                # 限制在途的图片数量，按提交顺序写出
+                while len(pending) > workers * 4:
+                    await write_next()
+            while pending:
+                await write_next()
     finally:
-        if current_file:
-            current_file.close()
+        manifests = writer.close()
+    
+    total_requests = sum(manifest['requests'] for manifest in manifests)
+    original = sum(manifest['original_image_bytes'] for manifest in manifests)
+    uploaded = sum(manifest['upload_image_bytes'] for manifest in manifests)
+    skipped = sum(len(manifest['errors']) for manifest in manifests) + len(writer.errors)
+    print(f"共 {total_requests} 个请求, {len(manifests)} 个分片, 跳过 {skipped} 张图片, "
+          f"图片 {original / (1024 * 1024):.1f} MB -> {uploaded / (1024 * 1024):.1f} MB")
+    return manifests
+
+async def process_directory(root_dir: str, output_base_path: str, **options):
+    """处理目录下所有 figures 文件夹中的图片，options 见 write_batch_requests"""
+    return await write_batch_requests(iter_images(root_dir), output_base_path, **options)
 
 async def main():
-    output_base_path = "/root/rawdata/batch_request/batch_requests.jsonl"
+    parser = argparse.ArgumentParser(description="生成 OpenAI Batch API 的图片描述请求文件")
+    parser.add_argument("--root-dir", default="/root/rawdata/gcs/textbook_ocr/1 普通生物学（5）",
+                        help="在该目录下查找所有 figures 文件夹")
+    parser.add_argument("--output", default="/root/rawdata/batch_request/batch_requests.jsonl",
+                        help="输出文件路径，实际文件为 <stem>_N.jsonl")
+    parser.add_argument("--max-mb", type=int, default=MAX_SHARD_BYTES // (1024 * 1024), help="每个分片的最大MB数")
+    parser.add_argument("--max-requests", type=int, default=MAX_SHARD_REQUESTS, help="每个分片的最大请求数")
+    parser.add_argument("--gzip", action="store_true", help="在本地用 gzip 压缩分片")
+    parser.add_argument("--upload-format", choices=sorted(FORMAT_EXTENSIONS), default=None,
+                        help="重新编码图片的格式，默认保持原格式")
+    parser.add_argument("--workers", type=int, default=None, help="进程数，默认等于CPU核数")
+    parser.add_argument("--prompt-mode", choices=PROMPT_MODES, default=DEFAULT_PROMPT_MODE,
+                        help="system: 说明放在 system 消息里以命中提示词缓存；user: 原来的请求结构")
+    args = parser.parse_args()
+    
     print(f"开始处理图片...")
-    await process_directory(output_base_path)
+    async with LoopLagMonitor():
+        await process_directory(
+            args.root_dir, args.output,
+            max_bytes=args.max_mb * 1024 * 1024,
+            max_requests=args.max_requests,
+            compress=args.gzip,
+            upload_format=args.upload_format,
+            workers=args.workers,
+            prompt_mode=args.prompt_mode,
+        )
     print(f"处理完成")
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    asyncio.run(main())
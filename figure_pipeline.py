@@ -0,0 +1,217 @@
+# 截图和描述的流水线：截图在内存中编码后直接通过有界队列交给描述协程，不再先写PNG再读回
+# 描述在截图的同时开始，图片文件只在指定 --save-images 时作为附带输出写入 auto/figures
+#
+# 输出与 figure_descriper.py 相同：auto/<书名>_figures_description.json（运行中先追加到 .jsonl 日志），键为图片文件名，
+# 已有描述的图片不会再截图，可以中断后重新运行
+#
+# 使用示例：
+#     python figure_pipeline.py --base-dir /root/rawdata/gcs/textbook_ocr --concurrency 100 --save-images
+#     # 小图每4张打包成一个请求
+#     python figure_pipeline.py --pack-size 4
+
+import argparse
+import asyncio
+import concurrent.futures
+import logging
+import threading
+import time
+from pathlib import Path
+from async_io import DEFAULT_IO_WORKERS, configure_executor
+from figure_crop import DPI_MODES, PDFElementExtractor, find_books, write_book_manifest
+from description_journal import DescriptionJournal, journal_path_for, load_descriptions
+import figure_descriper
+from description_quality import RejectManifest, rejects_path_for
+from figure_descriper import cache, describe_validated, limiter, packer
+from figure_catalog import DEFAULT_CATALOG_PATH, FigureCatalog
+from figure_prompt import PROMPT_MODES
+from image_encoder import FORMAT_EXTENSIONS, ImageEncoder
+
+async def describe_book(extractor, output_file, concurrency=100, queue_size=32, save_images=False):
+    """
+    截图线程逐个产出编码后的图片，concurrency 个协程从队列中取出并调用API描述
+    
+    队列满时截图线程等待，内存中最多有 queue_size + concurrency 张图片
+    """
+    journal = DescriptionJournal(journal_path_for(output_file))
+    descriptions = load_descriptions(output_file, journal)
+    # 永久不合格的图片（见 description_quality.py）也不再截图
+    rejects = RejectManifest(rejects_path_for(output_file))
+    book = output_file.name[:-len('_figures_description.json')]
+    # 图片目录由 main 按 --catalog 设置，为 None 时不写入
+    catalog = figure_descriper.catalog
+    if catalog is not None:
+        catalog.add_book(book, output_file.parent)
+    skip = {Path(name).stem for name in descriptions} | {Path(name).stem for name in rejects.permanent()}
+    
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue(maxsize=queue_size)
+    start_time = time.time()
+    processed_count = 0
+    
+    # 描述协程出错退出后设置，截图线程不再等待没人取的队列
+    stop = threading.Event()
+    
+    def put(item):
+        """从截图线程把 item 放入队列，队列满时等待；stop 被设置时放弃并返回 False"""
+        future = asyncio.run_coroutine_threadsafe(queue.put(item), loop)
+        while True:
+            try:
+                future.result(timeout=1)
+                return True
+            except concurrent.futures.TimeoutError:
+                if stop.is_set():
+                    future.cancel()
+                    return False
+    
+    def produce():
+        # 在线程中截图，通过事件循环把图片放入队列，队列满时阻塞
+        try:
+            for item in extractor.iter_encoded_crops(skip=skip, save_images=save_images):
+                if not put(item):
+                    return
+        finally:
+            for _ in range(concurrency):
+                if not put(None):
+                    break
+    
+    async def consume():
+        nonlocal processed_count
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            description, reason, attempts = await describe_validated(item['data'], item['name'])
+            if reason is None:
+                descriptions[item['name']] = description
+                journal.append(item['name'], description)
+                if catalog is not None:
+                    catalog.record_description(book, item['name'], description)
+            else:
+                rejects.add(item['name'], description, reason, attempts)
+                if catalog is not None:
+                    catalog.record_reject(book, item['name'], description, reason)
+            processed_count += 1
+            
+            # 每处理20个请求输出一次统计
+            if processed_count % 20 == 0:
+                elapsed_time = time.time() - start_time
+                rate = processed_count / (elapsed_time / 60)
+                print(f"当前处理速率: {rate:.2f} 请求/分钟，队列中等待: {queue.qsize()}")
+    
+    consumers = [loop.create_task(consume()) for _ in range(concurrency)]
+    producer = loop.run_in_executor(None, produce)
+    try:
+        try:
+            await asyncio.gather(*consumers)
+        finally:
+            # 描述协程出错时让截图线程停下，等它退出后才能关闭PDF
+            stop.set()
+            for task in consumers:
+                task.cancel()
+            await asyncio.wait([producer])
+        # 截图出错时截图线程仍会放入结束标记，在途的描述完成后再抛出
+        producer.result()
+    finally:
+        # 中途出错时已经完成的描述都在日志里，下次运行时回放
+        journal.close()
+        if catalog is not None:
+            # 本次截图的图片（包括 --save-images 时的保存位置）一并写入图片目录
+            catalog.add_figures(book, extractor.figures)
+            catalog.flush()
+        cache.flush()
+    journal.compact(output_file, descriptions)
+    limiter.report()
+    packer.report()
+    cache.report()
+    
+    print(f"新描述 {processed_count} 张图片")
+    if rejects.records:
+        print(f"{len(rejects.records)} 张图片的描述不合格，见 {rejects.path}")
+    return descriptions
+
+async def run_pipeline(books, concurrency=100, queue_size=32, save_images=False, **options):
+    """
+    逐本书运行流水线，options 传给 PDFElementExtractor
+    
+    和 figure_crop 一样按书隔离错误：一本书截图或描述出错时记录下来继续处理下一本，返回失败的书名
+    """
+    logger = logging.getLogger(__name__)
+    failed_books = []
+    for subdir, pdf_path, layout_json_path, output_dir in books:
+        print(f"\n处理文件夹: {subdir}")
+        output_file = Path(output_dir).parent / f"{subdir}_figures_description.json"
+        try:
+            extractor = PDFElementExtractor(pdf_path, layout_json_path, output_dir, **options)
+            try:
+                descriptions = await describe_book(
+                    extractor, output_file,
+                    concurrency=concurrency,
+                    queue_size=queue_size,
+                    save_images=save_images,
+                )
+            finally:
+                extractor.close()
+        except Exception as e:
+            # 已经完成的描述都在日志里，下次运行时回放
+            logger.error(f"处理 {subdir} 时发生错误: {str(e)}")
+            failed_books.append(subdir)
+            continue
+        extractor.encode_stats.report()
+        write_book_manifest(output_dir, subdir, extractor.manifest)
+        print(f"完成处理 {subdir}: 共 {len(descriptions)} 张图片")
+    
+    if failed_books:
+        logger.error(f"处理失败的书: {', '.join(failed_books)}")
+    return failed_books
+
+def main():
+    parser = argparse.ArgumentParser(description="截图后直接在内存中调用API描述图片")
+    parser.add_argument("--base-dir", default="/root/rawdata/gcs/textbook_ocr", help="textbook_ocr 目录")
+    parser.add_argument("--concurrency", type=int, default=100, help="同时进行的API请求数")
+    parser.add_argument("--queue-size", type=int, default=32, help="等待描述的图片队列长度")
+    parser.add_argument("--save-images", action="store_true", help="同时把截图写入 auto/figures")
+    parser.add_argument("--shard-mb", type=int, default=None,
+                        help="--save-images 时把截图写入每个约该大小（MB）的 tar 分片")
+    parser.add_argument("--format", choices=sorted(FORMAT_EXTENSIONS), default="png", help="图片格式")
+    parser.add_argument("--dpi-mode", choices=DPI_MODES, default="fixed",
+                        help="截图分辨率模式：fixed 按 --max-dpi 渲染（原来的行为），budget 按模型实际使用的尺寸选择较低的DPI")
+    parser.add_argument("--max-dpi", type=int, default=600, help="最高DPI")
+    parser.add_argument("--merge-overlaps", action="store_true", help="合并同一页中重叠/嵌套的图表")
+    parser.add_argument("--repeat-threshold", type=int, default=None,
+                        help="全书出现次数不少于该值的相似图片不再截图和描述")
+    parser.add_argument("--prompt-mode", choices=PROMPT_MODES, default=figure_descriper.PROMPT_MODE,
+                        help="system: 说明放在 system 消息里以命中提示词缓存；user: 原来的请求结构")
+    parser.add_argument("--pack-size", type=int, default=packer.pack_size,
+                        help="每个请求打包的小图数量，1 表示不打包")
+    parser.add_argument("--io-workers", type=int, default=DEFAULT_IO_WORKERS,
+                        help="缩小图片和 base64 使用的线程数")
+    parser.add_argument("--catalog", default=DEFAULT_CATALOG_PATH, help="图片目录数据库")
+    parser.add_argument("--no-catalog", action="store_true", help="不写入图片目录")
+    args = parser.parse_args()
+    
+    figure_descriper.catalog = None if args.no_catalog else FigureCatalog(args.catalog)
+    configure_executor(args.io_workers)
+    figure_descriper.PROMPT_MODE = args.prompt_mode
+    packer.pack_size = args.pack_size
+    
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    books = find_books(args.base_dir, logging.getLogger(__name__))
+    print(f"找到 {len(books)} 本书需要处理")
+    
+    asyncio.run(run_pipeline(
+        books,
+        concurrency=args.concurrency,
+        queue_size=args.queue_size,
+        save_images=args.save_images,
+        encoder=ImageEncoder(args.format),
+        dpi=args.max_dpi,
+        dpi_mode=args.dpi_mode,
+        merge_overlaps=args.merge_overlaps,
+        repeat_threshold=args.repeat_threshold,
+        shard_bytes=args.shard_mb * (1 << 20) if args.shard_mb else None,
+    ))
+    if figure_descriper.catalog is not None:
+        figure_descriper.catalog.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+# 图片描述请求的提示词和消息结构，figure_descriper.py（实时接口）和 figure_descriper_batch_jsonl.py（Batch 接口）共用
+# 原来每个请求都把约600 token的说明放在 user 消息里、图片之前；现在：
+#   - 'system' 模式把固定说明放在 system 消息里，所有请求的前缀完全相同，能被服务端的提示词缓存命中
+#     （OpenAI 按1024 token的前缀起缓存，命中部分按半价计费；前缀不够长时效果和 'user' 模式相同，不会变差）
+#   - 多张小图可以打包成一个请求，说明只发送一次，要求模型返回以图片编号为键的JSON；
+#     解析失败或缺少某张图片时由调用方退回到单图请求
+
+import json
+from typing import Dict, List, Tuple
+
+# 'system'：说明放在 system 消息；'user'：原来的结构，说明和图片放在同一条 user 消息里
+PROMPT_MODES = ('system', 'user')
+DEFAULT_PROMPT_MODE = 'system'
+
+DESCRIPTION_PROMPT = '''
+        请详细描述这张科学教学示意图。要求：
+
+        1. 描述长度：控制在100-300字之间
+
+        2. 描述结构（请按以下顺序组织内容）：
+        A. 开篇概述（15-25字）：
+            - 说明图示的主要生物学概念/原理
+            - 点明图示类型（如截面图、流程图、结构图等）
+        
+        B. 核心内容（50-150字）：
+            - 详细解释图中展示的生物学原理或概念
+            - 描述关键组成部分及其关系
+            - 说明重要的因果关系或变化过程
+            - 解释图中的箭头、标注等视觉元素含义
+        
+        C. 教学功能（20-50字）：
+            - 说明该图在教学中的作用
+            - 指出图示帮助理解的关键点
+        
+        D. 补充说明（如有必要，15-75字）：
+            - 相关的生物学应用场景
+            - 与其他生物学概念的联系
+            - 特殊的注意事项
+
+        3. 描述原则：
+        - 使用专业准确的生物学术语
+        - 保持逻辑性和连贯性
+        - 由表及里，由简到繁
+        - 注重概念间的关联性
+        
+        4. 语言要求：
+        - 使用生物学教材的规范表述
+        - 避免过于口语化的表达
+        - 必要时使用专业术语
+        - 保持客观严谨的语气
+
+        5. 特别注意：
+        - 不要使用"这是一张..."等开场白
+        - 不评价图片的设计质量
+        - 如涉及步骤或过程，要清晰标明顺序
+        - 如有数值或单位，需准确描述
+        - 如有图例或备注，要包含在描述中
+    '''
+
+PACKED_INSTRUCTION = '''
+        下面依次给出 {count} 张图片，每张图片前标有编号（{labels}）。
+        请按照上述要求分别描述每一张图片，各图片的描述互相独立。
+        只输出一个JSON对象，键为图片编号，值为该图片的描述文本，不要输出其他内容。
+    '''
+
+def figure_label(index: int) -> str:
+    """打包请求中第 index 张图片（从0开始）的编号"""
+    return f"图{index + 1}"
+
+def image_part(mime_type: str, base64_image: str, detail: str = "high") -> dict:
+    return {
+        "type": "image_url",
+        "image_url": {
+            "url": f"data:{mime_type};base64,{base64_image}",
+            "detail": detail
+        }
+    }
+
+def build_messages(mime_type: str, base64_image: str, detail: str = "high",
+                   mode: str = DEFAULT_PROMPT_MODE) -> List[dict]:
+    """单张图片的消息列表"""
+    if mode == 'user':
+        return [
+            {
+                "role": "user",
+                "content": [
+                    {"type": "text", "text": DESCRIPTION_PROMPT},
+                    image_part(mime_type, base64_image, detail)
+                ]
+            }
+        ]
+    if mode != 'system':
+        raise ValueError(f"不支持的提示词模式: {mode}，可选 {PROMPT_MODES}")
+    return [
+        {"role": "system", "content": DESCRIPTION_PROMPT},
+        {"role": "user", "content": [image_part(mime_type, base64_image, detail)]}
+    ]
+
+def build_packed_messages(images: List[Tuple[str, str]], detail: str = "high") -> List[dict]:
+    """
+    多张图片打包的消息列表，images 为 [(mime类型, base64字符串), ...]
+    
+    system 消息和单图的 'system' 模式相同，打包说明放在 user 消息开头，之后每张图片前加一行编号
+    """
+    labels = [figure_label(index) for index in range(len(images))]
+    content = [{"type": "text", "text": PACKED_INSTRUCTION.format(count=len(images), labels='、'.join(labels))}]
+    for label, (mime_type, base64_image) in zip(labels, images):
+        content.append({"type": "text", "text": f"{label}："})
+        content.append(image_part(mime_type, base64_image, detail))
+    return [
+        {"role": "system", "content": DESCRIPTION_PROMPT},
+        {"role": "user", "content": content}
+    ]
+
+def parse_packed_response(content: str, count: int) -> Dict[int, str]:
+    """
+    解析打包请求返回的JSON，返回 {图片序号: 描述}，只包含非空的描述
+    
+    返回内容不是JSON对象时抛出 ValueError，缺少的图片由调用方单独重新请求
+    """
+    text = (content or '').strip()
+    # 个别情况下模型仍会用 ```json 代码块包起来
+    if text.startswith('```'):
+        text = text.strip('`')
+        if text.startswith('json'):
+            text = text[4:]
+    try:
+        data = json.loads(text)
+    except json.JSONDecodeError as e:
+        raise ValueError(f"打包请求返回的不是JSON: {e}") from e
+    if not isinstance(data, dict):
+        raise ValueError("打包请求返回的JSON不是对象")
+    descriptions = {}
+    for index in range(count):
+        description = data.get(figure_label(index))
+        if isinstance(description, str) and description.strip():
+            descriptions[index] = description.strip()
+    return descriptions
@@ -0,0 +1,243 @@
+# 这个模块提供统一的图片编码层，供 pdf-highq-image.py 和 figure_crop.py 使用
+# 支持 PNG（可选压缩等级）、无损/有损 WebP、可控质量的 JPEG，以及单色页面自动转灰度
+# 编码放在独立的线程池里执行，渲染线程只负责产出像素，不再被 zlib 压缩阻塞
+
+import hashlib
+import io
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image, ImageChops
+from openai_image_tokenizer import effective_high_detail_size
+
+# WebP 单边最大像素
+WEBP_MAX_SIDE = 16383
+
+FORMAT_EXTENSIONS = {
+    'png': '.png',
+    'webp': '.webp',
+    'jpeg': '.jpg',
+}
+
+FORMAT_MIME_TYPES = {
+    'png': 'image/png',
+    'webp': 'image/webp',
+    'jpeg': 'image/jpeg',
+}
+
+def pixmap_to_image(pix):
+    """把 fitz.Pixmap 转换为 PIL Image（要求 alpha=False）"""
+    mode = 'L' if pix.n == 1 else 'RGB'
+    return Image.frombytes(mode, (pix.width, pix.height), pix.samples)
+
+def is_monochrome(image, tolerance=8):
+    """判断RGB图片是否实际上是灰度图（三个通道之间的差异不超过 tolerance）"""
+    if image.mode in ('L', '1'):
+        return True
+    r, g, b = image.convert('RGB').split()
+    return (ImageChops.difference(r, g).getextrema()[1] <= tolerance
+            and ImageChops.difference(g, b).getextrema()[1] <= tolerance)
+
+class ImageEncoder:
+    """
+    可配置的图片编码器
+    
+    参数:
+        fmt: 输出格式 png / webp / jpeg
+        png_compress_level: PNG 的 zlib 压缩等级 0-9，越小越快、文件越大
+        jpeg_quality: JPEG 质量 1-95
+        webp_lossless: WebP 是否无损
+        webp_quality: WebP 质量（无损模式下表示压缩力度）
+        webp_method: WebP 编码速度/压缩率折中 0-6，越小越快
+        grayscale: False 保持彩色；True 一律转灰度；'auto' 仅单色图片转灰度
+        gray_tolerance: 'auto' 模式下判断单色的通道差异阈值
+    """
+    def __init__(self, fmt='png', png_compress_level=6, jpeg_quality=90,
+                 webp_lossless=True, webp_quality=80, webp_method=4,
+                 grayscale=False, gray_tolerance=8):
+        if fmt not in FORMAT_EXTENSIONS:
+            raise ValueError(f"不支持的图片格式: {fmt}")
+        self.fmt = fmt
+        self.png_compress_level = png_compress_level
+        self.jpeg_quality = jpeg_quality
+        self.webp_lossless = webp_lossless
+        self.webp_quality = webp_quality
+        self.webp_method = webp_method
+        self.grayscale = grayscale
+        self.gray_tolerance = gray_tolerance
+    
+    @property
+    def extension(self):
+        return FORMAT_EXTENSIONS[self.fmt]
+    
+    @property
+    def mime_type(self):
+        return FORMAT_MIME_TYPES[self.fmt]
+    
+    def _resolve_format(self, image):
+        # WebP 有尺寸上限，超出时退回 PNG
+        if self.fmt == 'webp' and max(image.size) > WEBP_MAX_SIDE:
+            return 'png'
+        return self.fmt
+    
+    def encode(self, image):
+        """编码图片，返回 (实际使用的格式, 编码后的字节)"""
+        if self.grayscale == 'auto':
+            if image.mode != 'L' and is_monochrome(image, self.gray_tolerance):
+                image = image.convert('L')
+        elif self.grayscale:
+            image = image.convert('L')
+        
+        fmt = self._resolve_format(image)
+        buffer = io.BytesIO()
+        if fmt == 'png':
+            image.save(buffer, format='PNG', compress_level=self.png_compress_level)
+        elif fmt == 'webp':
+            image.save(buffer, format='WEBP', lossless=self.webp_lossless,
+                       quality=self.webp_quality, method=self.webp_method)
+        else:
+            image.save(buffer, format='JPEG', quality=self.jpeg_quality)
+        return fmt, buffer.getvalue()
+    
+    def output_path(self, path_without_suffix, fmt=None):
+        """根据实际编码格式生成输出路径"""
+        return f"{path_without_suffix}{FORMAT_EXTENSIONS[fmt or self.fmt]}"
+    
+    def encode_to_file(self, image, path_without_suffix, writer=None):
+        """
+        编码并写入文件，返回包含路径、字节数和耗时的结果
+        
+        writer 不为 None 时不单独写文件，而是调用 writer.write(文件名, 字节)（例如 tar 分片），
+        结果中的路径为 writer 返回的位置
+        """
+        start_time = time.perf_counter()
+        fmt, data = self.encode(image)
+        encode_seconds = time.perf_counter() - start_time
+        
+        output_path = self.output_path(path_without_suffix, fmt)
+        if writer is not None:
+            output_path = writer.write(os.path.basename(output_path), data)
+        else:
+            with open(output_path, 'wb') as f:
+                f.write(data)
+        
+        return {
+            'path': output_path,
+            'format': fmt,
+            'bytes': len(data),
+            'sha256': hashlib.sha256(data).hexdigest(),
+            'encode_seconds': encode_seconds,
+        }
+
+# PIL 识别出的格式到 FORMAT_EXTENSIONS 中格式名的对应
+PIL_FORMATS = {
+    'PNG': 'png',
+    'WEBP': 'webp',
+    'JPEG': 'jpeg',
+}
+
+def prepare_for_upload(image_bytes, encoder=None):
+    """
+    把图片缩小到视觉模型 high detail 实际使用的尺寸（2048px 内、最短边 768px），返回 (mime类型, 字节, (宽, 高))
+    
+    超出的像素API会直接缩掉，上传前缩小可以让请求体小好几倍。
+    encoder 不为 None 时按它重新编码（例如 JPEG/WebP），否则保持原格式；
+    不需要缩小且不重新编码时直接返回原始字节。
+    """
+    with Image.open(io.BytesIO(image_bytes)) as image:
+        fmt = PIL_FORMATS.get(image.format, 'png')
+        size = effective_high_detail_size(*image.size)
+        if size == image.size and encoder is None:
+            return FORMAT_MIME_TYPES[fmt], image_bytes, image.size
+        
+        image.load()
+        if size != image.size:
+            image = image.resize((max(1, size[0]), max(1, size[1])), Image.LANCZOS)
+        if encoder is None:
+            encoder = ImageEncoder(fmt)
+        if image.mode not in ('RGB', 'L') and encoder.fmt == 'jpeg':
+            image = image.convert('RGB')
+        fmt, data = encoder.encode(image)
+        return FORMAT_MIME_TYPES[fmt], data, image.size
+
+class EncodeStats:
+    """按格式统计编码后的字节数和编码耗时"""
+    def __init__(self):
+        self.by_format = {}
+    
+    def record(self, fmt, num_bytes, encode_seconds):
+        entry = self.by_format.setdefault(fmt, {'count': 0, 'bytes': 0, 'encode_seconds': 0.0})
+        entry['count'] += 1
+        entry['bytes'] += num_bytes
+        entry['encode_seconds'] += encode_seconds
+    
+    def record_result(self, result):
+        self.record(result['format'], result['bytes'], result['encode_seconds'])
+    
+    def merge(self, by_format):
+        """合并其他进程返回的 by_format 统计"""
+        for fmt, other in by_format.items():
+            entry = self.by_format.setdefault(fmt, {'count': 0, 'bytes': 0, 'encode_seconds': 0.0})
+            for key in entry:
+                entry[key] += other[key]
+    
+    def report(self):
+        """输出各格式的图片数量、总字节数和编码耗时"""
+        if not self.by_format:
+            print("没有编码任何图片")
+            return
+        print("编码统计:")
+        for fmt, entry in sorted(self.by_format.items()):
+            count = entry['count']
+            print(f"  {fmt}: {count} 张, 共 {entry['bytes'] / (1024 * 1024):.2f} MB, "
+                  f"平均 {entry['bytes'] / count / 1024:.1f} KB/张, "
+                  f"编码耗时 {entry['encode_seconds']:.2f} 秒, "
+                  f"平均 {entry['encode_seconds'] / count * 1000:.1f} 毫秒/张")
+
+class EncodeStage:
+    """
+    独立的编码线程池，渲染线程提交图片后立即继续渲染下一张
+    
+    in-flight 的图片数量受 max_pending 限制，超过时等待最早提交的图片编码完成，
+    避免渲染速度快于编码时像素缓冲无限堆积。
+    """
+    def __init__(self, encoder, workers=2, max_pending=None):
+        self.encoder = encoder
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.max_pending = max_pending or workers * 2
+        self.pending = deque()
+    
+    def submit(self, image, path_without_suffix, context=None, on_done=None, writer=None):
+        """
+        提交一张图片，返回此时已经完成的 (context, result) 列表
+        
+        on_done 会在编码线程里、编码结束（无论成功与否）后立即调用，可用于释放内存配额；
+        writer 见 ImageEncoder.encode_to_file
+        """
+        future = self.executor.submit(self.encoder.encode_to_file, image, path_without_suffix, writer)
+        if on_done is not None:
+            future.add_done_callback(lambda _: on_done())
+        self.pending.append((context, future))
+        finished = []
+        while len(self.pending) > self.max_pending:
+            finished.append(self._pop_oldest())
+        return finished
+    
+    def _pop_oldest(self):
+        context, future = self.pending.popleft()
+        try:
+            return context, future.result()
+        except Exception as e:
+            return context, {'error': str(e)}
+    
+    def drain(self):
+        """等待所有未完成的编码任务，返回 (context, result) 列表"""
+        finished = []
+        while self.pending:
+            finished.append(self._pop_oldest())
+        return finished
+    
+    def close(self):
+        self.drain()
+        self.executor.shutdown()
\ No newline at end of file
@@ -0,0 +1,201 @@
+# 这个模块把大量小图片写入按大小切分的 tar 分片（WebDataset 风格），代替每张图片一个文件
+# 几十万个小 PNG 在本地文件系统和 GCS 上的逐个操作开销远大于数据本身，合并成几百个分片后上传/下载都快得多
+#
+# 每个分片 <prefix>-00000.tar 旁边有一个索引 <prefix>-00000.idx.json，记录每张图片在 tar 中的数据偏移和长度，
+# 读取单张图片时直接 seek，不需要解包整个分片。分片写完才改为正式文件名，未写完的分片不会被读到。
+#
+# 使用示例：
+#     # 列出目录下所有分片中的图片
+#     python image_shards.py list "/root/rawdata/gcs/textbook_ocr/6 细胞生物学（5）/auto/figures"
+#
+#     # 取出单张图片
+#     python image_shards.py extract "/root/rawdata/gcs/textbook_ocr/6 细胞生物学（5）/auto/figures" "xxx_page_1_图_1.png" -o /tmp
+
+import argparse
+import io
+import json
+import os
+import tarfile
+import threading
+import time
+
+# 默认每个分片约1GB
+DEFAULT_SHARD_BYTES = 1 << 30
+
+SHARD_SUFFIX = '.tar'
+SHARD_INDEX_SUFFIX = '.idx.json'
+
+def shard_index_path(tar_path):
+    """xxx-00000.tar 的索引为 xxx-00000.idx.json"""
+    return tar_path[:-len(SHARD_SUFFIX)] + SHARD_INDEX_SUFFIX
+
+class ShardWriter:
+    """
+    把图片依次写入 <output_dir>/<prefix>-NNNNN.tar，超过 max_bytes 或 max_count 时换下一个分片
+    
+    可以在多个编码线程中同时调用 write
+    """
+    def __init__(self, output_dir, prefix, max_bytes=DEFAULT_SHARD_BYTES, max_count=None):
+        self.output_dir = str(output_dir)
+        self.prefix = prefix
+        self.max_bytes = max_bytes
+        self.max_count = max_count
+        os.makedirs(self.output_dir, exist_ok=True)
+        
+        self.lock = threading.Lock()
+        self.shard_num = 0
+        self.tar = None
+        self.tar_path = None
+        self.index = {}
+        self.shard_bytes = 0
+        self.shard_paths = []
+    
+    def _open_shard(self):
+        self.tar_path = os.path.join(self.output_dir, f"{self.prefix}-{self.shard_num:05d}{SHARD_SUFFIX}")
+        self.tar = tarfile.open(self.tar_path + '.tmp', 'w', format=tarfile.PAX_FORMAT)
+        self.index = {}
+        self.shard_bytes = 0
+        self.shard_num += 1
+    
+    def _close_shard(self):
+        if self.tar is None:
+            return
+        self.tar.close()
+        index_path = shard_index_path(self.tar_path)
+        with open(index_path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump({'shard': os.path.basename(self.tar_path), 'files': self.index}, f, ensure_ascii=False)
+        os.replace(self.tar_path + '.tmp', self.tar_path)
+        os.replace(index_path + '.tmp', index_path)
+        self.shard_paths.append(self.tar_path)
+        self.tar = None
+    
+    def write(self, name, data):
+        """写入一张图片，返回位置 <分片路径>::<文件名>"""
+        with self.lock:
+            if self.tar is not None and self.index:
+                full = self.shard_bytes + len(data) > self.max_bytes
+                if full or (self.max_count and len(self.index) >= self.max_count):
+                    self._close_shard()
+            if self.tar is None:
+                self._open_shard()
+            
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            info.mtime = time.time()
+            self.tar.addfile(info, io.BytesIO(data))
+            # 数据块按512字节补齐，tar.offset 为补齐后的结束位置
+            offset = self.tar.offset - -(-len(data) // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+            self.index[name] = [offset, len(data)]
+            self.shard_bytes = self.tar.offset
+            return f"{self.tar_path}::{name}"
+    
+    def close(self):
+        """写完当前分片，返回本次写出的所有分片路径"""
+        with self.lock:
+            self._close_shard()
+        return self.shard_paths
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.close()
+
+class ShardReader:
+    """通过索引按文件名读取单个分片中的图片"""
+    def __init__(self, tar_path):
+        self.tar_path = tar_path
+        with open(shard_index_path(tar_path), 'r', encoding='utf-8') as f:
+            self.index = json.load(f)['files']
+        self.file = open(tar_path, 'rb')
+    
+    def names(self):
+        return list(self.index)
+    
+    def __contains__(self, name):
+        return name in self.index
+    
+    def read(self, name):
+        """读取一张图片的字节，不存在时抛出 KeyError"""
+        offset, size = self.index[name]
+        self.file.seek(offset)
+        return self.file.read(size)
+    
+    def close(self):
+        self.file.close()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.close()
+
+class ShardDirectory:
+    """读取一个目录下所有分片，按文件名查找所在分片"""
+    def __init__(self, directory):
+        self.directory = str(directory)
+        self.locations = {}
+        for filename in sorted(os.listdir(self.directory)):
+            if not filename.endswith(SHARD_SUFFIX):
+                continue
+            tar_path = os.path.join(self.directory, filename)
+            if not os.path.exists(shard_index_path(tar_path)):
+                continue
+            with open(shard_index_path(tar_path), 'r', encoding='utf-8') as f:
+                for name in json.load(f)['files']:
+                    self.locations[name] = tar_path
+        self.readers = {}
+    
+    def names(self):
+        return list(self.locations)
+    
+    def __contains__(self, name):
+        return name in self.locations
+    
+    def read(self, name):
+        tar_path = self.locations[name]
+        reader = self.readers.get(tar_path)
+        if reader is None:
+            reader = self.readers[tar_path] = ShardReader(tar_path)
+        return reader.read(name)
+    
+    def close(self):
+        for reader in self.readers.values():
+            reader.close()
+        self.readers = {}
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="查看和读取图片分片")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    
+    list_parser = subparsers.add_parser("list", help="列出目录下所有分片中的图片")
+    list_parser.add_argument("directory", help="分片所在目录")
+    
+    extract_parser = subparsers.add_parser("extract", help="从分片中取出图片")
+    extract_parser.add_argument("directory", help="分片所在目录")
+    extract_parser.add_argument("names", nargs='+', help="图片文件名")
+    extract_parser.add_argument("-o", "--output-dir", default=".", help="输出目录")
+    args = parser.parse_args()
+    
+    with ShardDirectory(args.directory) as shards:
+        if args.command == "list":
+            for name in shards.names():
+                print(f"{shards.locations[name]}::{name}")
+            print(f"共 {len(shards.names())} 张图片")
+            return
+        
+        os.makedirs(args.output_dir, exist_ok=True)
+        for name in args.names:
+            output_path = os.path.join(args.output_dir, name)
+            with open(output_path, 'wb') as f:
+                f.write(shards.read(name))
+            print(f"已取出: {output_path}")
+
+if __name__ == "__main__":
+    main()
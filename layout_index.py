@@ -0,0 +1,132 @@
+# 这个脚本为 _middle.json 建立页偏移索引（sidecar 文件），记录 pdf_info 中每一页的字节偏移和长度
+# 之后读取某几页时只需 seek 到对应位置解码这几页，不用再解析整个文件
+#
+# 使用示例：
+#     # 为 textbook_ocr 下所有书建立索引
+#     python layout_index.py /root/rawdata/gcs/textbook_ocr
+#
+#     # 为单个文件建立索引
+#     python layout_index.py "/root/rawdata/gcs/textbook_ocr/6 细胞生物学（5）/auto/6 细胞生物学（5）_middle.json"
+
+import argparse
+import json
+import os
+from layout_stream import iter_array_items
+
+INDEX_SUFFIX = '.pageidx.json'
+
+def index_path_for(json_path):
+    """X_middle.json 的索引文件为 X_middle.pageidx.json"""
+    base, _ = os.path.splitext(str(json_path))
+    return base + INDEX_SUFFIX
+
+def build_page_index(json_path, index_path=None):
+    """流式扫描一遍 _middle.json，把每页的 [字节偏移, 字节长度] 按 page_idx 写入索引文件"""
+    index_path = index_path or index_path_for(json_path)
+    stat = os.stat(json_path)
+    
+    pages = {}
+    for position, (page, _, start, end) in enumerate(iter_array_items(json_path)):
+        page_idx = int(page.get('page_idx', position))
+        pages[str(page_idx)] = [start, end - start]
+    
+    index = {
+        'source_size': stat.st_size,
+        'source_mtime': stat.st_mtime,
+        'pages': pages,
+    }
+    tmp_path = index_path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(index, f, separators=(',', ':'))
+    os.replace(tmp_path, index_path)
+    return index
+
+def is_index_fresh(index, json_path):
+    """索引记录的源文件大小和修改时间与当前文件一致时才可用"""
+    stat = os.stat(json_path)
+    return index.get('source_size') == stat.st_size and index.get('source_mtime') == stat.st_mtime
+
+def load_page_index(json_path, rebuild=True):
+    """
+    读取索引，索引不存在或已过期时按 rebuild 决定是否重建
+    
+    返回索引字典，不可用且不重建时返回 None
+    """
+    index_path = index_path_for(json_path)
+    if os.path.exists(index_path):
+        with open(index_path, 'r', encoding='utf-8') as f:
+            index = json.load(f)
+        if is_index_fresh(index, json_path):
+            return index
+    if not rebuild:
+        return None
+    return build_page_index(json_path, index_path)
+
+class PageReader:
+    """通过页偏移索引随机读取 _middle.json 中的指定页面"""
+    def __init__(self, json_path, rebuild=True):
+        self.json_path = json_path
+        index = load_page_index(json_path, rebuild=rebuild)
+        if index is None:
+            raise FileNotFoundError(f"页索引不存在或已过期: {index_path_for(json_path)}")
+        self.offsets = {int(page_idx): tuple(entry) for page_idx, entry in index['pages'].items()}
+        self.file = open(json_path, 'rb')
+    
+    def page_indices(self):
+        """返回所有页的 page_idx（升序）"""
+        return sorted(self.offsets)
+    
+    def read_page(self, page_idx):
+        """读取并解码一页，页不存在时抛出 KeyError"""
+        start, length = self.offsets[page_idx]
+        self.file.seek(start)
+        return json.loads(self.file.read(length).decode('utf-8'))
+    
+    def iter_pages(self, page_indices=None):
+        """按给定顺序逐页返回页面数据，默认返回所有页；不存在的页会被跳过"""
+        if page_indices is None:
+            page_indices = self.page_indices()
+        for page_idx in page_indices:
+            if page_idx in self.offsets:
+                yield self.read_page(page_idx)
+    
+    def iter_page_range(self, start, end):
+        """返回 start <= page_idx < end 的页面"""
+        return self.iter_pages(page_idx for page_idx in self.page_indices() if start <= page_idx < end)
+    
+    def close(self):
+        self.file.close()
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.close()
+
+def find_middle_jsons(path):
+    """path 为 _middle.json 文件时直接返回，为目录时查找 <书>/auto/<书>_middle.json"""
+    if os.path.isfile(path):
+        return [path]
+    json_paths = []
+    for subdir in sorted(os.listdir(path)):
+        json_path = os.path.join(path, subdir, 'auto', f'{subdir}_middle.json')
+        if os.path.exists(json_path):
+            json_paths.append(json_path)
+    return json_paths
+
+def main():
+    parser = argparse.ArgumentParser(description="为 _middle.json 建立页偏移索引")
+    parser.add_argument("paths", nargs='+', help="_middle.json 文件或 textbook_ocr 目录")
+    parser.add_argument("--force", action="store_true", help="即使索引未过期也重建")
+    args = parser.parse_args()
+    
+    for path in args.paths:
+        for json_path in find_middle_jsons(path):
+            if not args.force and load_page_index(json_path, rebuild=False) is not None:
+                print(f"索引已是最新，跳过: {json_path}")
+                continue
+            index = build_page_index(json_path)
+            print(f"已建立索引: {index_path_for(json_path)} ({len(index['pages'])} 页)")
+
+if __name__ == "__main__":
+    main()
\ No newline at end of file
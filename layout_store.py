@@ -0,0 +1,183 @@
+# 这个脚本把每本书的 _middle.json 转换成紧凑的列式文件（NumPy .npz）
+# 下游只需要每个块的 page_idx、type、index 和 bbox，不必每次都重新解析冗长的嵌套JSON
+#
+# 每一行是块内找到的一个 bbox（块自身及嵌套的子块、行、span），列为:
+#   page  - page_idx
+#   type  - 块类型编码，对应 type_names
+#   index - 块的 index 字段
+#   block - 块的序号（全书唯一，同一个块的行是连续的）
+#   bbox  - x0, y0, x1, y1
+#
+# 使用示例：
+#     python layout_store.py /root/rawdata/gcs/textbook_ocr
+
+import argparse
+import os
+import numpy as np
+from layout_index import find_middle_jsons
+from layout_stream import iter_bboxes, iter_pages
+
+STORE_SUFFIX = '.layout.npz'
+
+def store_path_for(json_path):
+    """X_middle.json 的列式文件为 X_middle.layout.npz"""
+    base, _ = os.path.splitext(str(json_path))
+    return base + STORE_SUFFIX
+
+class LayoutStore:
+    """一本书所有块的 bbox 列式存储，支持按页/类型筛选和按块向量化求最大bbox"""
+    def __init__(self, page, type_code, index, block, bbox, type_names, source_size=0, source_mtime=0.0):
+        self.page = page
+        self.type_code = type_code
+        self.index = index
+        self.block = block
+        self.bbox = bbox
+        self.type_names = list(type_names)
+        self.source_size = source_size
+        self.source_mtime = source_mtime
+    
+    def __len__(self):
+        return len(self.page)
+    
+    @classmethod
+    def from_middle_json(cls, json_path):
+        """流式解析 _middle.json 生成列式数据"""
+        type_names = []
+        type_codes = {}
+        pages, codes, indices, blocks, bboxes = [], [], [], [], []
+        
+        block_id = 0
+        for page_data in iter_pages(json_path):
+            page_idx = int(page_data.get('page_idx', 0))
+            for block in page_data.get('preproc_blocks', []):
+                block_type = str(block.get('type'))
+                if block_type not in type_codes:
+                    type_codes[block_type] = len(type_names)
+                    type_names.append(block_type)
+                for bbox in iter_bboxes(block):
+                    # 跳过无效的bbox格式
+                    if not isinstance(bbox, (list, tuple)) or len(bbox) != 4:
+                        continue
+                    pages.append(page_idx)
+                    codes.append(type_codes[block_type])
+                    indices.append(int(block.get('index') or 0))
+                    blocks.append(block_id)
+                    bboxes.append(bbox)
+                block_id += 1
+        
+        stat = os.stat(json_path)
+        return cls(
+            page=np.asarray(pages, dtype=np.int32),
+            type_code=np.asarray(codes, dtype=np.int16),
+            index=np.asarray(indices, dtype=np.int32),
+            block=np.asarray(blocks, dtype=np.int32),
+            bbox=np.asarray(bboxes, dtype=np.float64).reshape(-1, 4),
+            type_names=type_names,
+            source_size=stat.st_size,
+            source_mtime=stat.st_mtime,
+        )
+    
+    def save(self, store_path):
+        tmp_path = store_path + '.tmp.npz'
+        np.savez_compressed(
+            tmp_path,
+            page=self.page, type_code=self.type_code, index=self.index,
+            block=self.block, bbox=self.bbox,
+            type_names=np.asarray(self.type_names, dtype=str),
+            source=np.asarray([self.source_size, self.source_mtime], dtype=np.float64),
+        )
+        os.replace(tmp_path, store_path)
+    
+    @classmethod
+    def load(cls, store_path):
+        with np.load(store_path) as data:
+            source_size, source_mtime = data['source']
+            return cls(
+                page=data['page'], type_code=data['type_code'], index=data['index'],
+                block=data['block'], bbox=data['bbox'],
+                type_names=data['type_names'].tolist(),
+                source_size=int(source_size), source_mtime=float(source_mtime),
+            )
+    
+    def _subset(self, mask):
+        return LayoutStore(
+            self.page[mask], self.type_code[mask], self.index[mask], self.block[mask],
+            self.bbox[mask], self.type_names, self.source_size, self.source_mtime,
+        )
+    
+    def select(self, pages=None, page_range=None, types=None):
+        """
+        筛选行
+        
+        参数:
+            pages: page_idx 列表
+            page_range: (start, end)，选择 start <= page_idx < end
+            types: 块类型名列表，如 ('image', 'table')
+        """
+        mask = np.ones(len(self), dtype=bool)
+        if pages is not None:
+            mask &= np.isin(self.page, np.asarray(list(pages), dtype=np.int32))
+        if page_range is not None:
+            mask &= (self.page >= page_range[0]) & (self.page < page_range[1])
+        if types is not None:
+            codes = [self.type_names.index(t) for t in types if t in self.type_names]
+            mask &= np.isin(self.type_code, np.asarray(codes, dtype=np.int16))
+        return self._subset(mask)
+    
+    def block_bboxes(self):
+        """
+        按块求所有 bbox 的最大外接矩形（向量化）
+        
+        返回 (page, type_code, index, bbox) 四个数组，每个块一行，保持文件中的顺序
+        """
+        if len(self) == 0:
+            return self.page, self.type_code, self.index, self.bbox
+        # 同一个块的行是连续的，找出每个块的起始行
+        starts = np.flatnonzero(np.r_[True, self.block[1:] != self.block[:-1]])
+        bbox = np.column_stack([
+            np.minimum.reduceat(self.bbox[:, 0], starts),
+            np.minimum.reduceat(self.bbox[:, 1], starts),
+            np.maximum.reduceat(self.bbox[:, 2], starts),
+            np.maximum.reduceat(self.bbox[:, 3], starts),
+        ])
+        return self.page[starts], self.type_code[starts], self.index[starts], bbox
+    
+    def iter_blocks(self):
+        """逐块返回 (page_idx, 块类型, index, 最大bbox)"""
+        page, type_code, index, bbox = self.block_bboxes()
+        for i in range(len(page)):
+            yield int(page[i]), self.type_names[type_code[i]], int(index[i]), bbox[i].tolist()
+
+def build_layout_store(json_path, store_path=None):
+    store = LayoutStore.from_middle_json(json_path)
+    store.save(store_path or store_path_for(json_path))
+    return store
+
+def load_layout_store(json_path, rebuild=True):
+    """读取列式文件，不存在或与 _middle.json 不一致时按 rebuild 决定是否重建，不可用时返回 None"""
+    store_path = store_path_for(json_path)
+    if os.path.exists(store_path):
+        store = LayoutStore.load(store_path)
+        stat = os.stat(json_path)
+        if store.source_size == stat.st_size and store.source_mtime == stat.st_mtime:
+            return store
+    if not rebuild:
+        return None
+    return build_layout_store(json_path, store_path)
+
+def main():
+    parser = argparse.ArgumentParser(description="把 _middle.json 转换为列式 bbox 文件")
+    parser.add_argument("paths", nargs='+', help="_middle.json 文件或 textbook_ocr 目录")
+    parser.add_argument("--force", action="store_true", help="即使列式文件未过期也重建")
+    args = parser.parse_args()
+    
+    for path in args.paths:
+        for json_path in find_middle_jsons(path):
+            if not args.force and load_layout_store(json_path, rebuild=False) is not None:
+                print(f"列式文件已是最新，跳过: {json_path}")
+                continue
+            store = build_layout_store(json_path)
+            print(f"已生成: {store_path_for(json_path)} ({len(store)} 个bbox, 类型: {', '.join(store.type_names)})")
+
+if __name__ == "__main__":
+    main()
\ No newline at end of file
@@ -0,0 +1,149 @@
+# 这个模块用于流式读取 MinerU 输出的 _middle.json
+# 大书的 _middle.json 有几百MB，json.load 需要好几倍的内存，而下游只需要逐页处理，
+# 这里按块读取文件，只把 pdf_info 数组中的当前这一页解码成对象，内存占用与单页大小相当
+
+import codecs
+import json
+
+_WHITESPACE = ' \t\r\n'
+
+class JsonArrayStream:
+    """
+    增量读取JSON文件，逐个解码顶层对象中某个数组字段的元素
+    
+    每个元素用 json 的C解码器整体解码，同时记录它在文件中的字节偏移，
+    供分片、建立页索引等场景使用。
+    """
+    def __init__(self, f, chunk_size=1 << 20):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.text_decoder = codecs.getincrementaldecoder('utf-8')()
+        self.json_decoder = json.JSONDecoder()
+        self.buf = ''
+        self.pos = 0
+        self.byte_pos = 0
+        self.eof = False
+    
+    def _fill(self, size=None):
+        """读入更多数据，同时丢弃已经处理过的部分，返回是否读到了新数据"""
+        if self.eof:
+            return False
+        if self.pos:
+            self.buf = self.buf[self.pos:]
+            self.pos = 0
+        data = self.f.read(size or self.chunk_size)
+        if not data:
+            self.eof = True
+            self.buf += self.text_decoder.decode(b'', final=True)
+            return False
+        self.buf += self.text_decoder.decode(data)
+        return True
+    
+    def _peek(self):
+        """跳过空白并返回下一个字符，文件结束时返回空字符串"""
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in _WHITESPACE:
+                self.pos += 1
+                self.byte_pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                return ''
+    
+    def _expect(self, char):
+        if self._peek() != char:
+            raise ValueError(f"JSON格式错误: 字节偏移 {self.byte_pos} 处期望 {char!r}")
+        self.pos += 1
+        self.byte_pos += 1
+    
+    def _decode_value(self):
+        """解码下一个完整的JSON值，返回 (对象, 原始文本, 起始字节偏移, 结束字节偏移)"""
+        self._peek()
+        size = self.chunk_size
+        while True:
+            try:
+                obj, end = self.json_decoder.raw_decode(self.buf, self.pos)
+                # 值正好在缓冲区末尾结束时（例如数字）可能被截断，需要多读一些再确认
+                if end < len(self.buf) or self.eof:
+                    break
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            # 单个值超出缓冲区时按倍数读入，避免大页面反复重试
+            self._fill(size)
+            size *= 2
+        
+        text = self.buf[self.pos:end]
+        start = self.byte_pos
+        self.byte_pos += len(text.encode('utf-8'))
+        self.pos = end
+        return obj, text, start, self.byte_pos
+    
+    def iter_array(self, key):
+        """逐个返回顶层对象中 key 数组的元素 (对象, 原始文本, 起始字节偏移, 结束字节偏移)"""
+        if self._peek() == '\ufeff':
+            self.pos += 1
+            self.byte_pos += 3
+        self._expect('{')
+        if self._peek() == '}':
+            return
+        while True:
+            name, _, _, _ = self._decode_value()
+            self._expect(':')
+            if name == key and self._peek() == '[':
+                self._expect('[')
+                if self._peek() == ']':
+                    return
+                while True:
+                    yield self._decode_value()
+                    if self._peek() == ']':
+                        return
+                    self._expect(',')
+            # 其他字段直接跳过
+            self._decode_value()
+            if self._peek() == '}':
+                return
+            self._expect(',')
+
+def iter_array_items(json_path, key='pdf_info', chunk_size=1 << 20):
+    """流式读取 json_path 顶层对象中的 key 数组，返回 (对象, 原始文本, 起始字节偏移, 结束字节偏移)"""
+    with open(json_path, 'rb') as f:
+        yield from JsonArrayStream(f, chunk_size).iter_array(key)
+
+def iter_pages(json_path):
+    """逐页返回 _middle.json 中 pdf_info 的每一项"""
+    for page_data, _, _, _ in iter_array_items(json_path):
+        yield page_data
+
+def iter_bboxes(data):
+    """
+    迭代地遍历嵌套的 dict/list，按深度优先顺序返回所有 bbox 字段
+    
+    与递归版本的遍历顺序一致：先返回当前字典自身的 bbox，再依次遍历各个值。
+    """
+    stack = [data]
+    while stack:
+        item = stack.pop()
+        if isinstance(item, dict):
+            if 'bbox' in item:
+                yield item['bbox']
+            stack.extend(reversed(list(item.values())))
+        elif isinstance(item, list):
+            stack.extend(reversed(item))
+
+def iter_layout_records(json_path, block_types=('image', 'table')):
+    """
+    流式返回 (page_idx, block_type, index, bbox) 记录
+    
+    每个 bbox 是块内（包括块自身和嵌套子块、行、span）找到的一个 bbox，
+    block_types 为 None 时返回所有类型的块。
+    """
+    for page_data in iter_pages(json_path):
+        page_idx = int(page_data.get('page_idx', 0))
+        for block in page_data.get('preproc_blocks', []):
+            block_type = block.get('type')
+            if block_types is not None and block_type not in block_types:
+                continue
+            index = block.get('index', 0)
+            for bbox in iter_bboxes(block):
+                yield page_idx, block_type, index, bbox
\ No newline at end of file
@@ -1,41 +1,94 @@
 import json
 import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from layout_stream import iter_array_items
 
-def split_json_by_pages(input_file, output_dir, pages_per_file):
+# 输出格式:
+#   pretty  - indent=2 缩进（旧行为，体积最大）
+#   compact - 不缩进、无多余空格
+#   raw     - 直接复制原文件中每一页的原始文本，不重新序列化，速度最快
+OUTPUT_FORMATS = ('pretty', 'compact', 'raw')
+
+def write_chunk(output_file, pages, output_format):
+    """把一组页面写成 {"pdf_info": [...]} 文件，pages 为 [(页面对象, 原始文本), ...]"""
+    with open(output_file, 'w', encoding='utf-8') as f:
+        if output_format == 'raw':
+            f.write('{"pdf_info": [')
+            f.write(', '.join(text for _, text in pages))
+            f.write(']}')
+        elif output_format == 'compact':
+            json.dump({'pdf_info': [page for page, _ in pages]}, f,
+                      ensure_ascii=False, separators=(',', ':'))
+        else:
+            json.dump({'pdf_info': [page for page, _ in pages]}, f,
+                      ensure_ascii=False, indent=2)
+    return output_file
+
+def split_json_by_pages(input_file, output_dir, pages_per_file=None, max_bytes=None,
+                        output_format='pretty', max_workers=4):
+    """
+    流式拆分 _middle.json，边解析边写出分片文件，内存占用与分片大小相当
+    
+    参数:
+        pages_per_file: 每个文件的最大页数
+        max_bytes: 每个文件的最大字节数（按原文件中页面的原始字节数计算），
+                   单页超过上限时单独成为一个文件
+        output_format: pretty / compact / raw
+        max_workers: 写文件的线程数，同时最多有 max_workers 个分片在内存中等待写出
+    """
+    if pages_per_file is None and max_bytes is None:
+        raise ValueError("pages_per_file 和 max_bytes 至少需要指定一个")
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"不支持的输出格式: {output_format}")
+    
     print(f"开始处理文件: {input_file}")
     print(f"输出目录: {output_dir}")
-    print(f"每个文件页数: {pages_per_file}")
+    print(f"每个文件页数: {pages_per_file or '不限'}，每个文件字节数: {max_bytes or '不限'}")
     
     # 创建输出目录
     os.makedirs(output_dir, exist_ok=True)
     
-    # 读取原始JSON
-    print("正在读取JSON文件...")
-    with open(input_file, 'r', encoding='utf-8') as f:
-        data = json.load(f)
+    chunk = []
+    chunk_bytes = 0
+    first_page = 1
+    total_pages = 0
+    pending = deque()
     
-    # 获取页面列表
-    pages = data['pdf_info']
-    total_pages = len(pages)
-    print(f"总页数: {total_pages}")
-    
-    # 按每个文件页数进行分割
-    for i in range(0, total_pages, pages_per_file):
-        chunk = {
-            'pdf_info': pages[i:i + pages_per_file]
-        }
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        def flush():
+            nonlocal chunk, chunk_bytes, first_page
+            if not chunk:
+                return
+            # 生成输出文件名
+            output_file = os.path.join(
+                output_dir,
+                f'pages_{first_page}_to_{first_page + len(chunk) - 1}.json'
+            )
+            pending.append(executor.submit(write_chunk, output_file, chunk, output_format))
+            first_page += len(chunk)
+            chunk = []
+            chunk_bytes = 0
+            # 限制等待写出的分片数量，保证内存占用有上限
+            while len(pending) > max_workers:
+                print(f"已保存文件: {pending.popleft().result()}")
         
-        # 生成输出文件名
-        output_file = os.path.join(
-            output_dir, 
-            f'pages_{i+1}_to_{min(i+pages_per_file, total_pages)}.json'
-        )
+        # 逐页读取pdf_info数组
+        for page, text, start, end in iter_array_items(input_file):
+            page_bytes = end - start
+            if chunk and max_bytes is not None and chunk_bytes + page_bytes > max_bytes:
+                flush()
+            chunk.append((page, text))
+            chunk_bytes += page_bytes
+            total_pages += 1
+            if pages_per_file is not None and len(chunk) >= pages_per_file:
+                flush()
+        flush()
         
-        print(f"正在保存文件: {output_file}")
-        # 保存分割后的文件
-        with open(output_file, 'w', encoding='utf-8') as f:
-            json.dump(chunk, f, ensure_ascii=False, indent=2)
+        while pending:
+            print(f"已保存文件: {pending.popleft().result()}")
     
+    print(f"总页数: {total_pages}")
     print("文件处理完成!")
 
 
@@ -45,4 +98,4 @@ if __name__ == '__main__':
     output_dir = '/root/rawdata/json_split'
 
     # 拆分文件
-    split_json_by_pages(input_path, output_dir, pages_per_file=3)
\ No newline at end of file
+    split_json_by_pages(input_path, output_dir, pages_per_file=3, output_format='compact')
\ No newline at end of file
@@ -5,7 +5,8 @@ import math
 # 这个脚本用于计算图片的token数量，用于OpenAI API的调用限制
 # 算出来不准还是怎么了，最后坑死了我，实际上搞一本书大概要四美元
 
-def calculate_high_detail_tokens(width, height):
+def effective_high_detail_size(width, height):
+    """计算 high detail 模式下 API 实际使用的图片尺寸，超出部分的像素会被API直接缩掉"""
     # 首先确保尺寸在2048x2048范围内
     if width > 2048 or height > 2048:
         ratio = 2048 / max(width, height)
@@ -19,10 +20,16 @@ def calculate_high_detail_tokens(width, height):
         width = int(width * ratio)
         height = int(height * ratio)
     
+    return width, height
+
+def count_high_detail_tiles(width, height):
+    """计算图片在 high detail 模式下占用的512px方块数"""
+    width, height = effective_high_detail_size(width, height)
+    return math.ceil(width / 512) * math.ceil(height / 512)
+
+def calculate_high_detail_tokens(width, height):
     # 计算需要多少个512px的方块
-    tiles_width = math.ceil(width / 512)
-    tiles_height = math.ceil(height / 512)
-    total_tiles = tiles_width * tiles_height
+    total_tiles = count_high_detail_tiles(width, height)
     
     # 计算总token：每个tile 170 tokens + 基础85 tokens
     return (total_tiles * 170) + 85
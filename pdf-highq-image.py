@@ -1,13 +1,37 @@
+import argparse
 import fitz
 import math
 import os
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from image_encoder import FORMAT_EXTENSIONS, EncodeStage, EncodeStats, ImageEncoder, pixmap_to_image
+from image_shards import ShardWriter
 
-def convert_page(page_info):
-    """单页转换函数"""
-    pdf_path, page_num, output_dir, pdf_name = page_info
+# 每个工作进程内缓存已打开的PDF，避免每页都重新 fitz.open 解析 xref
+_doc_cache = OrderedDict()
+_DOC_CACHE_SIZE = 4
+
+# 每个工作进程内的编码线程池，渲染下一页时上一页在后台编码
+_encode_stage = None
+_ENCODE_THREADS = 2
+
+def _get_document(pdf_path):
+    """获取当前进程缓存的PDF文档，超过缓存上限时关闭最久未用的文档"""
+    pdf = _doc_cache.get(pdf_path)
+    if pdf is not None:
+        _doc_cache.move_to_end(pdf_path)
+        return pdf
     
     pdf = fitz.open(pdf_path)
+    _doc_cache[pdf_path] = pdf
+    while len(_doc_cache) > _DOC_CACHE_SIZE:
+        _, old_pdf = _doc_cache.popitem(last=False)
+        old_pdf.close()
+    return pdf
+
+def render_page(pdf_path, page_num, target_dpi=300):
+    """渲染单页，返回 PIL 图片，编码交给编码线程"""
+    pdf = _get_document(pdf_path)
     page = pdf.load_page(page_num)
     
     # 获取页面尺寸
@@ -16,7 +40,6 @@ def convert_page(page_info):
     height_in_points = rect.height
     
     # 设置 DPI 和缩放
-    target_dpi = 300
     zoom = target_dpi / 72.0
     
     # 创建高分辨率图片
@@ -29,19 +52,154 @@ def convert_page(page_info):
     dpi_w = math.floor((width_in_pixels / width_in_points) * 72)
     dpi_h = math.floor((height_in_pixels / height_in_points) * 72)
     
-    # 保存图片
-    output_path = f"{output_dir}/{pdf_name}_page_{page_num + 1}.png"
-    pix.save(output_path)
+    return pixmap_to_image(pix)
+
+def _get_encode_stage(encoder):
+    """获取当前工作进程的编码线程池"""
+    global _encode_stage
+    if _encode_stage is None:
+        _encode_stage = EncodeStage(encoder, workers=_ENCODE_THREADS)
+    _encode_stage.encoder = encoder
+    return _encode_stage
+
+class _PageBuffer:
+    """分片输出时工作进程不写文件，把编码后的字节交回主进程写入 tar 分片"""
+    def __init__(self):
+        self.pages = {}
     
-    pdf.close()
+    def write(self, name, data):
+        self.pages[name] = data
+        return name
+
+def convert_page_range(range_info):
+    """
+    在同一个工作进程内连续转换一段页面，渲染和编码流水线执行，返回每页的结果
+    
+    to_parent 为 True 时不写文件，每页结果的 'data' 为编码后的字节，由主进程写入分片
+    """
+    pdf_path, start_page, end_page, output_dir, pdf_name, encoder, to_parent = range_info
+    stage = _get_encode_stage(encoder)
+    buffer = _PageBuffer() if to_parent else None
+    
+    results = []
+    
+    def collect(finished):
+        for (page_num, size), result in finished:
+            result['page_num'] = page_num
+            result['size'] = size
+            if buffer is not None and 'error' not in result:
+                result['data'] = buffer.pages.pop(result['path'])
+            results.append(result)
+    
+    for page_num in range(start_page, end_page):
+        try:
+            image = render_page(pdf_path, page_num)
+        except Exception as e:
+            results.append({'page_num': page_num, 'error': str(e)})
+            continue
+        path_without_suffix = f"{output_dir}/{pdf_name}_page_{page_num + 1}"
+        collect(stage.submit(image, path_without_suffix, context=(page_num, image.size), writer=buffer))
     
-    return {
-        'page_num': page_num,
-        'size': (width_in_pixels, height_in_pixels),
-        'path': output_path
-    }
+    collect(stage.drain())
+    return results
 
-def get_pdf_info_and_convert(pdf_path, output_dir):
+def split_page_ranges(total_pages, pages_per_task):
+    """把页面切分为连续页段"""
+    return [
+        (start, min(start + pages_per_task, total_pages))
+        for start in range(0, total_pages, pages_per_task)
+    ]
+
+def build_render_tasks(pdf_jobs, max_workers, encoder, pages_per_task=None, to_parent=False):
+    """
+    为所有PDF生成全局的 (pdf, 页段) 任务队列，按工作量从大到小排序
+    
+    参数:
+        pdf_jobs: [(pdf_path, output_dir, pdf_name, total_pages), ...]
+        max_workers: 进程数
+        encoder: ImageEncoder 编码配置
+        pages_per_task: 每个任务的页数，默认按全部页数平均每个进程约分到4段
+        to_parent: 工作进程是否把编码结果交回主进程（分片输出）
+    """
+    total_pages = sum(job[3] for job in pdf_jobs)
+    if pages_per_task is None:
+        pages_per_task = max(1, math.ceil(total_pages / (max_workers * 4)))
+    
+    tasks = []
+    for pdf_path, output_dir, pdf_name, page_count in pdf_jobs:
+        for start, end in split_page_ranges(page_count, pages_per_task):
+            tasks.append((pdf_path, start, end, output_dir, pdf_name, encoder, to_parent))
+    
+    # 最大任务优先（LPT调度），页数相同时大书优先，避免大书的尾巴拖到最后
+    book_pages = {job[0]: job[3] for job in pdf_jobs}
+    tasks.sort(key=lambda task: (task[2] - task[1], book_pages[task[0]]), reverse=True)
+    return tasks
+
+def run_render_tasks(pdf_jobs, max_workers=None, pages_per_task=None, encoder=None, shard_bytes=None):
+    """
+    用一个进程池执行所有PDF的页段任务，每本书的最后一个页段完成时输出汇总
+    
+    shard_bytes 不为 None 时每本书的页面写入输出目录下按大小切分的 tar 分片，由主进程统一写入
+    """
+    # 进程数默认等于CPU核数
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+    if encoder is None:
+        encoder = ImageEncoder()
+    
+    tasks = build_render_tasks(pdf_jobs, max_workers, encoder, pages_per_task, to_parent=bool(shard_bytes))
+    print(f"共 {len(pdf_jobs)} 个PDF，{sum(job[3] for job in pdf_jobs)} 页，拆分为 {len(tasks)} 个任务")
+    
+    # 记录每本书剩余的任务数和失败页数
+    remaining = {job[0]: 0 for job in pdf_jobs}
+    for task in tasks:
+        remaining[task[0]] += 1
+    failed_pages = {job[0]: 0 for job in pdf_jobs}
+    stats = EncodeStats()
+    shard_writers = {}
+    
+    # 使用进程池执行转换，每个工作进程对每本书只打开一次PDF
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        # 提交所有任务
+        future_to_task = {executor.submit(convert_page_range, task): task for task in tasks}
+        
+        # 页段一完成就输出结果
+        for future in as_completed(future_to_task):
+            pdf_path, start_page, end_page, output_dir, pdf_name, _, _ = future_to_task[future]
+            try:
+                results = future.result()
+            except Exception as e:
+                print(f"{pdf_name} 页面 {start_page + 1}-{end_page} 转换失败: {str(e)}\n")
+                results = []
+                failed_pages[pdf_path] += end_page - start_page
+            
+            for result in results:
+                page_num = result['page_num']
+                if 'error' in result:
+                    print(f"{pdf_name} 页面 {page_num + 1} 转换失败: {result['error']}\n")
+                    failed_pages[pdf_path] += 1
+                    continue
+                if shard_bytes:
+                    if pdf_path not in shard_writers:
+                        shard_writers[pdf_path] = ShardWriter(output_dir, pdf_name, max_bytes=shard_bytes)
+                    result['path'] = shard_writers[pdf_path].write(result['path'], result.pop('data'))
+                stats.record_result(result)
+                print(f"{pdf_name} 页面 {page_num + 1} 转换完成:")
+                print(f"输出尺寸: {result['size'][0]} x {result['size'][1]} 像素")
+                print(f"保存图片: {result['path']}\n")
+            
+            remaining[pdf_path] -= 1
+            if remaining[pdf_path] == 0:
+                if pdf_path in shard_writers:
+                    shard_paths = shard_writers.pop(pdf_path).close()
+                    print(f"{pdf_name} 共写入 {len(shard_paths)} 个分片")
+                print(f"{pdf_name} 转换完成！失败页数: {failed_pages[pdf_path]}\n")
+    
+    stats.report()
+    return failed_pages
+
+def get_pdf_info_and_convert(pdf_path, output_dir, max_workers=None, pages_per_task=None, encoder=None,
+                             shard_bytes=None):
     # 确保输出目录存在
     os.makedirs(output_dir, exist_ok=True)
     
@@ -58,29 +216,14 @@ def get_pdf_info_and_convert(pdf_path, output_dir):
     
     print(f"PDF 总页数: {total_pages}")
     
-    # 准备转换任务
-    tasks = [(pdf_path, i, output_dir, pdf_name) for i in range(total_pages)]
-    
-    # 使用线程池执行转换
-    with ThreadPoolExecutor(max_workers=10) as executor:
-        # 提交所有任务
-        future_to_page = {executor.submit(convert_page, task): task[1] for task in tasks}
-        
-        # 处理完成的任务
-        for future in as_completed(future_to_page):
-            page_num = future_to_page[future]
-            try:
-                result = future.result()
-                print(f"页面 {page_num + 1} 转换完成:")
-                print(f"输出尺寸: {result['size'][0]} x {result['size'][1]} 像素")
-                print(f"保存图片: {result['path']}\n")
-            except Exception as e:
-                print(f"页面 {page_num + 1} 转换失败: {str(e)}\n")
+    run_render_tasks([(pdf_path, output_dir, pdf_name, total_pages)], max_workers, pages_per_task, encoder,
+                     shard_bytes)
     
     print("转换完成！")
 
-def process_pdf_directory(input_dir, output_base_dir):
-    """处理指定目录下的所有PDF文件"""
+def process_pdf_directory(input_dir, output_base_dir, max_workers=None, pages_per_task=None, encoder=None,
+                          shard_bytes=None):
+    """处理指定目录下的所有PDF文件，所有PDF的页段共用一个全局任务队列"""
     print(f"开始处理目录: {input_dir}")
     
     # 获取目录下所有PDF文件
@@ -92,24 +235,50 @@ def process_pdf_directory(input_dir, output_base_dir):
     
     print(f"找到 {len(pdf_files)} 个PDF文件")
     
-    # 处理每个PDF文件
+    # 统计每个PDF的页数
+    pdf_jobs = []
     for pdf_file in pdf_files:
         pdf_path = os.path.join(input_dir, pdf_file)
         pdf_name = os.path.splitext(pdf_file)[0]
         output_dir = os.path.join(output_base_dir, pdf_name)
         
-        print(f"\n开始处理PDF文件: {pdf_file}")
         try:
-            get_pdf_info_and_convert(pdf_path, output_dir)
+            with fitz.open(pdf_path) as pdf:
+                total_pages = pdf.page_count
         except Exception as e:
             print(f"处理 {pdf_file} 时发生错误: {str(e)}")
             continue
+        
+        os.makedirs(output_dir, exist_ok=True)
+        print(f"{pdf_file}: {total_pages} 页")
+        pdf_jobs.append((pdf_path, output_dir, pdf_name, total_pages))
+    
+    if not pdf_jobs:
+        return
+    
+    run_render_tasks(pdf_jobs, max_workers, pages_per_task, encoder, shard_bytes)
+    print("所有PDF转换完成！")
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="把目录下所有PDF的每一页转换为高清图片")
+    parser.add_argument("input_dir", nargs='?', default=None, help="PDF文件所在目录，不指定时交互输入")
+    parser.add_argument("--output-dir", default="/root/rawdata/gcs/textbook_images", help="输出目录")
+    parser.add_argument("--workers", type=int, default=None, help="进程数，默认等于CPU核数")
+    parser.add_argument("--format", choices=sorted(FORMAT_EXTENSIONS), default="png", help="输出图片格式")
+    parser.add_argument("--shard-mb", type=int, default=None,
+                        help="把页面图片写入每个约该大小（MB）的 tar 分片，默认每页一个文件")
+    args = parser.parse_args()
+    
     # 设置输入和输出目录
-    print("请输入PDF文件所在目录路径:")
-    input_dir = input().strip()
-    output_base_dir = "/root/rawdata/gcs/textbook_images"
+    input_dir = args.input_dir
+    if input_dir is None:
+        print("请输入PDF文件所在目录路径:")
+        input_dir = input().strip()
     
     # 执行批量转换
-    process_pdf_directory(input_dir, output_base_dir)
\ No newline at end of file
+    process_pdf_directory(
+        input_dir, args.output_dir,
+        max_workers=args.workers,
+        encoder=ImageEncoder(args.format),
+        shard_bytes=args.shard_mb * (1 << 20) if args.shard_mb else None,
+    )
\ No newline at end of file
@@ -0,0 +1,183 @@
+# 这个模块为 OpenAI API 调用提供自适应限流：同时按 每分钟请求数（RPM）和 每分钟token数（TPM）两个令牌桶放行请求，
+# 根据响应头 x-ratelimit-* 调整桶的容量和剩余量，遇到 429/5xx 时带随机抖动地指数退避重试
+#
+# 原来只用 asyncio.Semaphore(100) 控制并发，要么用不满配额，要么被429打回来变成空描述；
+# 现在请求按配额均匀发出，稳定贴着配额上限跑
+#
+# 用法：
+#     limiter = RateLimiter(requests_per_minute=5000, tokens_per_minute=2000000)
+#     response = await call_with_retry(
+#         limiter,
+#         lambda: client.chat.completions.with_raw_response.create(...),
+#         tokens=estimate_request_tokens(width, height, prompt, max_tokens=1000),
+#     )
+#
+# client 需要设置 max_retries=0，重试统一由这里处理
+
+import asyncio
+import random
+import re
+import time
+import openai
+from openai_image_tokenizer import calculate_high_detail_tokens
+
+def parse_reset_seconds(value):
+    """解析 x-ratelimit-reset-* 的时长，例如 "1s"、"6m0s"、"20ms"、"1h2m3.5s"，无法解析时返回 None"""
+    if not value:
+        return None
+    total = 0.0
+    matched = False
+    for number, unit in re.findall(r'([\d.]+)(ms|h|m|s)', value):
+        matched = True
+        total += float(number) * {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}[unit]
+    return total if matched else None
+
+def estimate_request_tokens(width, height, prompt, max_tokens):
+    """
+    估算一次请求占用的 TPM：图片 token + 提示词 + max_tokens
+    
+    提示词按每个字符一个token粗略估计（中文基本如此），API 也按 max_tokens 预占输出额度
+    """
+    return calculate_high_detail_tokens(width, height) + len(prompt) + max_tokens
+
+class TokenBucket:
+    """按每分钟容量匀速补充的令牌桶"""
+    def __init__(self, per_minute):
+        self.capacity = per_minute
+        self.tokens = per_minute
+        self.updated_at = time.monotonic()
+    
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.capacity / 60)
+        self.updated_at = now
+    
+    def wait_time(self, amount):
+        """还需要等待多少秒才能取出 amount 个令牌（超过容量的请求按容量计算）"""
+        self._refill()
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) * 60 / self.capacity
+    
+    def consume(self, amount):
+        self._refill()
+        self.tokens -= min(amount, self.capacity)
+    
+    def set_capacity(self, per_minute):
+        self._refill()
+        self.capacity = per_minute
+        self.tokens = min(self.tokens, per_minute)
+    
+    def sync_remaining(self, remaining):
+        """服务端报告的剩余量比本地估计少时以服务端为准"""
+        self._refill()
+        self.tokens = min(self.tokens, remaining)
+
+class RateLimiter:
+    """同时按 RPM 和 TPM 放行请求，按到达顺序排队"""
+    def __init__(self, requests_per_minute, tokens_per_minute):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.lock = asyncio.Lock()
+        self.paused_until = 0.0
+        self.stats = {'requests': 0, 'rate_limited': 0, 'server_errors': 0, 'retries': 0, 'failed': 0}
+    
+    async def acquire(self, tokens):
+        """等待直到配额允许发出一个占用 tokens 的请求"""
+        async with self.lock:
+            while True:
+                wait = max(
+                    self.paused_until - time.monotonic(),
+                    self.requests.wait_time(1),
+                    self.tokens.wait_time(tokens),
+                )
+                if wait <= 0:
+                    break
+                await asyncio.sleep(wait)
+            self.requests.consume(1)
+            self.tokens.consume(tokens)
+            self.stats['requests'] += 1
+    
+    def pause(self, seconds):
+        """收到429后所有请求暂停一段时间"""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+    
+    def update_from_headers(self, headers):
+        """根据 x-ratelimit-* 响应头调整桶的容量和剩余量"""
+        for bucket, name in ((self.requests, 'requests'), (self.tokens, 'tokens')):
+            limit = headers.get(f'x-ratelimit-limit-{name}')
+            remaining = headers.get(f'x-ratelimit-remaining-{name}')
+            try:
+                if limit is not None and int(limit) > 0 and int(limit) != bucket.capacity:
+                    bucket.set_capacity(int(limit))
+                if remaining is not None:
+                    bucket.sync_remaining(int(remaining))
+            except ValueError:
+                continue
+    
+    def report(self):
+        stats = self.stats
+        print(f"限流统计: 请求 {stats['requests']} 次, 429 {stats['rate_limited']} 次, "
+              f"5xx/连接错误 {stats['server_errors']} 次, 重试 {stats['retries']} 次, 最终失败 {stats['failed']} 次, "
+              f"当前配额 {self.requests.capacity} RPM / {self.tokens.capacity} TPM")
+
+def _retry_after_seconds(headers):
+    """读取 retry-after-ms / retry-after / x-ratelimit-reset-* 中建议的等待时间"""
+    if headers is None:
+        return None
+    for name, scale in (('retry-after-ms', 0.001), ('retry-after', 1)):
+        value = headers.get(name)
+        try:
+            if value is not None:
+                return float(value) * scale
+        except ValueError:
+            pass
+    resets = [parse_reset_seconds(headers.get(f'x-ratelimit-reset-{name}')) for name in ('requests', 'tokens')]
+    resets = [reset for reset in resets if reset is not None]
+    return max(resets) if resets else None
+
+async def call_with_retry(limiter, make_request, tokens, max_retries=6, base_delay=1.0, max_delay=60.0):
+    """
+    限流后发出请求，429/5xx/连接错误时随机抖动地指数退避重试
+    
+    参数:
+        make_request: 无参数的协程函数，返回 with_raw_response 的原始响应
+        tokens: 该请求预估占用的TPM
+    返回解析后的响应，重试用尽或遇到其他错误时抛出异常
+    """
+    for attempt in range(max_retries + 1):
+        await limiter.acquire(tokens)
+        try:
+            raw_response = await make_request()
+            limiter.update_from_headers(raw_response.headers)
+            return raw_response.parse()
+        except openai.RateLimitError as e:
+            limiter.stats['rate_limited'] += 1
+            headers = e.response.headers if e.response is not None else None
+            if headers is not None:
+                limiter.update_from_headers(headers)
+            delay = _retry_after_seconds(headers)
+            if delay is not None:
+                limiter.pause(delay)
+            error = e
+        except (openai.APIConnectionError, openai.InternalServerError) as e:
+            limiter.stats['server_errors'] += 1
+            delay = None
+            error = e
+        except openai.APIStatusError as e:
+            if e.status_code < 500:
+                raise
+            limiter.stats['server_errors'] += 1
+            delay = None
+            error = e
+        
+        if attempt == max_retries:
+            break
+        # 全抖动的指数退避，避免大量协程同时重试
+        backoff = random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+        limiter.stats['retries'] += 1
+        await asyncio.sleep(max(backoff, delay or 0))
+    
+    limiter.stats['failed'] += 1
+    raise error
@@ -1,6 +1,19 @@
+# 检查已有描述文件中的不合格描述（过短、空、拒绝回答），默认只输出报告
+# figure_descriper.py / figure_pipeline.py 已经在拿到描述时检查并立即重试，这个脚本用于检查旧的描述文件；
+# 指定 --remove-entries 时从JSON中删除这些条目（下次运行描述脚本时会重新描述），
+# 只有同时指定 --delete-images 才会删除对应的图片（删除后这些图片不会再被描述）
+#
+# 使用示例：
+#     python short_figure_description_detector.py /root/rawdata/gcs/textbook_ocr --remove-entries
+#     # 从图片目录中查询有短描述的书，只读取这些书的描述文件
+#     python short_figure_description_detector.py --catalog /root/rawdata/figure_catalog.sqlite --remove-entries
+
+import argparse
 import os
 import json
 import datetime
+from description_quality import MIN_DESCRIPTION_LENGTH, check_description
+from figure_catalog import FigureCatalog
 
 def find_json_files(directory):
     """递归查找所有以_figures_description.json结尾的文件"""
@@ -11,8 +24,8 @@ def find_json_files(directory):
                 json_files.append(os.path.join(root, file))
     return json_files
 
-def process_json_files(json_files):
-    """处理所有json文件并收集短描述，同时删除这些条目和对应的图片"""
+def process_json_files(json_files, remove_entries=False, delete_images=False, min_length=MIN_DESCRIPTION_LENGTH):
+    """收集所有json文件中的不合格描述，按参数删除这些条目和对应的图片"""
     short_descriptions = {}
     
     for json_file in json_files:
@@ -20,20 +33,23 @@ def process_json_files(json_files):
             with open(json_file, 'r', encoding='utf-8') as f:
                 data = json.load(f)
             
-            # 找出所有值长度小于100的键值对
-            short_items = {k: v for k, v in data.items() if len(v) < 100}
+            # 找出所有不合格（过短、空、拒绝回答）的键值对
+            short_items = {k: v for k, v in data.items() if check_description(v, min_length) is not None}
             
             if short_items:
                 # 使用文件名作为键来组织数据
                 filename = os.path.basename(json_file)
                 short_descriptions[filename] = short_items
                 
+                if not remove_entries:
+                    continue
+                
                 # 从原始数据中删除这些条目
                 for key in short_items:
                     del data[key]
                     # 删除对应的图片文件
                     figure_path = os.path.join(os.path.dirname(json_file), 'figures', key)
-                    if os.path.exists(figure_path):
+                    if delete_images and os.path.exists(figure_path):
                         try:
                             os.remove(figure_path)
                             print(f"已删除图片: {figure_path}")
@@ -60,11 +76,20 @@ def save_results(results, output_file):
         print(f"保存结果时出错: {str(e)}")
 
 def main():
-    # 设置要搜索的目录（当前目录）
-    directory = "."
+    parser = argparse.ArgumentParser(description="检查描述文件中的不合格描述")
+    parser.add_argument("directory", nargs='?', default=".", help="要搜索的目录")
+    parser.add_argument("--output-dir", default="/root/rawdata/batch_request", help="报告的输出目录")
+    parser.add_argument("--min-length", type=int, default=MIN_DESCRIPTION_LENGTH, help="描述的最短字数")
+    parser.add_argument("--remove-entries", action="store_true", help="从JSON中删除不合格的条目，以便重新描述")
+    parser.add_argument("--delete-images", action="store_true", help="同时删除对应的图片（需要和 --remove-entries 一起使用）")
+    parser.add_argument("--catalog", default=None, help="从图片目录数据库中查询，不再遍历目录")
+    args = parser.parse_args()
+    
+    # 设置要搜索的目录
+    directory = args.directory
     
     # 设置输出路径
-    output_dir = "/root/rawdata/batch_request"
+    output_dir = args.output_dir
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
     
@@ -72,13 +97,27 @@ def main():
     timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
     output_file = os.path.join(output_dir, f"short_descriptions_{timestamp}.json")
     
-    # 查找所有json文件
-    json_files = find_json_files(directory)
+    catalog = FigureCatalog(args.catalog) if args.catalog else None
+    if catalog is not None:
+        # 只读取目录中记录了短描述的书
+        books = {book for book, _, _ in catalog.short_descriptions(args.min_length)}
+        json_files = [os.path.join(auto_dir, f"{book}_figures_description.json")
+                      for book, auto_dir in catalog.book_dirs(books).items()]
+    else:
+        # 查找所有json文件
+        json_files = find_json_files(directory)
     print(f"找到 {len(json_files)} 个json文件")
     
-    # 处理文件并收集短描述，同时删除相关内容
-    results = process_json_files(json_files)
-    print(f"处理完成，共删除 {sum(len(v) for v in results.values())} 个短描述条目")
+    # 处理文件并收集短描述，按参数删除相关内容
+    results = process_json_files(json_files, args.remove_entries, args.delete_images, args.min_length)
+    total = sum(len(v) for v in results.values())
+    if args.remove_entries:
+        print(f"处理完成，共删除 {total} 个短描述条目")
+        if catalog is not None:
+            for filename, items in results.items():
+                catalog.clear_descriptions(filename[:-len('_figures_description.json')], items)
+    else:
+        print(f"检查完成，共 {total} 个不合格的描述（未修改文件，使用 --remove-entries 删除）")
     
     # 保存结果
     save_results(results, output_file)
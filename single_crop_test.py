@@ -1,6 +1,9 @@
 import fitz
 import argparse
+import numpy as np
 from pathlib import Path
+from layout_index import PageReader
+from layout_stream import iter_bboxes
 
 def get_max_bbox(bboxes):
     """
@@ -11,16 +14,18 @@ def get_max_bbox(bboxes):
     返回:
         最大矩形范围 [x0, y0, x1, y1]
     """
-    if not bboxes:
+    if len(bboxes) == 0:
         return None
-        
+    
+    # 向量化计算，bboxes 也可以直接是 (N, 4) 的数组（例如 LayoutStore.bbox）
+    bboxes = np.asarray(bboxes)
     max_bbox = [
-        min(b[0] for b in bboxes),  # x0
-        min(b[1] for b in bboxes),  # y0 
-        max(b[2] for b in bboxes),  # x1
-        max(b[3] for b in bboxes)   # y1
+        bboxes[:, 0].min(),  # x0
+        bboxes[:, 1].min(),  # y0
+        bboxes[:, 2].max(),  # x1
+        bboxes[:, 3].max()   # y1
     ]
-    return max_bbox
+    return [value.item() for value in max_bbox]
 
 def crop_pdf_page(pdf_path, page_num, bbox, output_dir="debug_crops"):
     """
@@ -62,6 +67,28 @@ def crop_pdf_page(pdf_path, page_num, bbox, output_dir="debug_crops"):
     finally:
         doc.close()
 
+def get_page_block_bboxes(layout_json_path, page_idx, block_types=('image', 'table')):
+    """
+    通过页偏移索引只读取一页，返回该页每个图表块的最大bbox
+    
+    参数:
+        layout_json_path: _middle.json 路径（索引不存在时会先建立索引）
+        page_idx: 页码 (从0开始)
+    返回:
+        [(block_type, index, bbox), ...]
+    """
+    with PageReader(layout_json_path) as reader:
+        page_data = reader.read_page(page_idx)
+    
+    blocks = []
+    for block in page_data.get('preproc_blocks', []):
+        if block.get('type') not in block_types:
+            continue
+        bboxes = [b for b in iter_bboxes(block) if isinstance(b, (list, tuple)) and len(b) == 4]
+        if bboxes:
+            blocks.append((block.get('type'), block.get('index', 0), get_max_bbox(bboxes)))
+    return blocks
+
 def main():
     # 硬编码输入参数
     pdf_path = "/root/rawdata/gcs/textbook_ocr/6 细胞生物学（5）/auto/6 细胞生物学（5）_layout.pdf"
@@ -1,6 +1,5 @@
 import asyncio
 import aiohttp
-import base64
 import os
 from pathlib import Path
 import json
@@ -8,12 +7,12 @@ from datetime import datetime
 from tqdm import tqdm
 import random
 import time
+from async_io import LoopLagMonitor, read_file_base64
 
 API_KEY = os.getenv("STEP_API_KEY")
 
 async def encode_image_to_base64(image_path):
-    with open(image_path, 'rb') as image_file:
-        return base64.b64encode(image_file.read()).decode('utf-8')
+    return await read_file_base64(image_path)
 
 async def calculate_tokens(session, image_base64, api_key, model):
     url = "https://api.stepfun.com/v1/token/count"
@@ -170,7 +169,8 @@ async def main():
         raise ValueError("请设置环境变量 STEP_API_KEY")
 
     folder_path = "/root/rawdata/test_output"
-    results = await process_images(folder_path, api_key)
+    async with LoopLagMonitor():
+        results = await process_images(folder_path, api_key)
     print("\n总计token数:")
     for model, tokens in results.items():
         print(f"{model}: {tokens}")
@@ -0,0 +1,158 @@
+# batch_result_ingest.py 的测试：在临时目录中生成书籍图片、请求分片、结果文件和错误文件
+
+import asyncio
+import json
+from pathlib import Path
+
+import pytest
+from PIL import Image
+
+from batch_result_ingest import ingest_results, load_manifest_images
+from figure_descriper_batch_jsonl import iter_images, make_custom_id, write_batch_requests
+
+LONG_DESCRIPTION = '细胞膜由磷脂双分子层构成，' * 10
+
+def make_book(root, book, names):
+    figure_dir = root / book / 'auto' / 'figures'
+    figure_dir.mkdir(parents=True)
+    for i, name in enumerate(names):
+        Image.new('RGB', (64 + i, 48), (i * 30, 100, 50)).save(figure_dir / name)
+    return figure_dir
+
+def success(custom_id, content=LONG_DESCRIPTION):
+    return {
+        'custom_id': custom_id,
+        'response': {'status_code': 200, 'body': {'choices': [{'message': {'content': content}, 'finish_reason': 'stop'}]}},
+        'error': None,
+    }
+
+def failure(custom_id, code='batch_expired'):
+    return {'custom_id': custom_id, 'response': None, 'error': {'code': code, 'message': 'failed'}}
+
+def write_jsonl(path, records):
+    with open(path, 'w', encoding='utf-8') as f:
+        for record in records:
+            f.write(json.dumps(record, ensure_ascii=False) + '\n')
+    return str(path)
+
+def read_descriptions(root, book):
+    with open(root / book / 'auto' / f'{book}_figures_description.json', 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+@pytest.fixture
+def library(tmp_path):
+    root = tmp_path / 'textbook_ocr'
+    make_book(root, '1 书A', ['a1.png', 'a2.png', 'a3.png'])
+    make_book(root, '2 书B', ['b1.png', 'b2.png'])
+    # 书A已经有一条之前的描述
+    with open(root / '1 书A' / 'auto' / '1 书A_figures_description.json', 'w', encoding='utf-8') as f:
+        json.dump({'a0.png': '旧的描述'}, f, ensure_ascii=False)
+    
+    request_base = tmp_path / 'batch_request' / 'batch_requests.jsonl'
+    manifests = asyncio.run(write_batch_requests(iter_images(str(root)), str(request_base), max_requests=2, workers=1))
+    return root, tmp_path, manifests
+
+def test_request_shards_and_manifests(library):
+    root, tmp_path, manifests = library
+    assert [manifest['requests'] for manifest in manifests] == [2, 2, 1]
+    images = load_manifest_images([str(tmp_path / 'batch_request' / '*.manifest.json')])
+    assert images[make_custom_id('1 书A', 'a1.png')] == str(root / '1 书A' / 'auto' / 'figures' / 'a1.png')
+    assert len(images) == 5
+
+def test_merge_per_book_and_retry_set(library):
+    root, tmp_path, _ = library
+    manifest_images = load_manifest_images([str(tmp_path / 'batch_request' / '*.manifest.json')])
+    output = write_jsonl(tmp_path / 'batch_output.jsonl', [
+        success(make_custom_id('1 书A', 'a1.png')),
+        success(make_custom_id('1 书A', 'a2.png'), content='太短'),
+        success(make_custom_id('2 书B', 'b1.png')),
+    ])
+    errors = write_jsonl(tmp_path / 'batch_errors.jsonl', [
+        failure(make_custom_id('1 书A', 'a3.png')),
+        failure(make_custom_id('2 书B', 'b2.png'), code='server_error'),
+    ])
+    
+    written, failures = ingest_results([output, errors], manifest_images, root_dir=None)
+    
+    assert written == {'1 书A': 1, '2 书B': 1}
+    assert read_descriptions(root, '1 书A') == {'a0.png': '旧的描述', 'a1.png': LONG_DESCRIPTION}
+    assert read_descriptions(root, '2 书B') == {'b1.png': LONG_DESCRIPTION}
+    # 过短的描述和错误文件中的请求都进入重试集合
+    assert set(failures) == {
+        make_custom_id('1 书A', 'a2.png'),
+        make_custom_id('1 书A', 'a3.png'),
+        make_custom_id('2 书B', 'b2.png'),
+    }
+    assert failures[make_custom_id('1 书A', 'a3.png')] == (
+        str(root / '1 书A' / 'auto' / 'figures' / 'a3.png'), 'batch_expired: failed'
+    )
+    
+    retry_manifests = asyncio.run(write_batch_requests(
+        [image_path for image_path, _ in failures.values()], str(tmp_path / 'retry' / 'retry.jsonl'), workers=1
+    ))
+    assert sum(manifest['requests'] for manifest in retry_manifests) == 3
+    assert set(retry_manifests[0]['images']) == set(failures)
+
+def test_resolve_by_root_dir_without_manifest(library):
+    root, tmp_path, _ = library
+    output = write_jsonl(tmp_path / 'batch_output.jsonl', [
+        success(make_custom_id('2 书B', 'b2.png')),
+        # 旧格式的 custom_id 只有文件名，没有 manifest 时无法确定所属的书
+        success('b1.png'),
+    ])
+    
+    written, failures = ingest_results([output], manifest_images={}, root_dir=str(root))
+    
+    assert written == {'2 书B': 1}
+    assert failures == {}
+    assert read_descriptions(root, '2 书B') == {'b2.png': LONG_DESCRIPTION}
+
+def test_success_after_failure(library):
+    root, tmp_path, _ = library
+    manifest_images = load_manifest_images([str(tmp_path / 'batch_request' / '*.manifest.json')])
+    custom_id = make_custom_id('1 书A', 'a3.png')
+    # 同一个请求先出现在错误文件中，重试后出现在结果文件中，反过来也一样
+    errors = write_jsonl(tmp_path / 'batch_errors.jsonl', [failure(custom_id), failure(make_custom_id('2 书B', 'b1.png'))])
+    output = write_jsonl(tmp_path / 'batch_output.jsonl', [success(custom_id), success(make_custom_id('2 书B', 'b1.png'))])
+    late_error = write_jsonl(tmp_path / 'batch_errors_2.jsonl', [failure(make_custom_id('2 书B', 'b1.png'))])
+    
+    written, failures = ingest_results([errors, output, late_error], manifest_images)
+    
+    assert failures == {}
+    assert read_descriptions(root, '1 书A')['a3.png'] == LONG_DESCRIPTION
+    assert read_descriptions(root, '2 书B') == {'b1.png': LONG_DESCRIPTION}
+
+def test_failure_already_described_is_not_retried(library):
+    root, tmp_path, _ = library
+    with open(root / '2 书B' / 'auto' / '2 书B_figures_description.json', 'w', encoding='utf-8') as f:
+        json.dump({'b2.png': LONG_DESCRIPTION}, f, ensure_ascii=False)
+    errors = write_jsonl(tmp_path / 'batch_errors.jsonl', [failure(make_custom_id('2 书B', 'b2.png'))])
+    
+    written, failures = ingest_results([errors], manifest_images={}, root_dir=str(root))
+    
+    assert written == {}
+    assert failures == {}
+    assert not Path(root / '2 书B' / 'auto' / '2 书B_figures_description.jsonl').exists()
+
+def test_corrupt_image_is_skipped_and_recorded(tmp_path):
+    root = tmp_path / 'textbook_ocr'
+    figure_dir = make_book(root, '3 书C', ['c1.png', 'c3.png'])
+    (figure_dir / 'c2.png').write_bytes(b'not a png')
+    
+    request_base = tmp_path / 'batch_request' / 'batch_requests.jsonl'
+    manifests = asyncio.run(write_batch_requests(iter_images(str(root)), str(request_base), workers=1))
+    assert [manifest['requests'] for manifest in manifests] == [2]
+    errors = manifests[0]['errors']
+    assert list(errors) == [make_custom_id('3 书C', 'c2.png')]
+    assert errors[make_custom_id('3 书C', 'c2.png')]['image_path'] == str(figure_dir / 'c2.png')
+    assert make_custom_id('3 书C', 'c3.png') in manifests[0]['images']
+
+@pytest.mark.parametrize('prompt_mode, roles', [('system', ['system', 'user']), ('user', ['user'])])
+def test_prompt_mode(tmp_path, prompt_mode, roles):
+    root = tmp_path / 'textbook_ocr'
+    make_book(root, '4 书D', ['d1.png'])
+    request_base = tmp_path / 'batch_request' / 'batch_requests.jsonl'
+    asyncio.run(write_batch_requests(iter_images(str(root)), str(request_base), workers=1, prompt_mode=prompt_mode))
+    with open(tmp_path / 'batch_request' / 'batch_requests_1.jsonl', 'r', encoding='utf-8') as f:
+        request = json.loads(f.readline())
+    assert [message['role'] for message in request['body']['messages']] == roles
@@ -1,6 +1,8 @@
 from google.cloud import storage
+import argparse
 import os
 import time
+from figure_catalog import DEFAULT_CATALOG_PATH, FigureCatalog
 
 # 设置服务账号密钥文件路径
 os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = "/root/rawdata/moobius-int-storage.json"
@@ -30,7 +32,8 @@ def should_upload_file(file_path, folder_name, base_folder):
     
     return False
 
-def upload_folder_to_gcs(bucket_name, source_folder, destination_prefix):
+def upload_folder_to_gcs(bucket_name, source_folder, destination_prefix, catalog=None):
+    """上传一本书的描述文件，catalog 不为 None 时上传成功后记录上传时间"""
     try:
         storage_client = storage.Client()
         bucket = storage_client.bucket(bucket_name)
@@ -40,22 +43,20 @@ def upload_folder_to_gcs(bucket_name, source_folder, destination_prefix):
         file_list = []
         folder_name = os.path.basename(source_folder)
         base_folder = '/root/rawdata/gcs/textbook_ocr'
-        print(f"\n扫描目录 {source_folder} ...")
         
-        for root, dirs, files in os.walk(source_folder):
-            for file in files:
-                local_path = os.path.join(root, file)
-                # 检查文件是否需要上传
-                if should_upload_file(local_path, folder_name, base_folder):
-                    # 构建 GCS 路径：移除基础路径部分，保留子文件夹之后的路径
-                    relative_path = local_path.replace(os.path.join(base_folder, folder_name) + '/', '')
-                    gcs_path = os.path.join(destination_prefix, relative_path).replace('\\', '/')
-                    file_list.append((local_path, gcs_path))
-                    total_files += 1
+        # 只需要上传描述文件，直接检查它的路径，不再遍历整本书的 figures 目录
+        local_path = os.path.join(base_folder, folder_name, 'auto', f'{folder_name}_figures_description.json')
+        if os.path.exists(local_path) and should_upload_file(local_path, folder_name, base_folder):
+            # 构建 GCS 路径：移除基础路径部分，保留子文件夹之后的路径
+            relative_path = local_path.replace(os.path.join(base_folder, folder_name) + '/', '')
+            gcs_path = os.path.join(destination_prefix, relative_path).replace('\\', '/')
+            file_list.append((local_path, gcs_path))
+            total_files += 1
         
         print(f"找到 {total_files} 个文件需要上传")
         
-        # 上传文件
+        # 上传文件，上传期间新写入的描述留到下次上传
+        upload_started = time.time()
         current_file = 0
         failed_uploads = []
         
@@ -76,16 +77,34 @@ def upload_folder_to_gcs(bucket_name, source_folder, destination_prefix):
                 print(f"- {file}")
         else:
             print("\n所有文件上传成功!")
+            if catalog is not None and file_list:
+                catalog.mark_uploaded(folder_name, upload_started)
                 
     except Exception as e:
         print(f"发生错误: {str(e)}")
 
 def main():
+    parser = argparse.ArgumentParser(description="上传每本书的描述文件到 GCS")
+    parser.add_argument("--from-catalog", action="store_true",
+                        help="图片目录中已记录的书只上传上次上传之后有新描述的，目录中没有记录的书照常上传")
+    parser.add_argument("--catalog", default=DEFAULT_CATALOG_PATH, help="图片目录数据库")
+    parser.add_argument("--no-catalog", action="store_true", help="不读写图片目录，也不记录上传时间")
+    args = parser.parse_args()
+    if args.from_catalog and args.no_catalog:
+        parser.error("--from-catalog 需要图片目录，不能和 --no-catalog 同时使用")
+    
     # 配置参数
     bucket_name = "yfd-bio"
     base_path = '/root/rawdata/gcs/textbook_ocr'
+    catalog = None if args.no_catalog else FigureCatalog(args.catalog)
     source_folders = [os.path.join(base_path, folder) for folder in os.listdir(base_path) 
                      if os.path.isdir(os.path.join(base_path, folder))]
+    if args.from_catalog:
+        # 建立目录之前描述的书不在目录中，不能跳过
+        known = catalog.book_dirs()
+        changed = {book for book, _, _ in catalog.not_uploaded()}
+        source_folders = [folder for folder in source_folders
+                          if os.path.basename(folder) not in known or os.path.basename(folder) in changed]
 
     # 上传每个文件夹
     for folder in source_folders:
@@ -96,8 +115,11 @@ def main():
         print(f"源路径: {folder}")
         print(f"目标路径: gs://{bucket_name}/{destination_prefix}")
         
-        upload_folder_to_gcs(bucket_name, folder, destination_prefix)
+        upload_folder_to_gcs(bucket_name, folder, destination_prefix, catalog)
         print(f"完成文件夹 {folder_name} 的上传")
+    
+    if catalog is not None:
+        catalog.close()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file